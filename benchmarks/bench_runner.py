@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+'''Measure how much time, how many processes, and how much memory stodgy-tester itself uses.
+
+This drives the runner's hot paths against stodgy_tester.fake_vagrant, over a synthetic suite of
+*.t files, so no real VMs are involved. Each benchmark runs in its own child process, so that its
+peak RSS is its own. Run it from the top of the repository:
+
+    python benchmarks/bench_runner.py --tests 300 --boxes 6
+
+"spawned" counts the vagrant and ssh processes the benchmark started.
+'''
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+)
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+TEST_TEMPLATE = '''Title: Synthetic test %(i)d
+Vagrant-Box: %(box)s
+
+$[run]echo starting %(i)d; seq 1 %(output_lines)d; read -p "Continue? " answer; echo "got $answer"
+starting %(i)d
+%(output_lines)d
+Continue? $[type]yes
+got yes
+$[exitcode] 0
+'''
+
+
+def make_suite(suite_dir, num_tests, num_boxes, output_lines):
+    box_names = ['box%d' % (i,) for i in range(num_boxes)]
+    for i in range(num_tests):
+        with open(os.path.join(suite_dir, 'test%04d.t' % (i,)), 'w') as f:
+            f.write(TEST_TEMPLATE % {
+                'i': i,
+                'box': box_names[i % num_boxes],
+                'output_lines': output_lines,
+            })
+    return box_names
+
+
+def count_invocations():
+    try:
+        with open(os.path.join(os.environ['STODGY_FAKE_VAGRANT_ROOT'], 'invocations.log')) as f:
+            return sum(1 for line in f)
+    except IOError:
+        return 0
+
+
+def bench_parse_test_by_filename(args, testfiles):
+    import stodgy_tester
+    for filename in testfiles:
+        stodgy_tester.parse_test_by_filename(filename)
+
+
+def bench_load_test_plan_cold(args, testfiles):
+    import stodgy_tester
+    shutil.rmtree(os.path.join(os.environ['STODGY_TESTER_STATE_DIR'], 'plans'), True)
+    for filename in testfiles:
+        stodgy_tester.load_test_plan(filename)
+
+
+def bench_load_test_plan_warm(args, testfiles):
+    import stodgy_tester
+    for filename in testfiles:
+        stodgy_tester.load_test_plan(filename)
+
+
+def bench_virtual_machine(args, testfiles):
+    import stodgy_tester
+    import stodgy_tester.helpers
+    vm = stodgy_tester.helpers.VirtualMachine('box0', command_runner=stodgy_tester.RUNNER)
+    vm.up_or_resume_if_needed()
+    for i in range(args.commands):
+        vm.run_command_within_vm('seq 1 %d' % (args.output_lines,))
+    vm.run_probes(['test -e /nonexistent-%d' % (i,) for i in range(args.commands)])
+    vm.suspend()
+    vm.up_or_resume_if_needed()
+
+
+def bench_handle_test_script(args, testfiles):
+    import stodgy_tester
+    import stodgy_tester.helpers
+    vm = stodgy_tester.helpers.VirtualMachine('box0', command_runner=stodgy_tester.RUNNER)
+    vm.up_or_resume_if_needed()
+    steps = stodgy_tester.compile_test_script([
+        '$[run]seq 1 %d; echo done' % (args.big_output_lines,),
+        '$[slow]done',
+        '$[exitcode] 0',
+    ])
+    stodgy_tester.handle_test_script(vm, steps)
+
+
+def bench_main(args, testfiles):
+    import stodgy_tester
+    sys.argv = ['stodgy-tester', '--no-adaptive-timeouts']
+    try:
+        stodgy_tester.main()
+    except SystemExit as e:
+        assert not e.code, 'main() exited %r' % (e.code,)
+
+
+BENCHMARKS = [
+    ('parse_test_by_filename', bench_parse_test_by_filename),
+    ('load_test_plan (cold)', bench_load_test_plan_cold),
+    ('load_test_plan (warm)', bench_load_test_plan_warm),
+    ('VirtualMachine', bench_virtual_machine),
+    ('handle_test_script', bench_handle_test_script),
+    ('main', bench_main),
+]
+
+
+def run_one_benchmark(args):
+    '''Run one benchmark in this process, and print its measurements as JSON.'''
+    name, function = BENCHMARKS[args.one]
+    testfiles = sorted(f for f in os.listdir('.') if f.endswith('.t'))
+    # Keep the runner's chatter out of the way; the result goes to the original stdout.
+    result_file = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    invocations_before = count_invocations()
+    started_time = time.time()
+    function(args, testfiles)
+    wall_time = time.time() - started_time
+    sys.stdout.flush()
+
+    result_file.write(json.dumps({
+        'name': name,
+        'wall_time': wall_time,
+        'spawned': count_invocations() - invocations_before,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }) + '\n')
+    result_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tests', type=int, default=100, help='Number of synthetic *.t files.')
+    parser.add_argument('--boxes', type=int, default=4, help='Number of fake Vagrant boxes.')
+    parser.add_argument('--output-lines', type=int, default=2000,
+                        help='Lines of output from each synthetic test and VM command.')
+    parser.add_argument('--big-output-lines', type=int, default=500000,
+                        help='Lines of output for the handle_test_script benchmark.')
+    parser.add_argument('--commands', type=int, default=50,
+                        help='Commands and probes for the VirtualMachine benchmark.')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON.')
+    parser.add_argument('--one', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one is not None:
+        return run_one_benchmark(args)
+
+    import stodgy_tester.fake_vagrant
+
+    work_dir = tempfile.mkdtemp(prefix='stodgy-tester-bench-')
+    try:
+        suite_dir = os.path.join(work_dir, 'suite')
+        os.makedirs(suite_dir)
+        box_names = make_suite(suite_dir, args.tests, args.boxes, args.output_lines)
+        bin_dir = os.path.join(work_dir, 'bin')
+        stodgy_tester.fake_vagrant.install(bin_dir)
+
+        env = dict(os.environ)
+        env['PATH'] = bin_dir + os.pathsep + env['PATH']
+        env['PYTHONPATH'] = REPO_DIR
+        env['STODGY_FAKE_VAGRANT_ROOT'] = os.path.join(work_dir, 'vms')
+        env['STODGY_FAKE_VAGRANT_BOXES'] = ','.join(box_names)
+        env['STODGY_TESTER_STATE_DIR'] = os.path.join(work_dir, 'state')
+
+        results = []
+        for i in range(len(BENCHMARKS)):
+            argv = [sys.executable, os.path.abspath(__file__), '--one', str(i)] + sys.argv[1:]
+            output = subprocess.check_output(argv, cwd=suite_dir, env=env)
+            results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('%-26s %10s %9s %14s' % ('benchmark', 'wall (s)', 'spawned', 'peak RSS (KB)'))
+    for result in results:
+        print('%-26s %10.3f %9d %14d' % (
+            result['name'], result['wall_time'], result['spawned'], result['peak_rss_kb']))
+
+
+if __name__ == '__main__':
+    main()
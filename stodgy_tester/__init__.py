@@ -4,16 +4,25 @@ from __future__ import (
     absolute_import,
 )
 import argparse
+import contextlib
+import functools
 import glob
+import hashlib
 import importlib
 import logging
 import os
-import pexpect
 import random
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import stodgy_tester.clones
+import stodgy_tester.distributed
 import stodgy_tester.helpers
+import stodgy_tester.package_cache
+import stodgy_tester.tracing
+import stodgy_tester.virsh
 
 plugin = None
 
@@ -29,73 +38,185 @@ def _run_capture_output(*args, **kwargs):
     return output
 
 
-def _expect(line, current_cmd, do_re_escape=True, do_detect_slow=True,
-            strip_comments=True, verbose=True):
-    timeout = 2
+def _split_timeout_token(line):
+    '''Strip a leading $[slow] or $[veryslow] token from an expectation.
 
+    Returns (text, timeout_class), where timeout_class is None, 'slow' or 'veryslow'.'''
+    for timeout_class in ['slow', 'veryslow']:
+        token = '$[' + timeout_class + ']'
+        if line.startswith(token):
+            return line.replace(token, '', 1), timeout_class
+    return line, None
+
+
+def _static_timeout_for_class(timeout_class):
     slow_text_timeout = int(os.environ.get('SLOW_TEXT_TIMEOUT', 30))
-    veryslow_text_timeout = 2 * slow_text_timeout
+    if timeout_class == 'slow':
+        return slow_text_timeout
+    if timeout_class == 'veryslow':
+        return 2 * slow_text_timeout
+    return 2
 
-    if do_detect_slow:
-        slow_token = '$[slow]'
-        if line.startswith(slow_token):
-            stodgy_tester.helpers.print_info('Slow line...')
-            timeout = slow_text_timeout
-            line = line.replace(slow_token, '', 1)
 
-        veryslow_token = '$[veryslow]'
-        if line.startswith(veryslow_token):
-            stodgy_tester.helpers.print_info('Very slow line...')
-            timeout = veryslow_text_timeout
-            line = line.replace(veryslow_token, '', 1)
+def _expect(pattern, session, timeout_class=None, timeout=None, verbose=True):
+    '''Wait for pattern, and return how many seconds that took.
 
-    if verbose:
-        stodgy_tester.helpers.print_info('expecting', line)
+    If timeout is None, it comes from timeout_class (i.e. $[slow] and $[veryslow]).'''
+    if timeout_class == 'slow':
+        stodgy_tester.helpers.print_info('Slow line...')
+    if timeout_class == 'veryslow':
+        stodgy_tester.helpers.print_info('Very slow line...')
+    if timeout is None:
+        timeout = _static_timeout_for_class(timeout_class)
 
-    if do_re_escape:
-        line = re.escape(line)
+    if verbose:
+        stodgy_tester.helpers.print_info('expecting', pattern.text, '(%.1f sec timeout)' % (
+            timeout,))
 
-    current_cmd.expect(line, timeout=timeout)
+    started_time = stodgy_tester.tracing.clock()
+    with stodgy_tester.tracing.span('expect', pattern.text, timeout=timeout):
+        offset, seconds = session.expect(pattern, timeout=timeout)
+    if verbose:
+        stodgy_tester.helpers.print_info('  matched at byte %d, %.2f sec in' % (offset, seconds))
+    return stodgy_tester.tracing.clock() - started_time
 
 
 RUNNER = stodgy_tester.helpers.CommandRunner(default_cwd=os.getcwd(), extra_env={
     'VAGRANT_DEFAULT_PROVIDER': 'libvirt'
-})
-
-
-def handle_test_script(vagrant_box_name, lines):
-    current_cmd = None
-
-    for line in lines:
-        # Figure out what we want to do, given this line.
-        if line.startswith('$[run]'):
-            arg = line.replace('$[run]', '')
-            arg = 'vagrant ssh ' + vagrant_box_name + ' -c "' + arg + '"'
-            stodgy_tester.helpers.print_info('$', arg)
-            current_cmd = pexpect.spawn(arg, cwd=os.getcwd())
-        elif '$[exitcode]' in line:
-            left, right = map(lambda s: s.strip(), line.split('$[exitcode]'))
-            # Expect end of file.
-            current_cmd.expect(pexpect.EOF, timeout=1)
-            current_cmd.close()
-            assert current_cmd.exitstatus == int(right)
-
-        elif '$[type]' in line:
-            # First, we expect the left side.
-            left, right = map(lambda s: s.strip(), line.split('$[type]'))
-            _expect(left, current_cmd=current_cmd)
-
-            if right == 'gensym':
-                # instead of typing the literal string gensym, we generate
-                # a hopefully unique collection of letters and numbers.
-                right = ''.join(
-                    random.sample('abcdefghijklmnopqrstuvwxyz0123456789', 10))
-
-            # Then we sendline the right side.
-            current_cmd.sendline(right)
+}, log_dir=stodgy_tester.helpers.state_path('logs'))
+
+
+# A step token, e.g. $[run] or $[expect:server]. The optional name picks a session.
+_STEP_TOKEN_RE = re.compile(r'\$\[(run|exitcode|type|expect)(?::([A-Za-z0-9_.-]+))?\]')
+
+
+def compile_test_script(lines, first_lineno=1):
+    '''Classify each line of a test script, so that running it needs no more parsing.
+
+    Returns a list of step dicts. Every step has a 'kind' (run, exitcode, type or expect), the
+    'lineno' it came from, and the 'session' it names, e.g. "server" for $[run:server], or None;
+    the other keys depend on the kind.'''
+    steps = []
+    for lineno, line in enumerate(lines, first_lineno):
+        token = _STEP_TOKEN_RE.search(line)
+        kind = token and token.group(1)
+        if kind in ['run', 'expect'] and token.start() != 0:
+            # These only count at the start of a line; otherwise the line is text to expect.
+            kind = None
+        if kind == 'run':
+            steps.append({'kind': 'run', 'lineno': lineno, 'session': token.group(2),
+                          'command': line[token.end():]})
+        elif kind == 'exitcode':
+            right = line[token.end():].strip()
+            steps.append({'kind': 'exitcode', 'lineno': lineno, 'session': token.group(2),
+                          'exitcode': int(right)})
+        elif kind == 'type':
+            left, right = line[:token.start()].strip(), line[token.end():].strip()
+            text, timeout_class = _split_timeout_token(left)
+            steps.append({'kind': 'type', 'lineno': lineno, 'session': token.group(2),
+                          'text': text, 'timeout_class': timeout_class, 'response': right})
         else:
             # For now, assume the action is expect.
-            _expect(line, current_cmd=current_cmd)
+            session_name = None
+            if kind == 'expect':
+                session_name = token.group(2)
+                line = line[token.end():]
+            text, timeout_class = _split_timeout_token(line)
+            steps.append({'kind': 'expect', 'lineno': lineno, 'session': session_name,
+                          'text': text, 'timeout_class': timeout_class})
+    return steps
+
+
+def handle_test_script(vm, steps, timing_history=None, test_filename=None):
+    '''Run a compiled test script against vm.
+
+    Each $[run:NAME] starts a session that runs alongside the others until its $[exitcode:NAME];
+    a plain $[run] starts the unnamed session. Steps that name a session act on it and make it the
+    current one; steps that don't act on the current one.
+
+    If a TimingHistory is given, each wait's timeout comes from how long that line took on
+    earlier runs of test_filename (falling back to the $[slow]-style timeouts), and this run's
+    timings are added to it.'''
+    # Compile every expectation up front, rather than once per wait.
+    patterns = {}
+    for i, step in enumerate(steps):
+        if step['kind'] in ['type', 'expect']:
+            patterns[i] = stodgy_tester.helpers.LiteralPattern(step['text'])
+
+    def timing_key(step):
+        return stodgy_tester.helpers.TimingHistory.key(
+            test_filename, step['lineno'], step.get('text', '$[exitcode]'))
+
+    def timeout_for(step, fallback):
+        if timing_history is None:
+            return fallback
+        return timing_history.timeout_for(timing_key(step), fallback)
+
+    def record(step, seconds):
+        if timing_history is not None:
+            timing_history.record(timing_key(step), seconds)
+
+    sessions = stodgy_tester.helpers.SessionGroup()
+    current_session_name = ''
+    # Each covers one $[run] command, from starting it to its $[exitcode].
+    session_spans = {}
+
+    try:
+        for i, step in enumerate(steps):
+            if step['kind'] == 'run' or step['session'] is not None:
+                current_session_name = step['session'] or ''
+            if step['kind'] == 'run':
+                if not current_session_name:
+                    # As before sessions had names, a plain $[run] replaces the unnamed session's
+                    # command even if it is still running. A named one must wait for $[exitcode].
+                    sessions.finish(current_session_name)
+                    if current_session_name in session_spans:
+                        session_spans.pop(current_session_name).end()
+                sessions.start(current_session_name, vm.spawn(step['command']))
+                session_spans[current_session_name] = stodgy_tester.tracing.start_span(
+                    'ssh', step['command'], lineno=step['lineno'], session=current_session_name)
+                continue
+            if step['kind'] == 'expect' and not step['text']:
+                # A blank line (e.g. at the end of the file) always matches, even once the
+                # session has exited.
+                continue
+
+            session = sessions.get(current_session_name)
+            if step['kind'] == 'exitcode':
+                # Expect end of file.
+                started_time = stodgy_tester.tracing.clock()
+                with stodgy_tester.tracing.span('expect', '$[exitcode]', lineno=step['lineno']):
+                    exitstatus = session.expect_eof(timeout=timeout_for(step, 1))
+                record(step, stodgy_tester.tracing.clock() - started_time)
+                sessions.finish(current_session_name)
+                session_spans.pop(current_session_name).end()
+                assert exitstatus == step['exitcode'], (
+                    'Session %r exited %r, not %r' % (
+                        current_session_name, exitstatus, step['exitcode']))
+
+            elif step['kind'] == 'type':
+                # First, we expect the left side.
+                record(step, _expect(
+                    patterns[i], session=session, timeout_class=step['timeout_class'],
+                    timeout=timeout_for(step, _static_timeout_for_class(step['timeout_class']))))
+
+                right = step['response']
+                if right == 'gensym':
+                    # instead of typing the literal string gensym, we generate
+                    # a hopefully unique collection of letters and numbers.
+                    right = ''.join(
+                        random.sample('abcdefghijklmnopqrstuvwxyz0123456789', 10))
+
+                # Then we sendline the right side.
+                session.sendline(right)
+            else:
+                record(step, _expect(
+                    patterns[i], session=session, timeout_class=step['timeout_class'],
+                    timeout=timeout_for(step, _static_timeout_for_class(step['timeout_class']))))
+    finally:
+        for session_span in session_spans.values():
+            session_span.end()
+        sessions.close_all()
 
 
 def parse_test_file(headers_list):
@@ -113,6 +234,14 @@ def parse_test_file(headers_list):
         if key == 'title':
             parsed_headers['title'] = value
 
+        if key == 'machine-backend':
+            assert value in MACHINE_BACKENDS, "Unknown machine-backend: %s" % (value,)
+            parsed_headers['machine-backend'] = value
+
+        if key == 'reset':
+            assert value in ['snapshot', 'destroy'], "Unknown reset: %s" % (value,)
+            parsed_headers['reset'] = value
+
         if key == 'vagrant-destroy-if-bash':
             if key not in parsed_headers:
                 parsed_headers[key] = []
@@ -138,31 +267,83 @@ def parse_test_file(headers_list):
     return parsed_headers, postconditions, cleanups
 
 
-def handle_headers(parsed_headers):
-    vagrant_box_name = parsed_headers['vagrant-box']
-    vm = stodgy_tester.helpers.VirtualMachine(name=vagrant_box_name, command_runner=RUNNER)
+# Where a test can run, chosen by its machine-backend header: a Vagrant VM (the default), or a
+# helpers.LocalProcessMachine.
+MACHINE_BACKENDS = ['vagrant', 'local']
+
+
+def make_machine(machine_name, state_tracker=None, libvirt_fast_path=False):
+    '''Return a new Machine for a TestPlan.machine_name.
+
+    With libvirt_fast_path, Vagrant boxes are suspended, resumed and shut down with virsh.'''
+    if machine_name.startswith('local:'):
+        return stodgy_tester.helpers.LocalProcessMachine(machine_name, command_runner=RUNNER)
+    vm_class = stodgy_tester.helpers.VirtualMachine
+    if libvirt_fast_path:
+        vm_class = stodgy_tester.virsh.LibvirtVirtualMachine
+    return vm_class(
+        name=machine_name,
+        command_runner=RUNNER,
+        state_tracker=state_tracker,
+        synced_guest_path=stodgy_tester.helpers.vagrant_synced_folder(),
+    )
+
+
+def handle_headers(parsed_headers, vm):
+    # Start from a pristine VM, if the test asks for one.
+    if parsed_headers.get('reset') == 'snapshot':
+        vm.reset_to_baseline()
+    elif parsed_headers.get('reset') == 'destroy':
+        stodgy_tester.helpers.print_progress('Destroying this VM...')
+        vm.destroy_then_start()
 
     # Bring up VM, if needed.
     vm.up_or_resume_if_needed()
 
+    # Any of these probes exiting 0 means the VM is in a state we can't use, so start over. We
+    # send them all in one batch, to save on SSH round trips.
     values = parsed_headers.get('vagrant-destroy-if-bash')
-    if values:
-        for value in values:
-            succeeded = False
-            try:
-                vm.run_command_within_vm(value)
-            except:
-                succeeded = True
-            if not succeeded:
-                stodgy_tester.helpers.print_progress('Destroying this VM...')
-                vm.destroy()
-                stodgy_tester.helpers.print_info('Recreating as needed...')
-                vm.up_or_resume()
+    probe_states = [stodgy_tester.helpers.probe_state(value) for value in values or []]
+    if values and vm.has_known_states(probe_states):
+        stodgy_tester.helpers.print_info('Skipping vagrant-destroy-if-bash probes (known to pass)')
+    elif values:
+        results = vm.run_probes(values)
+        if any(status == 0 for status, output in results):
+            stodgy_tester.helpers.print_progress('Destroying this VM...')
+            vm.destroy_then_start()
+        else:
+            vm.add_known_states(probe_states)
 
     values = parsed_headers.get('precondition')
     if values:
         for value in values:
-            getattr(plugin, value)(vm)
+            run_plugin_function(value, vm, skip_if_known=True)
+
+
+def run_plugin_function(name, vm, skip_if_known=False):
+    '''Call a plugin function on vm, and keep track of the states it declares.
+
+    With skip_if_known, the function isn't called if every state it declares is already known to
+    hold. A function that declares no states might change anything, so afterwards, nothing about
+    the VM is known any more.'''
+    if not vm.isolated:
+        raise Exception('Refusing to run plugin function %s on %s, which is not isolated from '
+                        'this host' % (name, vm._name))
+    function = getattr(plugin, name)
+    states = stodgy_tester.helpers.declared_states(function)
+    if skip_if_known and states and vm.has_known_states(states):
+        stodgy_tester.helpers.print_info('Skipping', name, '(already known to hold)')
+        return
+    try:
+        with stodgy_tester.tracing.span('plugin', name):
+            function(vm)
+    except Exception:
+        vm.forget_known_states()
+        raise
+    if states:
+        vm.add_known_states(states)
+    else:
+        vm.forget_known_states()
 
 
 def handle_postconditions(postconditions_list):
@@ -183,39 +364,146 @@ def parse_test_by_filename(filename):
     return parsed_headers, postconditions, cleanups, headers, test_script
 
 
-def run_one_test(filename, box, do_cleanup):
-    parsed_headers, postconditions, cleanups, headers, test_script = parse_test_by_filename(
-        filename)
+# Bump this whenever TestPlan or the step dicts change shape, so stale on-disk plans get ignored.
+PLAN_FORMAT_VERSION = 4
+
+
+class TestPlan(object):
+    '''Everything stodgy-tester needs to know about one *.t file, parsed just once.'''
+    def __init__(self, filename, parsed_headers, postconditions, cleanups, headers, steps):
+        self.filename = filename
+        self.parsed_headers = parsed_headers
+        self.postconditions = postconditions
+        self.cleanups = cleanups
+        self.headers = headers
+        self.steps = steps
+
+    @property
+    def vagrant_box_name(self):
+        return self.parsed_headers['vagrant-box']
+
+    @property
+    def machine_backend(self):
+        return self.parsed_headers.get('machine-backend', 'vagrant')
+
+    @property
+    def machine_name(self):
+        '''Which machine this test runs on: the Vagrant box name, or e.g. "local:jessie".'''
+        if self.machine_backend == 'vagrant':
+            return self.vagrant_box_name
+        return '%s:%s' % (self.machine_backend, self.vagrant_box_name)
+
+    @classmethod
+    def compile(cls, filename):
+        parsed_headers, postconditions, cleanups, headers, test_script = parse_test_by_filename(
+            filename)
+        steps = compile_test_script(test_script, first_lineno=len(headers) + 2)
+        return cls(filename, parsed_headers, postconditions, cleanups, headers, steps)
+
+    def to_json(self):
+        return {
+            'parsed_headers': self.parsed_headers,
+            'postconditions': self.postconditions,
+            'cleanups': self.cleanups,
+            'headers': self.headers,
+            'steps': self.steps,
+        }
+
+    @classmethod
+    def from_json(cls, filename, data):
+        return cls(filename, data['parsed_headers'], data['postconditions'], data['cleanups'],
+                   data['headers'], data['steps'])
+
+
+_test_plans_by_filename = {}
+
+
+def load_test_plan(filename):
+    '''Return the TestPlan for filename, compiling it only if no cached copy is still valid.
+
+    Plans are kept in memory for the rest of the run, and on disk keyed by the file's path, mtime
+    and size, so that listing and sorting a big suite only stat()s each file.'''
+    if filename in _test_plans_by_filename:
+        return _test_plans_by_filename[filename]
+
+    abspath = os.path.abspath(filename)
+    stat = os.stat(filename)
+    cache_filename = os.path.join(
+        stodgy_tester.helpers.state_dir('plans'),
+        hashlib.sha1(abspath.encode('utf-8')).hexdigest() + '.json')
+
+    cached = stodgy_tester.helpers.read_json(cache_filename)
+    if (cached and cached.get('version') == PLAN_FORMAT_VERSION and
+            cached.get('mtime') == stat.st_mtime and cached.get('size') == stat.st_size):
+        plan = TestPlan.from_json(filename, cached['plan'])
+    else:
+        plan = TestPlan.compile(filename)
+        stodgy_tester.helpers.write_json_atomically(cache_filename, {
+            'version': PLAN_FORMAT_VERSION,
+            'path': abspath,
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'plan': plan.to_json(),
+        })
 
+    _test_plans_by_filename[filename] = plan
+    return plan
+
+
+def run_one_test(plan, box, do_cleanup, timing_history=None):
+    with stodgy_tester.tracing.span('test', plan.filename, box=plan.machine_name):
+        try:
+            _run_one_test(plan, box, do_cleanup, timing_history)
+        except Exception:
+            # Who knows what state a failed test left the VM in, or its copy of our files.
+            box.forget_known_states()
+            box.forget_synced_files()
+            raise
+
+
+def _run_one_test(plan, box, do_cleanup, timing_history):
     # Make the VM etc., if necessary.
-    handle_headers(parsed_headers)
-    stodgy_tester.helpers.print_progress("*** Running test from file:", filename)
-    stodgy_tester.helpers.print_info(" -> Extra info:", repr(headers))
+    with stodgy_tester.tracing.span('precondition', 'headers'):
+        handle_headers(plan.parsed_headers, box)
+    stodgy_tester.helpers.print_progress("*** Running test from file:", plan.filename)
+    stodgy_tester.helpers.print_info(" -> Extra info:", repr(plan.headers))
 
-    # Run the test script, using pexpect to track its output.
+    # Run the test script, using pexpect to track its output. It could change anything.
+    box.forget_known_states()
     try:
-        handle_test_script(parsed_headers['vagrant-box'], test_script)
+        with stodgy_tester.tracing.span('script', plan.filename):
+            handle_test_script(box, plan.steps, timing_history=timing_history,
+                               test_filename=plan.filename)
     except Exception as e:
         stodgy_tester.helpers.print_error(str(e))
         raise
         stodgy_tester.helpers.print_warn('Dazed and confused, but trying to continue.')
+    finally:
+        if timing_history is not None:
+            timing_history.save()
 
     # Run any sanity-checks in the test script, as needed.
-    handle_postconditions(postconditions)
+    with stodgy_tester.tracing.span('postcondition', 'postconditions'):
+        handle_postconditions(plan.postconditions)
 
     # If the test knows it needs to do some cleanup, e.g. destroying
     # its VM, then do so.
     if do_cleanup:
-        handle_cleanups(parsed_headers, cleanups, box)
+        with stodgy_tester.tracing.span('cleanup', 'cleanups'):
+            handle_cleanups(plan.parsed_headers, plan.cleanups, box)
     else:
         stodgy_tester.helpers.print_info('Skipping cleanup.')
 
 
 def handle_cleanups(parsed_headers, cleanups, box):
+    if cleanups and not box.isolated:
+        stodgy_tester.helpers.print_warn(
+            '** Skipping cleanup tasks on', box._name, '(they could change this host)')
+        return
     for key, value in cleanups:
         stodgy_tester.helpers.print_info('Doing cleanup task', value)
         try:
-            getattr(plugin, value)(box)
+            run_plugin_function(value, box)
         except Exception as e:
             stodgy_tester.helpers.print_error('Ran into error', str(e))
             raise
@@ -231,6 +519,494 @@ def import_plugin(plugin_name):
         raise
 
 
+def group_testfiles_by_box(testfiles):
+    '''Return a list of (machine_name, [testfile, ...]) pairs, keeping the input order.'''
+    groups = []
+    group_by_box_name = {}
+    for filename in testfiles:
+        box_name = load_test_plan(filename).machine_name
+        if box_name not in group_by_box_name:
+            group_by_box_name[box_name] = []
+            groups.append((box_name, group_by_box_name[box_name]))
+        group_by_box_name[box_name].append(filename)
+    return groups
+
+
+def prioritize_testfiles(testfiles, failure_likelihood, expected_duration):
+    '''Reorder testfiles so the ones most likely to fail run first, and otherwise the longest.
+
+    Each box's tests stay together, so a box still only has to start once. Boxes are ordered by
+    their likeliest failure, then by their total expected duration, so that --jobs and --clones
+    start the longest work first. failure_likelihood and expected_duration are functions of a
+    testfile.'''
+    likelihoods = dict((filename, failure_likelihood(filename)) for filename in testfiles)
+    durations = dict((filename, expected_duration(filename)) for filename in testfiles)
+
+    def test_sort_key(filename):
+        return (-likelihoods[filename], -durations[filename], filename)
+
+    groups = []
+    for box_name, group_testfiles in group_testfiles_by_box(testfiles):
+        group_testfiles = sorted(group_testfiles, key=test_sort_key)
+        groups.append((
+            -likelihoods[group_testfiles[0]],
+            -sum(durations[filename] for filename in group_testfiles),
+            box_name,
+            group_testfiles,
+        ))
+    return [filename for group in sorted(groups) for filename in group[3]]
+
+
+def _child_argv(args, testfiles, release_boxes=False):
+    '''Build the argv for a stodgy-tester child process that runs just these testfiles.
+
+    With release_boxes, the child suspends its boxes before it exits.'''
+    argv = [sys.executable, '-c', 'import stodgy_tester; stodgy_tester.main()']
+    if args.plugin:
+        argv.extend(['--plugin', args.plugin])
+    if args.on_vm_start:
+        argv.extend(['--on-vm-start', args.on_vm_start])
+    if args.rsync:
+        argv.append('--rsync')
+    if not args.do_cleanup:
+        argv.append('--no-do-cleanup')
+    if not args.adaptive_timeouts:
+        argv.append('--no-adaptive-timeouts')
+    if args.libvirt_fast_path:
+        argv.append('--libvirt-fast-path')
+    if args.changed_only:
+        argv.append('--changed-only')
+    if args.prioritize:
+        argv.append('--prioritize')
+    if args.http_proxy:
+        # Children share this process's package cache, if any, rather than starting their own.
+        argv.extend(['--http-proxy', args.http_proxy])
+    if release_boxes:
+        argv.append('--release-boxes')
+    argv.extend(testfiles)
+    return argv
+
+
+def _run_child(args, testfiles, release_boxes=False):
+    '''Run testfiles in a stodgy-tester child process. Returns (passed, output).'''
+    p = subprocess.Popen(_child_argv(args, testfiles, release_boxes), cwd=os.getcwd(),
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
+    return p.returncode == 0, output
+
+
+def prepare_box(args, box, boxes_that_have_been_prepared):
+    '''Run the --on-vm-start hook and --rsync for a box that is about to be tested.'''
+    # Set the proxy first, so that the hook's downloads go through it too.
+    box.set_http_proxy(args.http_proxy)
+    # If we were told to uninstall first, let's do that.
+    if args.on_vm_start and not box.isolated:
+        stodgy_tester.helpers.print_warn(
+            '** Skipping --on-vm-start on', box._name, '(it could change this host)')
+    elif args.on_vm_start:
+        run_plugin_function(args.on_vm_start, box)
+    # Same with rsyncing.
+    if args.rsync:
+        stodgy_tester.helpers.print_info(
+            '** rsync-ing the latest Sandstorm installer etc. to',
+            box._name,
+        )
+        box.rsync()
+        # Indicate that no further prep is needed.
+        boxes_that_have_been_prepared[box._name] = True
+
+
+def _resident_vm_cache(args, state_tracker, evict):
+    '''Return a ResidentVMCache of up to args.max_live_vms boxes, or as many as fit in
+    args.memory_budget_mb if that is 0.
+
+    evict(box, stop) is called with stop being box.suspend or box.stop, per --evict-with.'''
+    evict_with = args.evict_with or ('halt' if args.halt_afterward else 'suspend')
+    return stodgy_tester.helpers.ResidentVMCache(
+        create_vm=lambda machine_name: make_machine(
+            machine_name, state_tracker, libvirt_fast_path=args.libvirt_fast_path),
+        max_live_vms=args.max_live_vms or args.memory_budget_mb // args.vm_memory_mb,
+        evict=lambda box: evict(box, box.stop if evict_with == 'halt' else box.suspend),
+    )
+
+
+def run_testfiles_in_sequence(args, testfiles, fingerprinter=None):
+    '''Run the testfiles one at a time, in order. Returns True if every test passed.
+
+    Up to args.max_live_vms boxes stay running; beyond that, the least recently used box is
+    suspended (or halted). With args.pipeline, the next box in the sequence is resumed (or booted)
+    and prepared in the background while the current box is being tested, and boxes are suspended
+    in the background, too.'''
+    keep_going = True
+
+    boxes_that_have_been_prepared = {}
+
+    timing_history = None
+    if args.adaptive_timeouts:
+        timing_history = _timing_history()
+
+    result_cache = _result_cache()
+    if fingerprinter is None:
+        fingerprinter = _input_fingerprinter(args)
+
+    # Learn the state of every box at once, so each VM knows if it needs to resume or boot. With
+    # the libvirt fast path, each VM asks virsh instead, which is quicker than `vagrant status`.
+    state_tracker = stodgy_tester.helpers.VagrantStateTracker(RUNNER)
+    if not args.libvirt_fast_path and _uses_vagrant(testfiles):
+        try:
+            state_tracker.refresh()
+        except Exception as e:
+            stodgy_tester.helpers.print_warn('** Warning: could not get vagrant status', e)
+
+    lifecycle = None
+    if args.pipeline:
+        lifecycle = stodgy_tester.helpers.BackgroundLifecycle()
+
+    def evict(box, stop):
+        if lifecycle:
+            lifecycle.start(box._name, 'eviction', stop)
+        else:
+            stop()
+
+    resident_vms = _resident_vm_cache(args, state_tracker, evict)
+
+    def prewarm(next_box):
+        next_box.up_or_resume_if_needed()
+        prepare_box(args, next_box, boxes_that_have_been_prepared)
+
+    plans = [load_test_plan(filename) for filename in testfiles]
+    box = None
+    for i, filename in enumerate(testfiles):
+        plan = plans[i]
+        this_machine_name = plan.machine_name
+        if box is None or box._name != this_machine_name:
+            box = resident_vms.use(this_machine_name)
+
+            if lifecycle:
+                if lifecycle.wait(this_machine_name) is not None:
+                    # Prewarming failed, so leave it to run_one_test() and the preparation below.
+                    boxes_that_have_been_prepared.pop(this_machine_name, None)
+                next_names = [later_plan.machine_name for later_plan in plans[i + 1:]
+                              if later_plan.machine_name != this_machine_name]
+                if keep_going and next_names and not resident_vms.is_live(next_names[0]):
+                    next_box = resident_vms.get(next_names[0])
+                    lifecycle.start(next_box._name, 'prewarm', functools.partial(prewarm, next_box))
+
+        if this_machine_name not in boxes_that_have_been_prepared:
+            prepare_box(args, box, boxes_that_have_been_prepared)
+        try:
+            if keep_going:
+                run_one_test(plan, box, args.do_cleanup, timing_history=timing_history)
+                if args.changed_only:
+                    result_cache.record_pass(filename, fingerprinter.key_for(filename))
+        except:
+            keep_going = False
+            result_cache.record_failure(filename)
+            logging.exception("Alas! A test failed!")
+
+    if lifecycle:
+        lifecycle.wait_all()
+
+    if args.release_boxes:
+        # Whoever started us counts our boxes against their memory budget only until we exit.
+        for live_box in resident_vms.live_vms():
+            live_box.suspend()
+
+    return keep_going
+
+
+def run_testfiles_on_clones(args, testfiles, fingerprinter=None):
+    '''Run each box's tests on several linked clones of it at once. Returns True if all passed.
+
+    Each box is brought up and prepared (--on-vm-start, --rsync) once, then shut off to be the
+    read-only base of up to args.clones clones, which share out its tests and are thrown away
+    afterward.'''
+    state = {'keep_going': True}
+    lock = threading.Lock()
+
+    timing_history = None
+    if args.adaptive_timeouts:
+        timing_history = _timing_history()
+    result_cache = _result_cache()
+    if fingerprinter is None:
+        fingerprinter = _input_fingerprinter(args)
+    max_clones = max(1, min(args.clones, args.memory_budget_mb // args.vm_memory_mb))
+
+    for box_name, group_testfiles in group_testfiles_by_box(testfiles):
+        if not state['keep_going']:
+            break
+        if load_test_plan(group_testfiles[0]).machine_backend != 'vagrant':
+            # Only libvirt boxes can be cloned, and other machines are quick to set up anyway.
+            state['keep_going'] = run_testfiles_in_sequence(
+                args, group_testfiles, fingerprinter=fingerprinter)
+            continue
+        base = stodgy_tester.helpers.VirtualMachine(box_name, command_runner=RUNNER)
+        base.up_or_resume_if_needed()
+        prepare_box(args, base, {})
+        factory = stodgy_tester.clones.LinkedCloneFactory(base, RUNNER)
+        factory.prepare()
+        pending = list(group_testfiles)
+
+        def run_tests_on_clone(clone):
+            try:
+                while True:
+                    with lock:
+                        if not pending or not state['keep_going']:
+                            return
+                        filename = pending.pop(0)
+                    try:
+                        run_one_test(load_test_plan(filename), clone, args.do_cleanup,
+                                     timing_history=timing_history)
+                        if args.changed_only:
+                            result_cache.record_pass(filename, fingerprinter.key_for(filename))
+                    except Exception:
+                        state['keep_going'] = False
+                        result_cache.record_failure(filename)
+                        logging.exception("Alas! A test failed!")
+            finally:
+                clone.stop()
+
+        threads = []
+        for i in range(min(max_clones, len(group_testfiles))):
+            clone = factory.create('%s-stodgy-clone-%d-%d' % (box_name, os.getpid(), i))
+            threads.append(threading.Thread(target=run_tests_on_clone, args=(clone,)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return state['keep_going']
+
+
+def halt_boxes_in_parallel(libvirt_fast_path=False):
+    '''Halt every box that is running or suspended, all at the same time.
+
+    With libvirt_fast_path, the boxes are found and shut down without running Vagrant.'''
+    lifecycle = stodgy_tester.helpers.BackgroundLifecycle()
+    if libvirt_fast_path:
+        for name in stodgy_tester.virsh.libvirt_box_names():
+            box = stodgy_tester.virsh.LibvirtVirtualMachine(name, command_runner=RUNNER)
+            lifecycle.start(name, 'halt', box.stop)
+        return not any(lifecycle.wait_all().values())
+
+    state_tracker = stodgy_tester.helpers.VagrantStateTracker(RUNNER)
+    state_tracker.refresh()
+    for name in state_tracker.names():
+        if state_tracker.get(name) in [stodgy_tester.helpers.VagrantStateTracker.NOT_CREATED,
+                                       stodgy_tester.helpers.VagrantStateTracker.POWEROFF]:
+            continue
+        box = stodgy_tester.helpers.VirtualMachine(name, command_runner=RUNNER)
+        lifecycle.start(name, 'halt', box.stop)
+    return not any(lifecycle.wait_all().values())
+
+
+def run_box_groups_in_parallel(args, testfiles):
+    '''Run the tests for each Vagrant box in its own child process, several boxes at a time.
+
+    At most args.jobs children run at once, and a child only starts when its VM fits in the
+    memory budget. Each child's output is buffered and printed in one piece once it finishes, so
+    output from different boxes never interleaves. Returns True if every test passed.
+    '''
+    budget = stodgy_tester.helpers.MemoryBudget(args.memory_budget_mb)
+    groups = group_testfiles_by_box(testfiles)
+    print_lock = threading.Lock()
+    state = {'keep_going': True}
+
+    def run_group(box_name, group_testfiles):
+        budget.acquire(args.vm_memory_mb)
+        try:
+            if not state['keep_going']:
+                return
+            # The child suspends its box before exiting, so the budget covers running VMs.
+            passed, output = _run_child(args, group_testfiles, release_boxes=True)
+        finally:
+            budget.release(args.vm_memory_mb)
+
+        with print_lock:
+            stodgy_tester.helpers.print_progress('*** Output of tests for', box_name)
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if not passed:
+                state['keep_going'] = False
+                stodgy_tester.helpers.print_error('Alas! A test failed on', box_name)
+
+    pending = list(groups)
+    pending_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with pending_lock:
+                if not pending:
+                    return
+                box_name, group_testfiles = pending.pop(0)
+            run_group(box_name, group_testfiles)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(args.jobs, len(groups)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return state['keep_going']
+
+
+def _result_cache():
+    return stodgy_tester.helpers.ResultCache(
+        os.path.join(stodgy_tester.helpers.state_dir(), 'results.json'))
+
+
+def _uses_vagrant(testfiles):
+    return any(load_test_plan(filename).machine_backend == 'vagrant' for filename in testfiles)
+
+
+def _input_fingerprinter(args):
+    # Nothing is hashed or listed until the first key_for(), which is why only --changed-only and
+    # --prioritize ask for keys: the first one for a Vagrant test costs a `vagrant box list`.
+    return stodgy_tester.helpers.InputFingerprinter(
+        RUNNER,
+        plugin_filename=getattr(plugin, '__file__', None),
+        synced_root=os.getcwd() if args.rsync else None,
+        uses_vagrant=lambda filename: _uses_vagrant([filename]))
+
+
+def skip_unchanged_testfiles(testfiles, fingerprinter):
+    '''Return just the testfiles whose inputs changed since they last passed.'''
+    result_cache = _result_cache()
+    changed = []
+    for filename in testfiles:
+        if result_cache.passed_with(filename, fingerprinter.key_for(filename)):
+            stodgy_tester.helpers.print_info('Skipping', filename, '(unchanged since it passed)')
+        else:
+            changed.append(filename)
+    return changed
+
+
+def _timing_history():
+    return stodgy_tester.helpers.TimingHistory(
+        os.path.join(stodgy_tester.helpers.state_dir(), 'timings.json'))
+
+
+def _test_history(args, fingerprinter):
+    return stodgy_tester.helpers.TestHistory(
+        os.path.join(stodgy_tester.helpers.state_dir(), 'test-history.json'),
+        input_key_for=fingerprinter.key_for if args.prioritize else None)
+
+
+def prioritize_testfiles_by_history(testfiles, test_history, fingerprinter):
+    '''Run the tests most likely to fail first, based on their history, then the longest.'''
+    timing_history = _timing_history()
+
+    def failure_likelihood(filename):
+        return test_history.failure_likelihood(filename, fingerprinter.key_for(filename))
+
+    def expected_duration(filename):
+        return test_history.expected_duration(
+            filename, default=timing_history.expected_test_duration(filename))
+
+    return prioritize_testfiles(testfiles, failure_likelihood, expected_duration)
+
+
+def run_coordinator(args, testfiles, test_history):
+    '''Hand the testfiles out to --worker processes, longest expected work first.
+
+    The workers report how long each test took, which goes into test_history, so the next run's
+    expected durations come from it even if this host never runs a test itself.
+
+    Returns True if every test passed.'''
+    timing_history = _timing_history()
+
+    def expected_duration(filename):
+        return test_history.expected_duration(
+            filename, default=timing_history.expected_test_duration(filename))
+
+    def record_result(filename, passed, seconds):
+        test_history.record(filename, passed, seconds)
+        test_history.save()
+
+    work_queue = stodgy_tester.distributed.WorkQueue(
+        group_testfiles_by_box(testfiles), expected_duration=expected_duration)
+    coordinator = stodgy_tester.distributed.Coordinator(
+        args.coordinator, work_queue, worker_timeout=args.worker_timeout,
+        record_result=record_result)
+    return coordinator.serve_until_done()
+
+
+@contextlib.contextmanager
+def _output_captured_to(log_file):
+    '''Send stdout and stderr, including that of child processes, to log_file instead.'''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    os.dup2(log_file.fileno(), 1)
+    os.dup2(log_file.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in zip([1, 2], saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+
+def run_worker(args):
+    '''Run testfiles from a --coordinator until it runs out. Returns True if they all passed.
+
+    The tests run in this process, so however many leases of a box's tests the coordinator hands
+    this worker, the box is looked up, brought up and prepared (--on-vm-start, --rsync) once.
+    As in run_testfiles_in_sequence(), up to args.max_live_vms boxes stay running, so a worker
+    that is handed a stolen share of another box's tests and then goes back to its own box
+    finds both still warm.'''
+    timing_history = None
+    if args.adaptive_timeouts:
+        timing_history = _timing_history()
+    result_cache = _result_cache()
+    fingerprinter = _input_fingerprinter(args)
+    state_tracker = stodgy_tester.helpers.VagrantStateTracker(RUNNER)
+    resident_vms = _resident_vm_cache(args, state_tracker, lambda box, stop: stop())
+    boxes_that_have_been_prepared = {}
+    state = {'all_passed': True, 'refreshed_states': args.libvirt_fast_path}
+
+    def get_box(plan):
+        if plan.machine_backend == 'vagrant' and not state['refreshed_states']:
+            state['refreshed_states'] = True
+            try:
+                state_tracker.refresh()
+            except Exception as e:
+                stodgy_tester.helpers.print_warn('** Warning: could not get vagrant status', e)
+        return resident_vms.use(plan.machine_name)
+
+    def run_testfile(filename):
+        log_file = tempfile.TemporaryFile()
+        started = None
+        with _output_captured_to(log_file):
+            try:
+                plan = load_test_plan(filename)
+                box = get_box(plan)
+                if plan.machine_name not in boxes_that_have_been_prepared:
+                    prepare_box(args, box, boxes_that_have_been_prepared)
+                started = stodgy_tester.tracing.clock()
+                run_one_test(plan, box, args.do_cleanup, timing_history=timing_history)
+                if args.changed_only:
+                    result_cache.record_pass(filename, fingerprinter.key_for(filename))
+                passed = True
+            except Exception:
+                passed = False
+                state['all_passed'] = False
+                result_cache.record_failure(filename)
+                logging.exception("Alas! A test failed!")
+        # Like the test span, this leaves out bringing up and preparing the box.
+        seconds = stodgy_tester.tracing.clock() - started if started is not None else None
+        log_file.seek(0)
+        log = log_file.read().decode('utf-8', 'replace')
+        log_file.close()
+        return passed, log, seconds
+
+    stodgy_tester.distributed.run_worker(
+        args.worker, run_testfile, connect_timeout=args.worker_timeout)
+    return state['all_passed']
+
+
 def main():
     parser = argparse.ArgumentParser(description='Run automated tests with the help of Vagrant.')
     parser.add_argument("--plugin", type=str,
@@ -248,6 +1024,50 @@ def main():
         help='After running the tests, stop the VMs.',
         action='store_true',
     )
+    parser.add_argument(
+        '--max-live-vms', type=int, default=1, dest='max_live_vms',
+        help='Keep up to this many recently used VMs running, instead of suspending each box as '
+        'soon as the tests move on to another one. 0 means as many as fit in '
+        '--memory-budget-mb. (default: 1)',
+    )
+    parser.add_argument(
+        '--evict-with', choices=['suspend', 'halt'], dest='evict_with',
+        help='How to stop a VM beyond --max-live-vms (default: halt with --halt-afterward, '
+        'otherwise suspend).',
+    )
+    parser.add_argument(
+        '--clones', type=int, default=1,
+        help='Run each box\'s tests on up to this many throwaway linked clones of it at once '
+        '(libvirt only; also limited by --memory-budget-mb). The box itself is shut off while '
+        'its clones exist.',
+    )
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='While one box is being tested, resume and prepare the next one and suspend the '
+        'previous one in the background; with --halt-afterward, halt the boxes in parallel. '
+        'This briefly keeps up to three VMs in RAM.',
+    )
+    parser.add_argument(
+        '--libvirt-fast-path', action='store_true', dest='libvirt_fast_path',
+        help='Suspend, resume, check and shut down libvirt boxes with virsh, instead of waiting '
+        'for Vagrant to start up each time. Vagrant still creates, boots and destroys them.',
+    )
+    parser.add_argument(
+        '--prioritize', action='store_true',
+        help='Instead of running each box\'s tests in filename order, run the tests that are '
+        'most likely to fail first (those that failed recently, or changed since they last ran), '
+        'then the longest. Each box\'s tests still run together.',
+    )
+    parser.add_argument(
+        '--trace-file', dest='trace_file', metavar='FILENAME',
+        help='Write a Chrome trace (for chrome://tracing or ui.perfetto.dev) of where the time '
+        'went in this process: VM lifecycle, Vagrant and SSH commands, waits for output, and '
+        'each test phase.',
+    )
+    parser.add_argument(
+        '--timing-report', dest='timing_report', metavar='FILENAME',
+        help='Write a JSON report of how many seconds each test spent in each phase.',
+    )
     parser.add_argument(
         'testfiles',
         metavar='testfile',
@@ -255,6 +1075,75 @@ def main():
         help='A *.t file to run (multiple is OK; empty testfile sequence means run all)',
         default=[],
     )
+    parser.add_argument(
+        '--changed-only', action='store_true', dest='changed_only',
+        help='Skip tests that passed before with the same test file, plugin, rsync-ed files, '
+        'and Vagrant box versions.',
+    )
+    parser.add_argument(
+        '--list', action='store_true',
+        help='Print each testfile with its Vagrant box and title, in run order, then exit.',
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='Run the tests for up to this many different Vagrant boxes at the same time.',
+    )
+    # Set for --jobs children, which must not leave their box running when they exit.
+    parser.add_argument('--release-boxes', action='store_true', dest='release_boxes',
+                        help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--memory-budget-mb', type=int, dest='memory_budget_mb',
+        default=stodgy_tester.helpers.host_memory_mb() * 3 // 4,
+        help='With --jobs, only start another VM while the VMs fit in this much RAM '
+        '(default: 3/4 of host RAM).',
+    )
+    parser.add_argument(
+        '--vm-memory-mb', type=int, dest='vm_memory_mb', default=1024,
+        help='How much RAM to assume each VM uses, for --memory-budget-mb.',
+    )
+    distributed_parser = parser.add_mutually_exclusive_group(required=False)
+    distributed_parser.add_argument(
+        '--coordinator', metavar='ADDRESS',
+        help='Serve the testfiles to --worker processes at ADDRESS (host:port or unix:/path), '
+        'instead of running them here.',
+    )
+    distributed_parser.add_argument(
+        '--worker', metavar='ADDRESS',
+        help='Run testfiles handed out by the --coordinator at ADDRESS, until there are none left.',
+    )
+    parser.add_argument(
+        '--worker-timeout', type=float, dest='worker_timeout', default=600,
+        help='How many seconds a --coordinator waits with no --worker connected, and a --worker '
+        'waits for its --coordinator to start, before giving up (default: 600).',
+    )
+    http_proxy_parser = parser.add_mutually_exclusive_group(required=False)
+    http_proxy_parser.add_argument(
+        '--package-cache', action='store_true', dest='package_cache',
+        help='Serve a caching HTTP proxy on this host while the tests run, point the package '
+        'manager (apt, yum or dnf) of each VM at it, and print its hit and miss counts at the end. '
+        'Package files are cached in the state directory, so later runs can use them too.',
+    )
+    http_proxy_parser.add_argument(
+        '--http-proxy', metavar='URL', dest='http_proxy',
+        help='Point the package manager of each VM at this HTTP proxy, e.g. an apt-cacher-ng.',
+    )
+    parser.add_argument(
+        '--package-cache-host', dest='package_cache_host', default='192.168.121.1',
+        help='The address of this host as the VMs see it, for --package-cache, which only listens '
+        'there (default: the host side of vagrant-libvirt\'s management network).',
+    )
+    parser.add_argument(
+        '--package-cache-port', type=int, dest='package_cache_port', default=3142,
+        help='The port for --package-cache to listen on.',
+    )
+    adaptive_timeouts_parser = parser.add_mutually_exclusive_group(required=False)
+    adaptive_timeouts_parser.add_argument(
+        '--adaptive-timeouts', dest='adaptive_timeouts', action='store_true',
+        help='Base each line\'s timeout on how long it took on earlier runs (true by default)')
+    adaptive_timeouts_parser.add_argument(
+        '--no-adaptive-timeouts', dest='adaptive_timeouts', action='store_false',
+        help='Only use the fixed timeouts, and $[slow] and $[veryslow]')
+    adaptive_timeouts_parser.set_defaults(adaptive_timeouts=True)
     do_cleanup_parser = parser.add_mutually_exclusive_group(required=False)
     do_cleanup_parser.add_argument(
         '--do-cleanup', dest='do_cleanup', action='store_true',
@@ -266,7 +1155,8 @@ def main():
     args = parser.parse_args()
     # HACK
     global plugin
-    plugin = import_plugin(args.plugin)
+    if args.plugin:
+        plugin = import_plugin(args.plugin)
 
     testfiles = args.testfiles
     if not testfiles:
@@ -274,62 +1164,72 @@ def main():
 
     # Sort testfiles by the Vagrant box they use. That way, we can minimize
     # up/resume/suspend churn.
-    testfiles = sorted(testfiles,
-                       key=lambda filename: parse_test_by_filename(filename)[0]['vagrant-box'])
-
-    keep_going = True
-
-    boxes_by_name = {}
-    boxes_that_have_been_prepared = {}
-
-    box = None
-    for filename in testfiles:
-        this_vagrant_box_name = parse_test_by_filename(filename)[0]['vagrant-box']
-        if this_vagrant_box_name not in boxes_by_name:
-            # If this Vagrant box is not yet in boxes_by_name, then we should stop the previous one
-            # to conserve RAM.
-            if box:
-                if args.halt_afterward:
-                    box.stop()
-                else:
-                    box.suspend()
-
-            box = stodgy_tester.helpers.VirtualMachine(
-                name=this_vagrant_box_name,
-                command_runner=RUNNER,
-            )
-            boxes_by_name[this_vagrant_box_name] = box
-        else:
-            box = boxes_by_name[this_vagrant_box_name]
-
-        if this_vagrant_box_name not in boxes_that_have_been_prepared:
-            # If we were told to uninstall first, let's do that.
-            if args.on_vm_start:
-                getattr(plugin, args.on_vm_start)(box)
-            # Same with rsyncing.
-            if args.rsync:
-                stodgy_tester.helpers.print_info(
-                    '** rsync-ing the latest Sandstorm installer etc. to',
-                    this_vagrant_box_name,
-                )
-                box.rsync()
-                # Indicate that no further prep is needed.
-                boxes_that_have_been_prepared[this_vagrant_box_name] = True
-        try:
-            if keep_going:
-                run_one_test(filename, box, args.do_cleanup)
-        except:
-            keep_going = False
-            logging.exception("Alas! A test failed!")
+    testfiles = sorted(testfiles, key=lambda filename: load_test_plan(filename).machine_name)
+
+    # One fingerprinter, so the shared inputs are only hashed (and the boxes listed) once.
+    fingerprinter = _input_fingerprinter(args)
+    if args.changed_only:
+        testfiles = skip_unchanged_testfiles(testfiles, fingerprinter)
+
+    test_history = _test_history(args, fingerprinter)
+    if args.prioritize:
+        testfiles = prioritize_testfiles_by_history(testfiles, test_history, fingerprinter)
+
+    if args.list:
+        for filename in testfiles:
+            plan = load_test_plan(filename)
+            print(filename, plan.machine_name, plan.parsed_headers.get('title', ''), sep='\t')
+        sys.exit(0)
+
+    chrome_trace = None
+    if args.trace_file:
+        chrome_trace = stodgy_tester.tracing.ChromeTrace()
+        stodgy_tester.tracing.add_listener(chrome_trace)
+    timing_report = None
+    if args.timing_report:
+        timing_report = stodgy_tester.tracing.TimingReport()
+        stodgy_tester.tracing.add_listener(timing_report)
+    stodgy_tester.tracing.add_listener(test_history)
+
+    package_cache = None
+    if args.package_cache:
+        package_cache = stodgy_tester.package_cache.PackageCache(
+            stodgy_tester.helpers.state_dir('package-cache'), args.package_cache_host,
+            port=args.package_cache_port)
+        args.http_proxy = 'http://%s:%d' % (args.package_cache_host, package_cache.start())
+        stodgy_tester.helpers.print_info('** Caching package downloads at', args.http_proxy)
+
+    if args.coordinator:
+        keep_going = run_coordinator(args, testfiles, test_history)
+    elif args.worker:
+        keep_going = run_worker(args)
+    elif args.clones > 1:
+        keep_going = run_testfiles_on_clones(args, testfiles, fingerprinter=fingerprinter)
+    elif args.jobs > 1:
+        keep_going = run_box_groups_in_parallel(args, testfiles)
+    else:
+        keep_going = run_testfiles_in_sequence(args, testfiles, fingerprinter=fingerprinter)
 
     # If we need to stop the VMs, now's a good time to stop
     # them.
-    if args.halt_afterward:
+    halt_afterward = args.halt_afterward and (args.worker or _uses_vagrant(testfiles))
+    if halt_afterward and (args.pipeline or args.libvirt_fast_path):
+        if not halt_boxes_in_parallel(libvirt_fast_path=args.libvirt_fast_path):
+            keep_going = False
+    elif halt_afterward:
         subprocess.check_output(
             ['vagrant', 'halt'],
             cwd=os.getcwd(),
         )
 
+    if package_cache:
+        package_cache.stop()
+        stodgy_tester.helpers.print_info('** Package cache:', package_cache.summary())
+    if chrome_trace:
+        chrome_trace.write(args.trace_file)
+    if timing_report:
+        timing_report.write(args.timing_report)
+
     if not keep_going:
         sys.exit(1)
 
@@ -0,0 +1,200 @@
+'''Linked clones of libvirt boxes.
+
+A linked clone is a transient libvirt domain whose disk is a qcow2 overlay backed by the base box's
+disk. The clone only writes to its overlay, so making one takes a moment and little disk space, and
+throwing it away is just deleting the overlay. The base disk must not change while it has clones,
+so the base box stays shut off until they are gone.
+'''
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+)
+import re
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+import stodgy_tester.helpers
+import stodgy_tester.virsh
+
+
+def _first_disk(domain):
+    for disk in domain.findall('devices/disk'):
+        if disk.get('device', 'disk') == 'disk':
+            return disk
+    raise Exception('The domain has no disk to clone')
+
+
+def base_disk_path(domain_xml):
+    '''Return the path of the (first) disk in `virsh dumpxml` output.'''
+    domain = ElementTree.fromstring(domain_xml.encode('utf-8'))
+    return _first_disk(domain).find('source').get('file')
+
+
+def clone_domain_xml(domain_xml, clone_name, overlay_path):
+    '''Turn `virsh dumpxml` output for a base box into the XML for a linked clone of it.'''
+    domain = ElementTree.fromstring(domain_xml.encode('utf-8'))
+    domain.find('name').text = clone_name
+    uuid = domain.find('uuid')
+    if uuid is not None:
+        domain.remove(uuid)
+    # Let libvirt make up new MAC addresses, so each clone gets its own DHCP lease.
+    for interface in domain.findall('devices/interface'):
+        mac = interface.find('mac')
+        if mac is not None:
+            interface.remove(mac)
+    disk = _first_disk(domain)
+    disk.set('type', 'file')
+    if disk.find('driver') is not None:
+        disk.find('driver').set('type', 'qcow2')
+    disk.find('source').attrib.clear()
+    disk.find('source').set('file', overlay_path)
+    backing_store = disk.find('backingStore')
+    if backing_store is not None:
+        disk.remove(backing_store)
+    return ElementTree.tostring(domain).decode('utf-8')
+
+
+def clone_ssh_config(base_ssh_config, base_name, clone_name, address):
+    '''Rewrite the base box's `vagrant ssh-config` output to reach a clone at address instead.'''
+    lines = []
+    for line in base_ssh_config.splitlines():
+        stripped = line.strip()
+        if stripped == 'Host ' + base_name:
+            line = 'Host ' + clone_name
+        elif stripped.startswith('HostName '):
+            line = line[:line.index('HostName ')] + 'HostName ' + address
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+class LinkedCloneFactory(object):
+    '''Make and throw away linked clones of one box.'''
+    # How long a fresh clone gets to come up on the network and start sshd.
+    BOOT_TIMEOUT = 180
+
+    def __init__(self, base_vm, command_runner):
+        self._base_vm = base_vm
+        self._command_runner = command_runner
+        self._base_ssh_config = None
+        self._domain_xml = None
+        self._base_disk = None
+        self._pool = None
+        self._capacity = None
+
+    def prepare(self):
+        '''Shut the base box off, and learn what making a clone of it needs.
+
+        The base box must be up, and already have had any --on-vm-start hook and rsync.'''
+        # The clones' sshd is the base box's, so they take the same keys and user.
+        self._base_ssh_config = self._base_vm._fetch_ssh_config()
+        domain = self._base_vm._machine_id()
+        if domain is None:
+            raise Exception('%s has not been created by Vagrant' % (self._base_vm._name,))
+        self._base_vm.stop()
+        self._domain_xml = self._virsh('dumpxml', '--inactive', domain)
+        self._base_disk = base_disk_path(self._domain_xml)
+        self._pool = self._virsh('vol-pool', self._base_disk).strip()
+        vol_info = self._virsh('vol-info', '--bytes', self._base_disk)
+        self._capacity = re.search(r'Capacity:\s+(\d+)', vol_info).group(1)
+
+    def _virsh(self, *argv):
+        return self._command_runner(stodgy_tester.virsh.VIRSH + list(argv))
+
+    def create(self, clone_name):
+        return LinkedClone(self, clone_name, self._command_runner)
+
+    def ssh_config_for(self, clone_name, address):
+        return clone_ssh_config(self._base_ssh_config, self._base_vm._name, clone_name, address)
+
+    def _overlay_name(self, clone_name):
+        return clone_name + '.qcow2'
+
+    def start_clone(self, clone_name):
+        '''Create the overlay and domain for a clone, boot it, and return its IP address.'''
+        self._virsh(
+            'vol-create-as', self._pool, self._overlay_name(clone_name), self._capacity,
+            '--format', 'qcow2',
+            '--backing-vol', self._base_disk, '--backing-vol-format', 'qcow2')
+        try:
+            overlay_path = self._virsh(
+                'vol-path', '--pool', self._pool, self._overlay_name(clone_name)).strip()
+            with tempfile.NamedTemporaryFile(suffix='.xml') as xml_file:
+                xml_file.write(clone_domain_xml(
+                    self._domain_xml, clone_name, overlay_path).encode('utf-8'))
+                xml_file.flush()
+                # A transient domain, which libvirt forgets as soon as it is destroyed.
+                self._virsh('create', xml_file.name)
+
+            deadline = time.time() + self.BOOT_TIMEOUT
+            while True:
+                output = self._virsh('domifaddr', clone_name)
+                match = re.search(r'ipv4\s+([0-9.]+)/', output)
+                if match:
+                    return match.group(1)
+                if time.time() > deadline:
+                    raise Exception('%s did not get an IP address' % (clone_name,))
+                time.sleep(1)
+        except Exception:
+            self.discard_clone(clone_name)
+            raise
+
+    def discard_clone(self, clone_name):
+        '''Throw a clone and its overlay away. It is fine if either is already gone.'''
+        for argv in [['destroy', clone_name],
+                     ['vol-delete', '--pool', self._pool, self._overlay_name(clone_name)]]:
+            try:
+                self._virsh(*argv)
+            except Exception as e:
+                stodgy_tester.helpers.print_warn('** Warning: could not clean up', clone_name, e)
+
+
+class LinkedClone(stodgy_tester.helpers.VirtualMachine):
+    '''A throwaway linked clone, which can stand in for its base box's VirtualMachine.
+
+    Stopping, suspending, destroying or resetting a clone throws its changes away; the next
+    command boots a fresh clone from the untouched base disk.'''
+    def __init__(self, factory, name, command_runner):
+        super(LinkedClone, self).__init__(name, command_runner)
+        self._factory = factory
+        self._address = None
+
+    @stodgy_tester.helpers._traced_vm_operation
+    def _up_or_resume(self):
+        self._address = self._factory.start_clone(self._name)
+        deadline = time.time() + self._factory.BOOT_TIMEOUT
+        while True:
+            try:
+                self._command_runner(self.ssh_argv('true'))
+                break
+            except Exception:
+                if time.time() > deadline:
+                    raise
+                time.sleep(1)
+        self._cached_box_seems_up = True
+
+    def _fetch_ssh_config(self):
+        return self._factory.ssh_config_for(self._name, self._address)
+
+    @stodgy_tester.helpers._traced_vm_operation
+    def stop(self):
+        self._close_ssh_connection(forget_config=True)
+        self.forget_known_states()
+        if self._address is not None:
+            self._factory.discard_clone(self._name)
+            self._address = None
+        self._cached_box_seems_up = False
+
+    def suspend(self):
+        self.stop()
+
+    def destroy_then_start(self):
+        self.stop()
+        return self.up_or_resume_if_needed()
+
+    def reset_to_baseline(self):
+        self.destroy_then_start()
+
+    def rsync(self):
+        # The base box was rsync-ed before it was cloned.
+        self.up_or_resume_if_needed()
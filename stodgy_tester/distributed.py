@@ -0,0 +1,270 @@
+# This file lets one stodgy-tester coordinator hand out testfiles to workers on several hosts, so a
+# suite can use more libvirt capacity than one machine has.
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+)
+import json
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import stodgy_tester.helpers
+
+
+def parse_address(address):
+    '''Turn "host:port" into a TCP address, or "unix:/path" into a Unix socket path.
+
+    Returns (socket_family, address).'''
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+class WorkQueue(object):
+    '''Hand out testfiles to workers, one Vagrant box's worth at a time.
+
+    A worker keeps getting testfiles for the same box, so its VM stays warm. When it runs out, it
+    gets the box with the most expected work left; if every box has been handed out, it steals the
+    later half (rounded up) of the remaining testfiles from whichever worker has the most expected
+    work.
+    '''
+    def __init__(self, groups, expected_duration):
+        '''groups is a list of (vagrant_box_name, [testfile, ...]), and expected_duration is a
+        function that guesses how many seconds a testfile takes.'''
+        self._expected_duration = expected_duration
+        self._pending_units = sorted(
+            [[box_name, list(testfiles)] for box_name, testfiles in groups],
+            key=lambda unit: -self._unit_duration(unit))
+        self._units_by_worker = {}
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def _unit_duration(self, unit):
+        return sum(self._expected_duration(testfile) for testfile in unit[1])
+
+    def next_testfile(self, worker_id):
+        '''Return (vagrant_box_name, testfile) for a worker to run next, or None if there is no
+        more work for it.'''
+        with self._lock:
+            if self._stopped:
+                return None
+            unit = self._units_by_worker.get(worker_id)
+            if not unit or not unit[1]:
+                unit = self._take_unit(worker_id)
+                if unit is None:
+                    return None
+            return unit[0], unit[1].pop(0)
+
+    def _take_unit(self, worker_id):
+        if self._pending_units:
+            unit = self._pending_units.pop(0)
+        else:
+            victims = [other_unit for other_worker_id, other_unit in self._units_by_worker.items()
+                       if other_worker_id != worker_id and other_unit[1]]
+            if not victims:
+                self._units_by_worker.pop(worker_id, None)
+                return None
+            victim = max(victims, key=self._unit_duration)
+            keep = len(victim[1]) // 2
+            unit = [victim[0], victim[1][keep:]]
+            del victim[1][keep:]
+        self._units_by_worker[worker_id] = unit
+        return unit
+
+    def is_empty(self):
+        with self._lock:
+            return self._stopped or not (
+                self._pending_units or any(unit[1] for unit in self._units_by_worker.values()))
+
+    def stop(self):
+        '''Stop handing out work, e.g. because a test failed.'''
+        with self._lock:
+            self._stopped = True
+
+
+class Coordinator(object):
+    '''Serve a WorkQueue to workers, and collect their results and logs.
+
+    If no worker is connected for worker_timeout seconds while there is work left, the
+    coordinator gives up, and the run counts as failed.
+
+    Workers keep their timings on their own hosts, so each result says how long the test took;
+    if given, record_result(testfile, passed, seconds) is called with it, e.g. to save it to a
+    TestHistory that later runs' WorkQueues can take expected durations from.'''
+    def __init__(self, address, work_queue, keep_going_after_failure=False, worker_timeout=600,
+                 record_result=None):
+        self._address = address
+        self._work_queue = work_queue
+        self._keep_going_after_failure = keep_going_after_failure
+        self._worker_timeout = worker_timeout
+        self._record_result_callback = record_result
+        self._outstanding = {}
+        self._all_passed = True
+        self._connected_workers = 0
+        self._idle_since = time.time()
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _handle_request(self, request):
+        worker_id = request['worker']
+        if request['op'] == 'next':
+            item = self._work_queue.next_testfile(worker_id)
+            if item is None:
+                self._shut_down_if_done()
+                return {'done': True}
+            with self._lock:
+                self._outstanding[worker_id] = item[1]
+            return {'box': item[0], 'testfile': item[1]}
+        if request['op'] == 'result':
+            self._record_result(worker_id, request['testfile'], request['ok'], request['log'],
+                                request.get('seconds'))
+            return {}
+        raise ValueError('Unknown request %r' % (request,))
+
+    def _record_result(self, worker_id, testfile, ok, log, seconds=None):
+        with self._lock:
+            self._outstanding.pop(worker_id, None)
+            stodgy_tester.helpers.print_progress('*** Output of', testfile, 'from', worker_id)
+            sys.stdout.write(log.encode('utf-8'))
+            sys.stdout.flush()
+            if not ok:
+                self._all_passed = False
+                stodgy_tester.helpers.print_error('Alas! A test failed:', testfile)
+        # A worker that disconnected can't say how long the test took.
+        if seconds is not None and self._record_result_callback is not None:
+            self._record_result_callback(testfile, ok, seconds)
+        if not ok and not self._keep_going_after_failure:
+            self._work_queue.stop()
+
+    def _worker_connected(self):
+        with self._lock:
+            self._connected_workers += 1
+            self._idle_since = None
+
+    def _worker_disconnected(self, worker_id):
+        with self._lock:
+            self._connected_workers -= 1
+            if not self._connected_workers:
+                self._idle_since = time.time()
+            testfile = self._outstanding.get(worker_id)
+        if testfile is not None:
+            self._record_result(worker_id, testfile, False,
+                                'Worker disconnected before reporting a result.\n')
+        self._shut_down_if_done()
+
+    def _shut_down_if_done(self):
+        with self._lock:
+            done = self._work_queue.is_empty() and not self._outstanding
+        if done:
+            # shutdown() waits for serve_forever() to return, so it can't run on a handler thread.
+            threading.Thread(target=self._server.shutdown).start()
+
+    def _give_up_without_workers(self, finished):
+        while not finished.wait(1):
+            with self._lock:
+                idle_since = self._idle_since
+            if idle_since is not None and time.time() - idle_since > self._worker_timeout:
+                stodgy_tester.helpers.print_error(
+                    '** No worker connected for %d seconds; giving up' % (self._worker_timeout,))
+                with self._lock:
+                    self._all_passed = False
+                self._work_queue.stop()
+                self._server.shutdown()
+                return
+
+    def serve_until_done(self):
+        '''Serve work until every testfile has a result. Returns True if they all passed.'''
+        if self._work_queue.is_empty():
+            stodgy_tester.helpers.print_info('** No testfiles to hand out')
+            return self._all_passed
+        coordinator = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                worker_id = None
+                coordinator._worker_connected()
+                try:
+                    while True:
+                        line = self.rfile.readline()
+                        if not line:
+                            break
+                        request = json.loads(line)
+                        worker_id = request['worker']
+                        response = coordinator._handle_request(request)
+                        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                        self.wfile.flush()
+                finally:
+                    coordinator._worker_disconnected(worker_id)
+
+        family, address = parse_address(self._address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)
+            server_class = SocketServer.ThreadingUnixStreamServer
+        else:
+            server_class = SocketServer.ThreadingTCPServer
+            server_class.allow_reuse_address = True
+        server_class.daemon_threads = True
+        self._server = server_class(address, Handler)
+        stodgy_tester.helpers.print_info('** Coordinator waiting for workers on', self._address)
+        finished = threading.Event()
+        watchdog = threading.Thread(target=self._give_up_without_workers, args=(finished,))
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            finished.set()
+            self._server.server_close()
+        return self._all_passed
+
+
+def _connect(address, timeout):
+    '''Connect to a coordinator, retrying until timeout in case it hasn't started yet.'''
+    family, address = parse_address(address)
+    deadline = time.time() + timeout
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            return sock
+        except socket.error:
+            sock.close()
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+
+
+def run_worker(address, run_testfile, worker_id=None, connect_timeout=600):
+    '''Pull testfiles from a coordinator until it runs out, and report back on each.
+
+    run_testfile(testfile) must return (passed, log_text, seconds_the_test_took).'''
+    if worker_id is None:
+        worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+    sock = _connect(address, connect_timeout)
+    f = sock.makefile('rwb')
+
+    def call(request):
+        request['worker'] = worker_id
+        f.write(json.dumps(request).encode('utf-8') + b'\n')
+        f.flush()
+        return json.loads(f.readline())
+
+    try:
+        while True:
+            work = call({'op': 'next'})
+            if work.get('done'):
+                return
+            stodgy_tester.helpers.print_progress(
+                '** Worker', worker_id, 'running', work['testfile'], 'on', work['box'])
+            passed, log, seconds = run_testfile(work['testfile'])
+            call({'op': 'result', 'testfile': work['testfile'], 'ok': passed, 'log': log,
+                  'seconds': seconds})
+    finally:
+        f.close()
+        sock.close()
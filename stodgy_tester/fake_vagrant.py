@@ -0,0 +1,313 @@
+'''A stand-in for the `vagrant`, `ssh` and `virsh` commands, for testing and benchmarking
+stodgy-tester.
+
+Each "VM" is a directory on this host, and running a command "inside" it just runs bash with that
+directory as $HOME. That is enough to exercise everything stodgy-tester does around its VMs, in
+milliseconds and without libvirt. Like vagrant-libvirt, `vagrant up` writes each VM's domain ID
+to .vagrant/machines/NAME/libvirt/id, and `virsh` can check, pause, resume and shut down that
+domain.
+
+To use it, install the wrapper scripts into a directory and put it at the front of $PATH:
+
+    python -m stodgy_tester.fake_vagrant install /tmp/fake-bin
+
+It is configured with environment variables:
+
+- STODGY_FAKE_VAGRANT_ROOT: where the VM directories live (required).
+
+- STODGY_FAKE_VAGRANT_BOXES: comma-separated box names that the "Vagrantfile" defines. Any other
+  name is rejected. If unset, any name is accepted.
+
+Every invocation appends a line to $STODGY_FAKE_VAGRANT_ROOT/invocations.log, so callers can
+count how many processes stodgy-tester spawned.
+'''
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+)
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+NOT_CREATED = 'not_created'
+POWEROFF = 'shutoff'
+SAVED = 'paused'
+RUNNING = 'running'
+
+WRAPPER_TEMPLATE = '''#!/bin/sh
+export PYTHONPATH=%(package_parent)s${PYTHONPATH:+:$PYTHONPATH}
+exec %(python)s -m stodgy_tester.fake_vagrant %(command)s "$@"
+'''
+
+
+def install(bin_dir, commands=('vagrant', 'ssh', 'virsh')):
+    '''Write `vagrant`, `ssh` and `virsh` wrapper scripts into bin_dir.'''
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for command in commands:
+        filename = os.path.join(bin_dir, command)
+        with open(filename, 'w') as f:
+            f.write(WRAPPER_TEMPLATE % {
+                'package_parent': package_parent,
+                'python': sys.executable,
+                'command': command,
+            })
+        os.chmod(filename, 0o755)
+
+
+def _root():
+    return os.environ['STODGY_FAKE_VAGRANT_ROOT']
+
+
+def _box_names():
+    names = os.environ.get('STODGY_FAKE_VAGRANT_BOXES')
+    if names:
+        return names.split(',')
+    machines_dir = os.path.join(_root(), 'machines')
+    if not os.path.isdir(machines_dir):
+        return []
+    return sorted(os.listdir(machines_dir))
+
+
+def _check_box_name(name):
+    names = os.environ.get('STODGY_FAKE_VAGRANT_BOXES')
+    if names and name not in names.split(','):
+        sys.stderr.write("The machine with the name '%s' was not found configured for\n"
+                         "this Vagrant environment.\n" % (name,))
+        sys.exit(1)
+
+
+def _machine_dir(name, *parts):
+    return os.path.join(_root(), 'machines', name, *parts)
+
+
+def _get_state(name):
+    try:
+        with open(_machine_dir(name, 'state')) as f:
+            return f.read().strip()
+    except IOError:
+        return NOT_CREATED
+
+
+def _set_state(name, state):
+    if not os.path.isdir(_machine_dir(name)):
+        os.makedirs(_machine_dir(name))
+    with open(_machine_dir(name, 'state'), 'w') as f:
+        f.write(state)
+
+
+def _domain_id_filename(name):
+    return os.path.join('.vagrant', 'machines', name, 'libvirt', 'id')
+
+
+def _domain_id(name):
+    return 'fake-domain-' + name
+
+
+def _log_invocation(argv):
+    if not os.path.isdir(_root()):
+        os.makedirs(_root())
+    with open(os.path.join(_root(), 'invocations.log'), 'a') as f:
+        f.write('%f %s\n' % (time.time(), ' '.join(argv).replace('\n', '\\n')))
+
+
+def _run_in_machine(name, command, stdin=None):
+    if _get_state(name) != RUNNING:
+        sys.stderr.write('ssh: connect to host %s port 22: Connection refused\n' % (name,))
+        return 255
+    home = _machine_dir(name, 'home')
+    env = dict(os.environ)
+    env['HOME'] = home
+    return subprocess.call(['bash', '-c', command], cwd=home, env=env, stdin=stdin)
+
+
+def _copy_tree(source, destination, ignore=None):
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    shutil.copytree(source, destination, symlinks=True, ignore=ignore)
+
+
+def vagrant_main(argv):
+    if not argv:
+        sys.stderr.write('usage: vagrant COMMAND [NAME]\n')
+        return 1
+    command, rest = argv[0], argv[1:]
+    names = [arg for arg in rest if not arg.startswith('-')]
+
+    if command == 'status':
+        for name in _box_names():
+            print('%d,%s,metadata,provider,libvirt' % (time.time(), name))
+            print('%d,%s,state,%s' % (time.time(), name, _get_state(name)))
+        return 0
+
+    if command == 'box' and rest[:1] == ['list']:
+        print('%d,fake-box,box-name,fake-box' % (time.time(),))
+        print('%d,fake-box,box-provider,libvirt' % (time.time(),))
+        print('%d,fake-box,box-version,0' % (time.time(),))
+        return 0
+
+    if command == 'halt' and not names:
+        names = _box_names()
+
+    if command == 'snapshot':
+        subcommand, name = rest[0], names[1]
+        _check_box_name(name)
+        snapshots_dir = _machine_dir(name, 'snapshots')
+        if subcommand == 'list':
+            if os.path.isdir(snapshots_dir):
+                for snapshot_name in sorted(os.listdir(snapshots_dir)):
+                    print(snapshot_name)
+            return 0
+        snapshot_dir = os.path.join(snapshots_dir, names[2])
+        if subcommand == 'save':
+            _copy_tree(_machine_dir(name, 'home'), snapshot_dir)
+            return 0
+        if subcommand == 'restore':
+            _copy_tree(snapshot_dir, _machine_dir(name, 'home'))
+            _set_state(name, RUNNING)
+            return 0
+        sys.stderr.write('Unknown snapshot command %s\n' % (subcommand,))
+        return 1
+
+    for name in names:
+        _check_box_name(name)
+        state = _get_state(name)
+        if command == 'up':
+            print("Bringing machine '%s' up with 'libvirt' provider..." % (name,))
+            if not os.path.isdir(_machine_dir(name, 'home')):
+                os.makedirs(_machine_dir(name, 'home'))
+            if not os.path.isdir(os.path.dirname(_domain_id_filename(name))):
+                os.makedirs(os.path.dirname(_domain_id_filename(name)))
+            with open(_domain_id_filename(name), 'w') as f:
+                f.write(_domain_id(name))
+            _set_state(name, RUNNING)
+        elif command == 'resume':
+            if state == NOT_CREATED:
+                print('==> %s: VM not created. Moving on...' % (name,))
+            elif state != SAVED:
+                print('==> %s: Domain is not suspended' % (name,))
+            else:
+                print('==> %s: Resuming domain...' % (name,))
+                _set_state(name, RUNNING)
+        elif command == 'suspend':
+            if state == RUNNING:
+                _set_state(name, SAVED)
+        elif command == 'halt':
+            if state != NOT_CREATED:
+                _set_state(name, POWEROFF)
+        elif command == 'destroy':
+            if os.path.isdir(_machine_dir(name)):
+                shutil.rmtree(_machine_dir(name))
+            if os.path.exists(_domain_id_filename(name)):
+                os.unlink(_domain_id_filename(name))
+        elif command == 'rsync':
+            if state != RUNNING:
+                sys.stderr.write('The machine is not running.\n')
+                return 1
+            _copy_tree(os.getcwd(), _machine_dir(name, 'home', 'vagrant'),
+                       ignore=shutil.ignore_patterns('.vagrant'))
+        elif command == 'ssh-config':
+            if state != RUNNING:
+                sys.stderr.write('The provider for this Vagrant-managed machine is reporting '
+                                 'that it is not yet ready for SSH.\n')
+                return 1
+            print('Host %s' % (name,))
+            print('  HostName 127.0.0.1')
+            print('  User vagrant')
+            print('  Port 22')
+        elif command == 'ssh':
+            if '-c' not in rest:
+                sys.stderr.write('Interactive `vagrant ssh` is not supported by the fake.\n')
+                return 1
+            return _run_in_machine(name, rest[rest.index('-c') + 1])
+        else:
+            sys.stderr.write('Unknown command %s\n' % (command,))
+            return 1
+    return 0
+
+
+def ssh_main(argv):
+    '''Handle the subset of ssh's command line that stodgy-tester uses.'''
+    positional = []
+    control_command = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ['-F', '-o', '-p', '-l', '-i']:
+            i += 2
+            continue
+        if arg == '-O':
+            control_command = argv[i + 1]
+            i += 2
+            continue
+        if arg.startswith('-') and not positional:
+            i += 1
+            continue
+        positional.append(arg)
+        i += 1
+
+    if control_command is not None:
+        # There is no real master connection to check or shut down.
+        return 0
+    host, command = positional[0], ' '.join(positional[1:])
+    return _run_in_machine(host, command)
+
+
+def virsh_main(argv):
+    '''Handle the domain lifecycle commands that stodgy-tester's libvirt fast path uses.'''
+    if argv[:1] == ['-c']:
+        argv = argv[2:]
+    if len(argv) != 2:
+        sys.stderr.write('usage: virsh COMMAND DOMAIN\n')
+        return 1
+    command, domain = argv
+    name = domain[len(_domain_id('')):] if domain.startswith(_domain_id('')) else domain
+    state = _get_state(name)
+    if state == NOT_CREATED:
+        sys.stderr.write("error: failed to get domain '%s'\n" % (domain,))
+        return 1
+
+    if command == 'domstate':
+        print({RUNNING: 'running', SAVED: 'paused', POWEROFF: 'shut off'}[state])
+        print()
+        return 0
+    # Each command only works from some states, as with libvirt.
+    transitions = {
+        'suspend': ([RUNNING], SAVED),
+        'resume': ([SAVED], RUNNING),
+        'shutdown': ([RUNNING], POWEROFF),
+        'destroy': ([RUNNING, SAVED], POWEROFF),
+    }
+    if command not in transitions:
+        sys.stderr.write('Unknown fake virsh command %s\n' % (command,))
+        return 1
+    from_states, to_state = transitions[command]
+    if state not in from_states:
+        sys.stderr.write('error: Requested operation is not valid: domain is %s\n' % (state,))
+        return 1
+    _set_state(name, to_state)
+    return 0
+
+
+def main():
+    if len(sys.argv) >= 3 and sys.argv[1] == 'install':
+        install(sys.argv[2])
+        return 0
+    command, argv = sys.argv[1], sys.argv[2:]
+    _log_invocation([command] + argv)
+    if command == 'vagrant':
+        return vagrant_main(argv)
+    if command == 'ssh':
+        return ssh_main(argv)
+    if command == 'virsh':
+        return virsh_main(argv)
+    sys.stderr.write('Unknown fake command %s\n' % (command,))
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,9 +6,22 @@ from __future__ import (
     absolute_import,
 )
 import ansicolor
-import datetime
+import functools
+import glob
+import hashlib
+import json
 import os
+import pexpect
+import pipes
+import random
+import re
+import select
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+import stodgy_tester.tracing
 
 
 def _make_colored_printer(color):
@@ -32,9 +45,240 @@ print_progress = _make_colored_printer(color=ansicolor.black)
 print_error = _make_colored_printer(color=ansicolor.red)
 
 
+def state_path(*parts):
+    '''Return the path to something in stodgy-tester's on-disk state directory.
+
+    By default this lives under .vagrant/ next to the *.t files, since `vagrant rsync` already
+    leaves that directory alone. Set STODGY_TESTER_STATE_DIR to put it somewhere else.'''
+    base = os.environ.get('STODGY_TESTER_STATE_DIR') or os.path.join(
+        os.getcwd(), '.vagrant', 'stodgy-tester')
+    return os.path.join(base, *parts)
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Someone else (e.g. a parallel child process) may have just made it.
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+def state_dir(*parts):
+    '''Like state_path(), but for a directory, which gets created if needed.'''
+    return _makedirs(state_path(*parts))
+
+
+def read_json(filename, default=None):
+    '''Load a JSON file, returning default if it is missing or unreadable.'''
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def write_json_atomically(filename, data):
+    '''Write data to filename as JSON, so that readers never see a half-written file.'''
+    temp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+    with open(temp_filename, 'w') as f:
+        json.dump(data, f)
+    os.rename(temp_filename, filename)
+
+
+def hash_file(filename):
+    '''Return the SHA-1 of a file's contents, as hex.'''
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# By default, `vagrant rsync` copies the Vagrantfile's directory to /vagrant in the VM, leaving
+# out any .vagrant/ directory and copying what symlinks point to (rsync --copy-links).
+DEFAULT_SYNCED_GUEST_PATH = '/vagrant'
+SYNCED_TREE_EXCLUDES = ['.vagrant']
+
+_PLAIN_SYNCED_FOLDER_RE = re.compile(
+    r'''\.synced_folder\s*\(?\s*(['"])\./?\1\s*,\s*(['"])(/[^'"]*)\2\s*\)?'''
+    r'''(\s*,\s*type:\s*(['"])rsync\5)?\s*$''')
+
+
+def vagrant_synced_folder(vagrantfile='Vagrantfile'):
+    '''Return where `vagrant rsync` puts the current directory inside the VMs, or None if we
+    can't tell.
+
+    We understand Vagrant's default, and one plain `config.vm.synced_folder ".", "/path"` line.
+    Anything else, e.g. rsync__exclude or a folder per machine, may change what gets synced where,
+    so the caller should leave all the syncing to `vagrant rsync`.'''
+    try:
+        with open(vagrantfile) as f:
+            lines = [line.split('#', 1)[0].strip() for line in f]
+    except IOError:
+        return None
+    lines = [line for line in lines if 'synced_folder' in line or 'rsync__' in line]
+    if not lines:
+        return DEFAULT_SYNCED_GUEST_PATH
+    if len(lines) == 1:
+        match = _PLAIN_SYNCED_FOLDER_RE.search(lines[0])
+        if match:
+            return match.group(3)
+    return None
+
+
+def synced_tree_files(root):
+    '''Yield the path, relative to root, of each file that `vagrant rsync` would push.'''
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        dirnames[:] = sorted(d for d in dirnames if d not in SYNCED_TREE_EXCLUDES)
+        for filename in sorted(filenames):
+            yield os.path.relpath(os.path.join(dirpath, filename), root)
+
+
+def hash_synced_tree(root):
+    '''Return one SHA-1 covering the names and contents of every file under root.'''
+    digest = hashlib.sha1()
+    for relative_path in synced_tree_files(root):
+        full_path = os.path.join(root, relative_path)
+        if os.path.isfile(full_path):
+            digest.update(relative_path.encode('utf-8') + b'\0')
+            digest.update(hash_file(full_path).encode('ascii') + b'\0')
+    return digest.hexdigest()
+
+
+def build_synced_manifest(root, previous_files=None):
+    '''Describe each file that `vagrant rsync` would push, as {path: [size, mtime, sha1]}.
+
+    Files whose size and mtime match previous_files keep their old hash instead of being re-read.'''
+    previous_files = previous_files or {}
+    files = {}
+    for relative_path in synced_tree_files(root):
+        full_path = os.path.join(root, relative_path)
+        if not os.path.isfile(full_path):
+            continue
+        stat = os.stat(full_path)
+        previous = previous_files.get(relative_path)
+        if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime:
+            files[relative_path] = previous
+        else:
+            files[relative_path] = [stat.st_size, stat.st_mtime, hash_file(full_path)]
+    return files
+
+
+class InputFingerprinter(object):
+    '''Compute a hash of everything a test's outcome depends on.
+
+    That is the *.t file itself, the plugin module, the files `vagrant rsync` would push (if we
+    rsync at all), and, for tests on Vagrant boxes, the list of installed box versions.
+    uses_vagrant(test_filename) says which tests those are; by default, all of them. Everything
+    but the *.t file is the same for every test, so it is only computed once, when first needed.'''
+    def __init__(self, command_runner, plugin_filename=None, synced_root=None, uses_vagrant=None):
+        self._command_runner = command_runner
+        self._plugin_filename = plugin_filename
+        self._synced_root = synced_root
+        self._uses_vagrant = uses_vagrant or (lambda test_filename: True)
+        self._shared_hash = None
+        self._box_list_hash = None
+        self._lock = threading.Lock()
+
+    def _compute_shared_hash(self):
+        digest = hashlib.sha1()
+        if self._plugin_filename:
+            # Hash the source, not the .pyc.
+            plugin_filename = re.sub(r'\.py[co]$', '.py', self._plugin_filename)
+            digest.update(b'plugin ' + hash_file(plugin_filename).encode('ascii') + b'\n')
+        if self._synced_root:
+            digest.update(b'synced ' + hash_synced_tree(self._synced_root).encode('ascii') + b'\n')
+        return digest.hexdigest()
+
+    def _compute_box_list_hash(self):
+        digest = hashlib.sha1()
+        try:
+            output = self._command_runner(['vagrant', 'box', 'list', '--machine-readable'])
+        except Exception as e:
+            print_warn('** Warning: could not list Vagrant boxes', e)
+            output = 'unknown'
+        for line in output.splitlines():
+            # Skip the timestamp that starts each line.
+            digest.update(line.split(',', 1)[-1].encode('utf-8') + b'\n')
+        return digest.hexdigest()
+
+    def key_for(self, test_filename):
+        uses_vagrant = self._uses_vagrant(test_filename)
+        with self._lock:
+            if self._shared_hash is None:
+                self._shared_hash = self._compute_shared_hash()
+            hashes = [hash_file(test_filename), self._shared_hash]
+            if uses_vagrant:
+                if self._box_list_hash is None:
+                    self._box_list_hash = self._compute_box_list_hash()
+                hashes.append(self._box_list_hash)
+        return hashlib.sha1(''.join(hashes).encode('ascii')).hexdigest()
+
+
+class ResultCache(object):
+    '''Remember, for each test, the input fingerprint of its last passing run.'''
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+
+    def passed_with(self, test_filename, key):
+        '''Return True if the test last passed with exactly these inputs.'''
+        return read_json(self._filename, {}).get(test_filename) == key
+
+    def _update(self, test_filename, key):
+        # Re-read the file first, so parallel runs don't lose each other's results.
+        with self._lock:
+            results = read_json(self._filename, {})
+            if key is None:
+                results.pop(test_filename, None)
+            else:
+                results[test_filename] = key
+            write_json_atomically(self._filename, results)
+
+    def record_pass(self, test_filename, key):
+        self._update(test_filename, key)
+
+    def record_failure(self, test_filename):
+        self._update(test_filename, None)
+
+
+class _OutputTail(object):
+    '''Keep just the last max_bytes of a stream of bytes.'''
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._chunks = []
+        self._length = 0
+
+    def append(self, data):
+        self._chunks.append(data)
+        self._length += len(data)
+        while self._chunks and self._length - len(self._chunks[0]) >= self._max_bytes:
+            self._length -= len(self._chunks.pop(0))
+
+    def get_text(self):
+        '''Return the tail as text, with trailing whitespace stripped from each line.'''
+        data = b''.join(self._chunks)[-self._max_bytes:]
+        return u''.join(
+            line.rstrip() + u'\n' for line in data.decode('utf-8', 'replace').splitlines())
+
+
 class CommandRunner(object):
-    def __init__(self, default_cwd, extra_env=None, print_cmd=True):
-        '''The whole point of this CommandRunner is to encapsulate a default CWD value.'''
+    # Only this much of each command's output is kept in memory; all of it goes to the log file.
+    MAX_OUTPUT_IN_MEMORY = 256 * 1024
+    # Output without a newline, e.g. a progress bar, is printed in pieces of at most this size.
+    MAX_PRINTED_LINE = 64 * 1024
+    # Log files in a log_dir we were given are deleted once they are this old.
+    LOG_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+    def __init__(self, default_cwd, extra_env=None, print_cmd=True, log_dir=None):
+        '''The whole point of this CommandRunner is to encapsulate a default CWD value.
+
+        The full output of each command is written to a file in log_dir (by default, a fresh
+        temporary directory). Logs older than LOG_RETENTION_SECONDS in log_dir are deleted the
+        first time this runner writes a log there.'''
         self._default_cwd = default_cwd
         self._default_env = os.environ.copy()
         self._full_env = self._default_env
@@ -44,6 +288,9 @@ class CommandRunner(object):
         self._should_print_cmd = print_cmd
         self._should_print_cmd_output = True
         self._should_print_timing = True
+        self._log_dir = log_dir
+        self._log_count = 0
+        self._log_lock = threading.Lock()
 
     def _print_cmd_start(self, argv):
         if not self._should_print_cmd:
@@ -61,74 +308,873 @@ class CommandRunner(object):
     def _print_cmd_end(self, printed_length, started_time):
         if not self._should_print_cmd:
             return
-        now = datetime.datetime.utcnow()
-        print_info('  ' + '[%d sec]' % ((now - started_time).seconds,))
+        print_info('  ' + '[%.1f sec]' % (stodgy_tester.tracing.clock() - started_time,))
+
+    def _new_log_filename(self, argv):
+        with self._log_lock:
+            if self._log_dir is None:
+                self._log_dir = tempfile.mkdtemp(prefix='stodgy-tester-logs-')
+            _makedirs(self._log_dir)
+            if self._log_count == 0:
+                self._delete_old_logs()
+            self._log_count += 1
+            log_count = self._log_count
+        slug = re.sub(r'[^A-Za-z0-9.]+', '-', ' '.join(argv[:3]))[:60].strip('-')
+        return os.path.join(self._log_dir, '%d-%04d-%s.log' % (os.getpid(), log_count, slug))
+
+    def _delete_old_logs(self):
+        cutoff = time.time() - self.LOG_RETENTION_SECONDS
+        for filename in glob.glob(os.path.join(self._log_dir, '*.log')):
+            try:
+                if os.path.getmtime(filename) < cutoff:
+                    os.unlink(filename)
+            except OSError:
+                # Another stodgy-tester process got to it first.
+                pass
 
     def __call__(self, argv):
         '''Run the command indicated by argv. Raise an exception if it failed to exit 0.
 
         Depending on the value of self._should_print_cmd, also print the command & how long it took.
+
+        Returns the command's stdout, or just the end of it if it was very long; see the log file
+        for the rest.
         '''
-        # TODO(soon): Create log files of each test in a text file, but only print out what seems
-        # relevant.
+        program = os.path.basename(argv[0])
+        if program in ['vagrant', 'ssh']:
+            category = program
+        else:
+            category = 'command'
+        name = ' '.join(argv[:2]) if program == 'vagrant' else program
+        with stodgy_tester.tracing.span(category, name, argv=argv):
+            return self._run(argv)
+
+    def _run(self, argv):
         printed_length = self._print_cmd_start(argv)
-        started_time = datetime.datetime.utcnow()
-        output = '(Output not known)'
-        # Run the process. capturing its output, and printing it if it exited non-zero.
+        started_time = stodgy_tester.tracing.clock()
+        log_filename = self._new_log_filename(argv)
+        # Run the process, reading stdout and stderr at the same time so that neither one can
+        # fill up its pipe and stall the command.
         p = subprocess.Popen(
             argv, cwd=self._default_cwd, stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             env=self._default_env,
         )
-        output = ''
-        for line in p.stdout:
-            line = line.rstrip()
-            output += unicode(line, 'utf-8') + u'\n'
-            if self._should_print_cmd_output:
-                if line:
-                    print_info(line)
+        stdout_tail = _OutputTail(self.MAX_OUTPUT_IN_MEMORY)
+        stderr_tail = _OutputTail(self.MAX_OUTPUT_IN_MEMORY)
+        tails = {p.stdout.fileno(): stdout_tail, p.stderr.fileno(): stderr_tail}
+        unprinted = b''
+        with open(log_filename, 'wb') as log_file:
+            open_fds = list(tails)
+            while open_fds:
+                readable_fds = select.select(open_fds, [], [])[0]
+                for fd in readable_fds:
+                    data = os.read(fd, 65536)
+                    if not data:
+                        open_fds.remove(fd)
+                        continue
+                    log_file.write(data)
+                    tails[fd].append(data)
+                    if fd == p.stdout.fileno() and self._should_print_cmd_output:
+                        lines = (unprinted + data).split(b'\n')
+                        unprinted = lines.pop()
+                        if len(unprinted) > self.MAX_PRINTED_LINE:
+                            # Don't hold on to (and re-split) an ever-growing partial line.
+                            lines.append(unprinted)
+                            unprinted = b''
+                        for line in lines:
+                            line = line.rstrip()
+                            if line:
+                                print_info(line.decode('utf-8', 'replace'))
+        if unprinted.rstrip() and self._should_print_cmd_output:
+            print_info(unprinted.rstrip().decode('utf-8', 'replace'))
+        p.stdout.close()
+        p.stderr.close()
         status = p.wait()
-        stderr = p.communicate()[1].decode('utf-8', 'replace')
+        output = stdout_tail.get_text()
+        stderr = stderr_tail.get_text()
         self._print_cmd_end(printed_length, started_time)
         if status != 0:
-            raise_me = Exception(u"Subprocess failed: argv=%s, stderr=%s" % (argv, stderr))
+            raise_me = Exception(u"Subprocess failed: argv=%s, stderr=%s, log=%s" % (
+                argv, stderr, log_filename))
             raise_me.status = status
             raise_me.output = output
             raise_me.stderr = stderr
             raise_me.argv = argv
+            raise_me.log_filename = log_filename
             raise raise_me
         return output
 
 
-class VirtualMachine(object):
-    '''Model for a Vagrant VM.'''
+class TimingHistory(object):
+    '''Remember how long each step of each test took on past runs, and suggest timeouts.
+
+    Keys identify a step by test filename, line number and a hash of the line's text, so editing
+    a line starts its history over.'''
+    MAX_SAMPLES = 20
+    MIN_SAMPLES = 3
+    PERCENTILE = 0.95
+    # The timeout is the percentile times this factor, plus the margin (in seconds).
+    FACTOR = 1.5
+    MARGIN = 2.0
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._samples = read_json(filename, {})
+        self._new_samples = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(test_filename, lineno, text):
+        return '%s:%d:%s' % (test_filename, lineno,
+                             hashlib.sha1(text.encode('utf-8')).hexdigest()[:12])
+
+    def record(self, key, seconds):
+        with self._lock:
+            self._samples.setdefault(key, []).append(seconds)
+            self._samples[key] = self._samples[key][-self.MAX_SAMPLES:]
+            self._new_samples.setdefault(key, []).append(seconds)
+
+    def timeout_for(self, key, fallback):
+        '''Return a timeout based on this step's history, or fallback if there isn't enough.'''
+        with self._lock:
+            samples = sorted(self._samples.get(key, []))
+        if len(samples) < self.MIN_SAMPLES:
+            return fallback
+        index = min(len(samples) - 1, int(len(samples) * self.PERCENTILE))
+        return samples[index] * self.FACTOR + self.MARGIN
+
+    def expected_test_duration(self, test_filename, default=60.0):
+        '''Guess how many seconds a whole test takes, from the average time of each of its steps.'''
+        prefix = test_filename + ':'
+        with self._lock:
+            averages = [sum(samples) / len(samples) for key, samples in self._samples.items()
+                        if key.startswith(prefix) and samples]
+        if not averages:
+            return default
+        return sum(averages)
+
+    def save(self):
+        '''Merge this run's samples into the file, keeping any that other processes saved.'''
+        with self._lock:
+            samples = read_json(self._filename, {})
+            for key, new_samples in self._new_samples.items():
+                samples[key] = (samples.get(key, []) + new_samples)[-self.MAX_SAMPLES:]
+            self._new_samples = {}
+            write_json_atomically(self._filename, samples)
+            self._samples = samples
+
+
+class TestHistory(object):
+    '''Remember how each test did on past runs: whether it passed, how long it took, and the
+    fingerprint of its inputs, so that tests likely to fail can be run first.
+
+    It is a tracing listener, so it records every test span that ends while it is listening.'''
+    MAX_SAMPLES = 20
+    # Each older outcome counts this much less than the one after it.
+    DECAY = 0.7
+    # How likely to fail a test is if it has never run, or its inputs changed since it last ran.
+    NEW_TEST_LIKELIHOOD = 0.5
+    CHANGED_LIKELIHOOD = 0.5
+
+    def __init__(self, filename, input_key_for=None):
+        self._filename = filename
+        self._input_key_for = input_key_for
+        self._tests = read_json(filename, {})
+        self._new_runs = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if event['category'] != 'test' or event['nested']:
+            return
+        key = None
+        if self._input_key_for is not None:
+            key = self._input_key_for(event['test'])
+        self.record(event['test'], not event['failed'], event['duration'], key)
+        self.save()
+
+    def record(self, test_filename, passed, seconds, key=None):
+        with self._lock:
+            self._add_run(self._tests, (test_filename, passed, seconds, key))
+            self._new_runs.append((test_filename, passed, seconds, key))
+
+    def _add_run(self, tests, run):
+        test_filename, passed, seconds, key = run
+        entry = tests.setdefault(test_filename, {'outcomes': [], 'seconds': [], 'key': None})
+        entry['outcomes'] = (entry['outcomes'] + [passed])[-self.MAX_SAMPLES:]
+        entry['seconds'] = (entry['seconds'] + [seconds])[-self.MAX_SAMPLES:]
+        if key is not None:
+            entry['key'] = key
+
+    def failure_likelihood(self, test_filename, key=None):
+        '''Guess how likely the test is to fail, from 0 to 1.
+
+        Recent failures count for more than old ones. If key is given and is not the input
+        fingerprint of the test's last fingerprinted run, the test counts as at least
+        CHANGED_LIKELIHOOD likely to fail.'''
+        with self._lock:
+            entry = self._tests.get(test_filename)
+        if not entry or not entry['outcomes']:
+            return self.NEW_TEST_LIKELIHOOD
+        weight, total_weight, failures = 1.0, 0.0, 0.0
+        for passed in reversed(entry['outcomes']):
+            total_weight += weight
+            if not passed:
+                failures += weight
+            weight *= self.DECAY
+        likelihood = failures / total_weight
+        if key is not None and entry['key'] is not None and key != entry['key']:
+            likelihood = max(likelihood, self.CHANGED_LIKELIHOOD)
+        return likelihood
+
+    def expected_duration(self, test_filename, default=None):
+        '''Return the average number of seconds the whole test took, or default if it never ran.'''
+        with self._lock:
+            entry = self._tests.get(test_filename)
+        if not entry or not entry['seconds']:
+            return default
+        return sum(entry['seconds']) / len(entry['seconds'])
+
+    def save(self):
+        '''Merge this run's results into the file, keeping any that other processes saved.'''
+        with self._lock:
+            tests = read_json(self._filename, {})
+            for run in self._new_runs:
+                self._add_run(tests, run)
+            self._new_runs = []
+            write_json_atomically(self._filename, tests)
+            self._tests = tests
+
+
+class LiteralPattern(object):
+    '''A piece of text to wait for, compiled once so it can be searched for cheaply.'''
+    def __init__(self, text):
+        self.text = text
+        encoded = text.encode('utf-8')
+        self.regex = re.compile(re.escape(encoded))
+        # No match can be longer than this, which bounds how much unmatched output we must keep.
+        self.max_length = len(encoded)
+
+
+class ExpectSession(object):
+    '''Wait for literal text in the output of a pexpect child, using bounded memory.
+
+    Output is read in large chunks and searched only once; anything that has been searched and
+    cannot be the start of a match is thrown away, so a noisy command doesn't make each later
+    expectation slower, and the transcript is never held in memory all at once.'''
+    READ_CHUNK_SIZE = 65536
+
+    def __init__(self, child, group=None):
+        self.child = child
+        self._buffer = b''
+        # How many bytes of output came before self._buffer[0].
+        self._buffer_offset = 0
+        self._started_time = stodgy_tester.tracing.clock()
+        # The SessionGroup this session shares an event loop with, if any.
+        self._group = group
+        # Whether the group has already read the end of this session's output.
+        self._eof = False
+
+    def _discard(self, length):
+        self._buffer = self._buffer[length:]
+        self._buffer_offset += length
+
+    def _read_available(self, max_buffer_length):
+        '''Read whatever output is ready without waiting, keeping at most max_buffer_length bytes.
+
+        Returns True if there was any output, or the output ended.'''
+        try:
+            self._buffer += self.child.read_nonblocking(self.READ_CHUNK_SIZE, timeout=0)
+        except pexpect.TIMEOUT:
+            return False
+        except pexpect.EOF:
+            self._eof = True
+            return True
+        self._discard(max(0, len(self._buffer) - max_buffer_length))
+        return True
+
+    def _read(self, deadline, waiting_for):
+        remaining = deadline - stodgy_tester.tracing.clock()
+        if remaining <= 0:
+            raise pexpect.TIMEOUT('Timed out waiting for %r; recent output: %r' % (
+                waiting_for, self._buffer[-200:]))
+        try:
+            if self._eof:
+                raise pexpect.EOF('')
+            if self._group is not None:
+                self._group.read_until_output(self, remaining)
+            else:
+                self._buffer += self.child.read_nonblocking(
+                    self.READ_CHUNK_SIZE, timeout=remaining)
+        except pexpect.TIMEOUT:
+            raise pexpect.TIMEOUT('Timed out waiting for %r; recent output: %r' % (
+                waiting_for, self._buffer[-200:]))
+        except pexpect.EOF:
+            raise pexpect.EOF('Output ended while waiting for %r; recent output: %r' % (
+                waiting_for, self._buffer[-200:]))
+
+    def expect(self, pattern, timeout):
+        '''Wait up to timeout seconds for the LiteralPattern to show up in the output.
+
+        Returns (offset, seconds), where offset is the byte offset into the command's output at
+        which the match starts, and seconds is how long after the command started it matched.'''
+        deadline = stodgy_tester.tracing.clock() + timeout
+        while True:
+            match = pattern.regex.search(self._buffer)
+            if match:
+                offset = self._buffer_offset + match.start()
+                self._discard(match.end())
+                return offset, stodgy_tester.tracing.clock() - self._started_time
+            # Only the last few bytes could be the beginning of a match that is still arriving.
+            self._discard(max(0, len(self._buffer) - max(pattern.max_length - 1, 0)))
+            self._read(deadline, pattern.text)
+
+    def expect_eof(self, timeout):
+        '''Wait for the command to finish, then return its exit status.'''
+        deadline = stodgy_tester.tracing.clock() + timeout
+        while True:
+            self._discard(len(self._buffer))
+            try:
+                self._read(deadline, 'end of output')
+            except pexpect.EOF:
+                break
+        self.child.close()
+        return self.child.exitstatus
+
+    def sendline(self, line):
+        return self.child.sendline(line)
+
+
+class SessionGroup(object):
+    '''Drive several named ExpectSessions at once, on one select() loop.
+
+    While a test waits on one session, the group keeps reading the others, so a chatty background
+    command never stalls on a full pty. Output that no expectation has looked at yet is kept per
+    session, but only the last MAX_PENDING_OUTPUT bytes of it.'''
+    MAX_PENDING_OUTPUT = 1024 * 1024
+
+    def __init__(self):
+        self._sessions_by_name = {}
+
+    def start(self, name, child):
+        '''Start tracking a pexpect child as session `name`, and return its ExpectSession.
+
+        If that session is still running, the test is wrong: child is killed, and we raise.'''
+        if name in self._sessions_by_name:
+            child.close(force=True)
+            raise Exception('Session %r is still running; wait for its $[exitcode] first' % (
+                name,))
+        session = ExpectSession(child, group=self)
+        self._sessions_by_name[name] = session
+        return session
+
+    def get(self, name):
+        if name not in self._sessions_by_name:
+            raise Exception('No session named %r is running' % (name,))
+        return self._sessions_by_name[name]
+
+    def finish(self, name):
+        '''Stop tracking a session, e.g. once it has exited, killing it if it is still running.'''
+        session = self._sessions_by_name.pop(name, None)
+        if session is not None:
+            session.child.close(force=True)
+
+    def close_all(self):
+        '''Kill any sessions that are still running.'''
+        for session in self._sessions_by_name.values():
+            session.child.close(force=True)
+        self._sessions_by_name = {}
+
+    def read_until_output(self, waiting_session, timeout):
+        '''Read from every session until waiting_session has new output or has ended.'''
+        deadline = stodgy_tester.tracing.clock() + timeout
+        while True:
+            sessions_by_fd = dict((session.child.child_fd, session)
+                                  for session in self._sessions_by_name.values()
+                                  if not session._eof)
+            sessions_by_fd[waiting_session.child.child_fd] = waiting_session
+            remaining = deadline - stodgy_tester.tracing.clock()
+            if remaining <= 0:
+                raise pexpect.TIMEOUT('')
+            readable_fds = select.select(list(sessions_by_fd), [], [], remaining)[0]
+            got_output = False
+            for fd in readable_fds:
+                session = sessions_by_fd[fd]
+                if session is waiting_session:
+                    got_output = session._read_available(float('inf')) or got_output
+                else:
+                    session._read_available(self.MAX_PENDING_OUTPUT)
+            if got_output:
+                return
+
+
+class VagrantStateTracker(object):
+    '''Remember the lifecycle state of each box in the Vagrantfile.
+
+    refresh() learns the state of every box from one `vagrant status --machine-readable` call, and
+    VirtualMachine updates the state as it changes it, so that bringing a box up only has to run
+    the one Vagrant command it really needs.'''
+    NOT_CREATED = 'not_created'
+    POWEROFF = 'poweroff'
+    SAVED = 'saved'
+    RUNNING = 'running'
+
+    # Providers use their own names for some states. These are the libvirt and VirtualBox ones.
+    _STATE_ALIASES = {
+        'shutoff': POWEROFF,
+        'shutdown': POWEROFF,
+        'aborted': POWEROFF,
+        'paused': SAVED,
+        'suspended': SAVED,
+    }
+
+    def __init__(self, command_runner):
+        self._command_runner = command_runner
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        output = self._command_runner(['vagrant', 'status', '--machine-readable'])
+        states = {}
+        for line in output.splitlines():
+            fields = line.strip().split(',')
+            if len(fields) >= 4 and fields[2] == 'state':
+                states[fields[1]] = self._STATE_ALIASES.get(fields[3], fields[3])
+        with self._lock:
+            self._states = states
+
+    def get(self, name):
+        '''Return the state of a box, or None if we don't know it.'''
+        with self._lock:
+            return self._states.get(name)
+
+    def names(self):
+        '''Return the names of every box we know the state of.'''
+        with self._lock:
+            return sorted(self._states)
+
+    def set(self, name, state):
+        with self._lock:
+            if state is None:
+                self._states.pop(name, None)
+            else:
+                self._states[name] = state
+
+
+def produces_state(*states):
+    '''Declare that a plugin function leaves the VM in each of these states.
+
+    States are just names, e.g. "sandstorm-not-installed". stodgy-tester remembers which states
+    each VM is known to be in, until something that might change them happens, and skips any
+    precondition whose states are all known to hold already. A vagrant-destroy-if-bash probe's
+    state is probe_state(command).'''
+    def decorate(function):
+        function.produces_states = getattr(function, 'produces_states', ()) + states
+        return function
+    return decorate
+
+
+def checks_state(*states):
+    '''Declare that a plugin function only succeeds if the VM is in each of these states.'''
+    def decorate(function):
+        function.checks_states = getattr(function, 'checks_states', ()) + states
+        return function
+    return decorate
+
+
+def declared_states(function):
+    '''Return the set of states a plugin function produces or checks.'''
+    return (set(getattr(function, 'produces_states', ())) |
+            set(getattr(function, 'checks_states', ())))
+
+
+def probe_state(command):
+    '''Return the state name for "this vagrant-destroy-if-bash probe exits non-zero".'''
+    return 'vagrant-destroy-if-bash: ' + command
+
+
+def _traced_vm_operation(method):
+    '''Record each call of a VirtualMachine method as a span in the "vm" category.'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with stodgy_tester.tracing.span('vm', method.__name__.strip('_'), box=self._name):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def guest_http_proxy_script(proxy_url):
+    '''Return a shell command that points apt, yum and dnf at proxy_url, replacing any proxy an
+    earlier one set. If proxy_url is None, it just removes that proxy.
+
+    Only package managers are configured, since sending the test scripts' own HTTP requests
+    through a proxy could change what they test.'''
+    lines = [
+        'rm -f /etc/apt/apt.conf.d/01stodgy-tester-proxy',
+        'for f in /etc/yum.conf /etc/dnf/dnf.conf; do',
+        '  if [ -e "$f" ]; then sed -i "/^# stodgy-tester proxy$/,+1d" "$f"; fi',
+        'done',
+    ]
+    if proxy_url is not None:
+        lines.extend([
+            'if [ -d /etc/apt/apt.conf.d ]; then',
+            '  echo %s > /etc/apt/apt.conf.d/01stodgy-tester-proxy' % (
+                pipes.quote('Acquire::http::Proxy "%s";' % (proxy_url,)),),
+            'fi',
+            'for f in /etc/yum.conf /etc/dnf/dnf.conf; do',
+            '  if [ -e "$f" ]; then sed -i %s "$f"; fi' % (
+                pipes.quote('/^\\[main\\]/a # stodgy-tester proxy\\nproxy=' + proxy_url),),
+            'done',
+        ])
+    return 'sudo sh -c ' + pipes.quote('\n'.join(lines))
+
+
+class Machine(object):
+    '''Somewhere to run tests: what the runner and plugins need from a VM.
+
+    Subclasses provide the lifecycle (up_or_resume_if_needed, suspend, stop, destroy_then_start,
+    reset_to_baseline), rsync, and ssh_argv, which says how to run a shell command inside the
+    machine; running commands, probes and interactive sessions is built on top of that.'''
+    # Whether commands run somewhere that a plugin may trash, e.g. with `sudo rm -rf`. Plugin
+    # functions (--on-vm-start, Cleanup: and Precondition:) only ever run on isolated machines.
+    isolated = False
+
     def __init__(self, name, command_runner):
         # Store a name so we can print it
         self._name = name
         # Store a command runner so that someone can configure default_cwd just once.
         self._command_runner = command_runner
+        # States that plugins declared this machine to be in; see produces_state().
+        self._known_states = set()
+
+    def has_known_states(self, states):
+        return set(states) <= self._known_states
+
+    def add_known_states(self, states):
+        self._known_states.update(states)
+
+    def forget_known_states(self):
+        self._known_states = set()
+
+    def up_or_resume_if_needed(self):
+        raise NotImplementedError()
+
+    def suspend(self):
+        raise NotImplementedError()
+
+    def stop(self):
+        raise NotImplementedError()
+
+    def destroy_then_start(self):
+        raise NotImplementedError()
+
+    def reset_to_baseline(self):
+        raise NotImplementedError()
+
+    def rsync(self):
+        '''Make the machine's copy of the current directory match ours.'''
+        raise NotImplementedError()
+
+    def forget_synced_files(self):
+        '''Make the next rsync() copy everything, e.g. because a test may have changed the
+        machine's copy.'''
+        pass
+
+    def ssh_argv(self, command_as_str, tty=False):
+        '''Return an argv that runs a shell command inside this machine.'''
+        raise NotImplementedError()
+
+    def set_http_proxy(self, proxy_url):
+        '''Make the machine's package manager download through proxy_url, or, if it is None, stop.
+
+        Machines that share the host's network have nothing to gain from a proxy, so by default
+        this does nothing.'''
+        pass
+
+    def spawn(self, command_as_str):
+        '''Start an interactive shell command inside this machine, as a pexpect child.'''
+        argv = self.ssh_argv(command_as_str, tty=True)
+        print_info('$', ' '.join(argv))
+        return pexpect.spawn(argv[0], argv[1:], cwd=os.getcwd())
+
+    def run_command_within_vm(self, command_as_str):
+        '''Run a shell command inside this machine, and return its output.'''
+        self.up_or_resume_if_needed()
+        full_bash_cmd = 'set -e; ' + command_as_str
+        return self._command_runner(self.ssh_argv(full_bash_cmd))
+
+    def run_probes(self, commands):
+        '''Run several small shell commands inside this machine, using just one SSH round trip.
+
+        Each command runs in its own subshell with `set -e`, and one failing doesn't stop the
+        others. Returns a list with a (exit_status, output) pair for each command, where output
+        has its stdout and stderr combined.'''
+        if not commands:
+            return []
+        self.up_or_resume_if_needed()
+        marker = 'stodgy-probe-%016x' % (random.getrandbits(64),)
+        script_lines = []
+        for i, command in enumerate(commands):
+            script_lines.append("echo '%s begin %d'" % (marker, i))
+            script_lines.append('( set -e; %s ) 2>&1 </dev/null' % (command,))
+            script_lines.append("printf '\\n%s end %d %%d\\n' $?" % (marker, i))
+        script_lines.append('true')
+        output = self._command_runner(self.ssh_argv('\n'.join(script_lines)))
+
+        results = []
+        for i in range(len(commands)):
+            match = re.search(
+                r'(?:^|\n)%s begin %d\n(.*?)\n%s end %d (\d+)\n' % (marker, i, marker, i),
+                output, re.DOTALL)
+            assert match, "Lost track of the output of probe %d (%s)" % (i, commands[i])
+            results.append((int(match.group(2)), match.group(1)))
+        return results
+
+
+class VirtualMachine(Machine):
+    '''Model for a Vagrant VM.'''
+    isolated = True
+
+    # `vagrant ssh-config` output files, by box name. This is shared by every VirtualMachine in the
+    # process, so that each box only pays for Vagrant's startup time once.
+    _ssh_config_filenames_by_name = {}
+    _ssh_config_lock = threading.Lock()
+
+    def __init__(self, name, command_runner, state_tracker=None,
+                 synced_guest_path=DEFAULT_SYNCED_GUEST_PATH):
+        super(VirtualMachine, self).__init__(name, command_runner)
+        # Where `vagrant rsync` puts the current directory inside the VM, or None if we don't know
+        # (see vagrant_synced_folder()), in which case every sync is a full `vagrant rsync`.
+        self._synced_guest_path = synced_guest_path
+        # Optionally, a VagrantStateTracker that knows whether this box is running, suspended, etc.
+        self._state_tracker = state_tracker
         # Store a flag indicating if the VM seems up. If it's not, we auto-start it as needed.
         self._cached_box_seems_up = False
+        # Remember if we rsync-ed, since restoring a snapshot rolls the synced files back.
+        self._has_been_rsynced = False
+        # Likewise for the proxy that set_http_proxy() configured, if any.
+        self._http_proxy = None
+
+    def _set_state(self, state):
+        if self._state_tracker is not None:
+            self._state_tracker.set(self._name, state)
+
+    def _get_state(self):
+        if self._state_tracker is None:
+            return None
+        return self._state_tracker.get(self._name)
 
+    @_traced_vm_operation
     def suspend(self):
+        self._close_ssh_connection()
         self._command_runner(['vagrant', 'suspend', self._name])
         self._cached_box_seems_up = False
+        self._set_state(VagrantStateTracker.SAVED)
 
+    @_traced_vm_operation
+    def stop(self):
+        self._close_ssh_connection(forget_config=True)
+        # Anything running in the VM is about to go away.
+        self.forget_known_states()
+        self._command_runner(['vagrant', 'halt', self._name])
+        self._cached_box_seems_up = False
+        self._set_state(VagrantStateTracker.POWEROFF)
+
+    def _manifest_filename(self):
+        return os.path.join(state_dir('rsync-manifests'), self._name + '.json')
+
+    def _machine_id(self):
+        '''Return Vagrant's ID for this VM, which changes whenever it is re-created.'''
+        for filename in glob.glob(os.path.join('.vagrant', 'machines', self._name, '*', 'id')):
+            with open(filename) as f:
+                return f.read().strip()
+        return None
+
+    def _forget_synced_manifest(self):
+        filename = state_path('rsync-manifests', self._name + '.json')
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    def forget_synced_files(self):
+        self._forget_synced_manifest()
+
+    @_traced_vm_operation
     def rsync(self):
-        self.up_or_resume_if_needed()
-        self._command_runner(['vagrant', 'rsync', self._name])
+        '''Make the VM's copy of the current directory match ours.
 
-    def run_command_within_vm(self, command_as_str):
-        '''Ask Vagrant to run a shell command inside this Linux virtual machine.'''
+        We remember what we last pushed to each VM. If nothing changed, we skip the sync entirely;
+        if a few files changed, we send just those (and delete removed ones) in one tar stream over
+        the VM's SSH connection. Only the first sync to a VM uses the full `vagrant rsync`.'''
         self.up_or_resume_if_needed()
-        full_bash_cmd = 'set -e; ' + command_as_str
-        self._command_runner(['vagrant', 'ssh', self._name, '-c', full_bash_cmd])
+        if self._synced_guest_path is None:
+            self._command_runner(['vagrant', 'rsync', self._name])
+            self._has_been_rsynced = True
+            return
+        root = os.getcwd()
+        previous = read_json(self._manifest_filename())
+        if previous and previous.get('machine_id') != self._machine_id():
+            previous = None
+        files = build_synced_manifest(root, previous and previous['files'])
+
+        if previous is None:
+            self._command_runner(['vagrant', 'rsync', self._name])
+        elif previous['files'] == files:
+            print_info('** Synced files unchanged since the last rsync to', self._name)
+        else:
+            changed = sorted(path for path in files if previous['files'].get(path) != files[path])
+            removed = sorted(path for path in previous['files'] if path not in files)
+            print_info('** Sending', str(len(changed)), 'changed and', str(len(removed)),
+                       'removed files to', self._name)
+            self._push_files(root, changed, removed)
+
+        write_json_atomically(self._manifest_filename(), {
+            'machine_id': self._machine_id(),
+            'files': files,
+        })
+        self._has_been_rsynced = True
+
+    def set_http_proxy(self, proxy_url):
+        '''Make the VM's package manager download through proxy_url, or, if it is None, stop.
+
+        The setting stays in the VM, so we remember which boxes have it, and a later run without a
+        proxy takes it out again.'''
+        marker_filename = state_path('http-proxies', self._name)
+        if proxy_url == self._http_proxy and (
+                proxy_url is not None or not os.path.exists(marker_filename)):
+            return
+        print_info('** Setting the package download proxy of', self._name, 'to', str(proxy_url))
+        self.run_command_within_vm(guest_http_proxy_script(proxy_url))
+        self._http_proxy = proxy_url
+        if proxy_url is None:
+            os.unlink(marker_filename)
+        else:
+            with open(os.path.join(state_dir('http-proxies'), self._name), 'w') as f:
+                f.write(proxy_url)
+
+    def _reapply_http_proxy(self):
+        # The VM just lost its settings, e.g. to a snapshot from before we set them.
+        proxy_url, self._http_proxy = self._http_proxy, None
+        if proxy_url is not None:
+            self.set_http_proxy(proxy_url)
+
+    def _push_files(self, root, changed, removed):
+        remote_command = 'mkdir -p %s && cd %s' % (
+            pipes.quote(self._synced_guest_path), pipes.quote(self._synced_guest_path))
+        if removed:
+            remote_command += ' && rm -f -- ' + ' '.join(pipes.quote(path) for path in removed)
+        if changed:
+            remote_command += ' && tar -xf -'
+        file_list = tempfile.NamedTemporaryFile()
+        file_list.write(b''.join(path.encode('utf-8') + b'\0' for path in changed))
+        file_list.flush()
+        with open(os.devnull, 'r') as devnull:
+            tar = None
+            if changed:
+                tar = subprocess.Popen(
+                    ['tar', '-C', root, '--dereference', '--null', '-T', file_list.name,
+                     '-cf', '-'],
+                    stdout=subprocess.PIPE)
+            ssh = subprocess.Popen(self.ssh_argv(remote_command),
+                                   stdin=tar.stdout if tar else devnull)
+            if tar:
+                # Let tar see a broken pipe if ssh exits early.
+                tar.stdout.close()
+            ssh_status = ssh.wait()
+            tar_status = tar.wait() if tar else 0
+        file_list.close()
+        if ssh_status != 0 or tar_status != 0:
+            self._forget_synced_manifest()
+            raise Exception('Failed to push files to %s (tar exited %d, ssh exited %d)' % (
+                self._name, tar_status, ssh_status))
+
+    def _ssh_config_filename(self):
+        '''Return the path to this box's `vagrant ssh-config` output, fetching it if needed.
+
+        Returns None if Vagrant could not give us an SSH config, in which case callers should fall
+        back to `vagrant ssh`.'''
+        with self._ssh_config_lock:
+            if self._name not in self._ssh_config_filenames_by_name:
+                filename = os.path.join(state_dir('ssh'), self._name + '.config')
+                try:
+                    output = self._fetch_ssh_config()
+                except Exception as e:
+                    print_warn('** Warning: could not get ssh-config for', self._name)
+                    print_warn(e)
+                    filename = None
+                else:
+                    with open(filename, 'w') as f:
+                        f.write(output.encode('utf-8'))
+                self._ssh_config_filenames_by_name[self._name] = filename
+            return self._ssh_config_filenames_by_name[self._name]
+
+    def _fetch_ssh_config(self):
+        return self._command_runner(['vagrant', 'ssh-config', self._name])
+
+    def _ssh_options(self, config_filename):
+        # The ControlPath socket has to fit in a sockaddr_un, so keep it short; %C is a hash of
+        # the host, port and user.
+        control_path = os.path.join(tempfile.gettempdir(), 'stodgy-tester-ssh-%C')
+        return [
+            '-F', config_filename,
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=' + control_path,
+            '-o', 'ControlPersist=10m',
+        ]
+
+    def ssh_argv(self, command_as_str, tty=False):
+        '''Return an argv that runs a shell command inside this VM.
+
+        The command goes over a multiplexed SSH connection that stays open between calls, so only
+        the first command to this box pays for the SSH handshake. Pass tty=True for interactive
+        sessions, e.g. ones driven by pexpect.'''
+        config_filename = self._ssh_config_filename()
+        if config_filename is None:
+            return ['vagrant', 'ssh', self._name, '-c', command_as_str]
+        return (['ssh'] + self._ssh_options(config_filename) + ['-t' if tty else '-T'] +
+                [self._name, command_as_str])
+
+    def _close_ssh_connection(self, forget_config=False):
+        '''Shut down the shared SSH connection, if any, e.g. because the VM is going away.
+
+        Pass forget_config=True if the VM's address may change, so the SSH config is re-fetched.'''
+        with self._ssh_config_lock:
+            config_filename = self._ssh_config_filenames_by_name.get(self._name)
+            if forget_config:
+                self._ssh_config_filenames_by_name.pop(self._name, None)
+        if config_filename is None:
+            return
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(
+                ['ssh'] + self._ssh_options(config_filename) + ['-O', 'exit', self._name],
+                stdout=devnull, stderr=devnull)
 
     def up_or_resume_if_needed(self):
         "Ask Vagrant to attempt to resume this VM, and if that doesn't work, then boot it fresh."
         if self._cached_box_seems_up:
             return
-        # First, try doing vagrant resume.
+        return self._up_or_resume()
+
+    @_traced_vm_operation
+    def _up_or_resume(self):
+        # If we know what state the box is in, run only the command it needs.
+        state = self._get_state()
+        if state == VagrantStateTracker.RUNNING:
+            self._cached_box_seems_up = True
+            return
+        if state in [VagrantStateTracker.NOT_CREATED, VagrantStateTracker.POWEROFF]:
+            return self._up()
+        if state == VagrantStateTracker.SAVED:
+            try:
+                output = self._command_runner(['vagrant', 'resume', self._name])
+                self._cached_box_seems_up = True
+                self._set_state(VagrantStateTracker.RUNNING)
+                return output
+            except Exception as e:
+                print_warn("** Warning: exception during vagrant resume", self._name)
+                print_warn("Going to do vagrant up instead.")
+                print_warn(e)
+                return self._up()
+
+        # Otherwise, first, try doing vagrant resume.
         try:
             output = self._command_runner(['vagrant', 'resume', self._name])
             if (
@@ -138,6 +1184,7 @@ class VirtualMachine(object):
                 pass  # Still need to vagrant up.
             else:
                 self._cached_box_seems_up = True
+                self._set_state(VagrantStateTracker.RUNNING)
                 return output
         except Exception as e:
             print_warn("** Warning: exception during vagrant resume", self._name)
@@ -146,16 +1193,242 @@ class VirtualMachine(object):
 
         # Then, always do "vagrant up", since it should be a no-up if the VM is already up, and if
         # the VM isn't up, then we bring it up.
+        return self._up()
+
+    def _up(self):
         output = self._command_runner(['vagrant', 'up', self._name])
         self._cached_box_seems_up = True
+        self._set_state(VagrantStateTracker.RUNNING)
         return output
 
+    @_traced_vm_operation
     def destroy_then_start(self):
         '''Ask Vagrant to remove all stored files on-disk related to this VM, then recreate it.
 
         Useful if the VM gets into some horrific state. No one should ever need this, yet I need it
         frequently. That's life, I guess.
         '''
+        self._close_ssh_connection(forget_config=True)
+        self._forget_synced_manifest()
+        self.forget_known_states()
         self._command_runner(['vagrant', 'destroy', '-f', self._name])
         self._cached_box_seems_up = False
-        return self.up_or_resume_if_needed()
+        self._set_state(VagrantStateTracker.NOT_CREATED)
+        output = self.up_or_resume_if_needed()
+        self._reapply_http_proxy()
+        return output
+
+    BASELINE_SNAPSHOT_NAME = 'stodgy-tester-baseline'
+
+    def has_snapshot(self, snapshot_name):
+        try:
+            output = self._command_runner(['vagrant', 'snapshot', 'list', self._name])
+        except Exception:
+            # e.g. the VM has not been created yet.
+            return False
+        return snapshot_name in [line.strip() for line in output.splitlines()]
+
+    @_traced_vm_operation
+    def save_snapshot(self, snapshot_name):
+        '''Ask Vagrant to take a snapshot of this VM. With libvirt, this is a qemu internal
+        snapshot, so it includes the running VM's memory.'''
+        self.up_or_resume_if_needed()
+        self._command_runner(['vagrant', 'snapshot', 'save', self._name, snapshot_name])
+
+    @_traced_vm_operation
+    def restore_snapshot(self, snapshot_name):
+        '''Roll this VM back to a snapshot, which takes seconds rather than minutes.'''
+        # The guest's side of any open SSH connection is about to be rolled back, too, as are the
+        # files we synced.
+        self._close_ssh_connection()
+        self._forget_synced_manifest()
+        self.forget_known_states()
+        self._command_runner(
+            ['vagrant', 'snapshot', 'restore', '--no-provision', self._name, snapshot_name])
+        self._cached_box_seems_up = False
+        # Whether the VM comes back running depends on the snapshot, so ask again later.
+        self._set_state(None)
+        self.up_or_resume_if_needed()
+        self._reapply_http_proxy()
+        if self._has_been_rsynced:
+            self.rsync()
+
+    @_traced_vm_operation
+    def reset_to_baseline(self):
+        '''Put this VM back into a pristine state.
+
+        The first time, this rebuilds the VM from scratch and saves a baseline snapshot of it; after
+        that, it just restores the snapshot.'''
+        if self.has_snapshot(self.BASELINE_SNAPSHOT_NAME):
+            print_info('** Restoring baseline snapshot of', self._name)
+            self.restore_snapshot(self.BASELINE_SNAPSHOT_NAME)
+            return
+        print_info('** No baseline snapshot of', self._name, 'yet; rebuilding it to take one')
+        self.destroy_then_start()
+        self.save_snapshot(self.BASELINE_SNAPSHOT_NAME)
+        if self._has_been_rsynced:
+            self.rsync()
+
+
+class LocalProcessMachine(Machine):
+    '''A machine that is just a directory on this host, where bash runs each command.
+
+    It is ready in milliseconds, so it suits tests that only check what a script says, not what it
+    does to a real system. The directory is $HOME and the working directory for every command, and
+    rsync copies the current directory to vagrant/ inside it. Nothing isolates it from the rest of
+    the host, so its tests must not need root.'''
+    def __init__(self, name, command_runner):
+        super(LocalProcessMachine, self).__init__(name, command_runner)
+        self._root = state_path('local-machines', name)
+        self._has_been_rsynced = False
+
+    def up_or_resume_if_needed(self):
+        _makedirs(self._root)
+
+    def suspend(self):
+        # Nothing keeps running between commands, so there is nothing to suspend.
+        pass
+
+    def stop(self):
+        self.forget_known_states()
+
+    @_traced_vm_operation
+    def destroy_then_start(self):
+        self.forget_known_states()
+        shutil.rmtree(self._root, ignore_errors=True)
+        self.up_or_resume_if_needed()
+
+    def reset_to_baseline(self):
+        self.destroy_then_start()
+        if self._has_been_rsynced:
+            self.rsync()
+
+    @_traced_vm_operation
+    def rsync(self):
+        self.up_or_resume_if_needed()
+        destination = os.path.join(self._root, 'vagrant')
+        shutil.rmtree(destination, ignore_errors=True)
+        shutil.copytree(os.getcwd(), destination, symlinks=True,
+                        ignore=shutil.ignore_patterns(*SYNCED_TREE_EXCLUDES))
+        self._has_been_rsynced = True
+
+    def ssh_argv(self, command_as_str, tty=False):
+        return ['env', 'HOME=' + self._root, 'bash', '-c',
+                'cd "$HOME" || exit 1\n' + command_as_str]
+
+
+def host_memory_mb():
+    '''Return the amount of physical RAM on this host, in megabytes.'''
+    return os.sysconf(str('SC_PHYS_PAGES')) * os.sysconf(str('SC_PAGE_SIZE')) // (1024 * 1024)
+
+
+class MemoryBudget(object):
+    '''Admit VMs only while their combined RAM fits under a budget.
+
+    Callers say how much RAM they expect their VM to use, and acquire() blocks until that much is
+    free. A VM larger than the whole budget is still allowed to run, but only on its own.
+    '''
+    def __init__(self, budget_mb):
+        self._budget_mb = budget_mb
+        self._in_use_mb = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, cost_mb):
+        with self._condition:
+            while self._in_use_mb and (self._in_use_mb + cost_mb > self._budget_mb):
+                self._condition.wait()
+            self._in_use_mb += cost_mb
+
+    def release(self, cost_mb):
+        with self._condition:
+            self._in_use_mb -= cost_mb
+            self._condition.notify_all()
+
+    def in_use_mb(self):
+        with self._condition:
+            return self._in_use_mb
+
+
+class ResidentVMCache(object):
+    '''Keep the most recently used VMs running, and evict the rest.
+
+    use() returns the VirtualMachine for a box, creating it the first time, and marks it as the
+    most recently used. Once more than max_live_vms boxes are live, the least recently used ones
+    are passed to evict(), which typically suspends or halts them. So a run that goes back and
+    forth between a few boxes, e.g. in --prioritize order or as a --worker, keeps them warm.
+    '''
+    def __init__(self, create_vm, max_live_vms, evict):
+        self._create_vm = create_vm
+        self._max_live_vms = max(1, max_live_vms)
+        self._evict = evict
+        self._vms_by_name = {}
+        # Least recently used first.
+        self._live_names = []
+
+    def get(self, name):
+        '''Return the VirtualMachine for a box, without marking it as used.'''
+        if name not in self._vms_by_name:
+            self._vms_by_name[name] = self._create_vm(name)
+        return self._vms_by_name[name]
+
+    def is_live(self, name):
+        return name in self._live_names
+
+    def live_vms(self):
+        '''Return the live VMs, least recently used first.'''
+        return [self._vms_by_name[name] for name in self._live_names]
+
+    def use(self, name):
+        vm = self.get(name)
+        if name in self._live_names:
+            self._live_names.remove(name)
+        self._live_names.append(name)
+        while len(self._live_names) > self._max_live_vms:
+            self._evict(self._vms_by_name[self._live_names.pop(0)])
+        return vm
+
+
+class BackgroundLifecycle(object):
+    '''Run slow VM lifecycle operations, like booting and suspending, on background threads.
+
+    Operations on the same box run one at a time, in the order they were started, so a caller only
+    has to wait() for a box before using it. Operations on different boxes run at the same time.
+    '''
+    def __init__(self):
+        self._threads_by_name = {}
+        self._errors_by_name = {}
+        self._lock = threading.Lock()
+
+    def start(self, name, description, function):
+        '''Call function() in the background, once earlier operations on box `name` finish.'''
+        def run(previous_thread):
+            if previous_thread is not None:
+                previous_thread.join()
+            try:
+                function()
+            except Exception as e:
+                print_warn('** Warning: background', description, 'of', name, 'failed:', e)
+                with self._lock:
+                    self._errors_by_name[name] = e
+
+        with self._lock:
+            thread = threading.Thread(target=run, args=(self._threads_by_name.get(name),))
+            thread.daemon = True
+            self._threads_by_name[name] = thread
+        thread.start()
+
+    def wait(self, name):
+        '''Wait for every operation started on box `name`.
+
+        Returns the exception from the last one that failed, or None if they all worked.'''
+        with self._lock:
+            thread = self._threads_by_name.get(name)
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            return self._errors_by_name.pop(name, None)
+
+    def wait_all(self):
+        with self._lock:
+            names = list(self._threads_by_name)
+        return dict((name, self.wait(name)) for name in names)
@@ -0,0 +1,423 @@
+'''A caching HTTP proxy on the host, so VMs don't download the same packages over and over.
+
+Installer tests purge and reinstall packages on every run, on every box. With --package-cache,
+stodgy-tester serves this proxy for the length of the run and points each VM's package manager at
+it, so each package file is only downloaded once. A .deb or .rpm never changes once it is
+published, so it is served from the cache without asking upstream again. Other cacheable files,
+i.e. tarballs, are served from the cache while their Cache-Control max-age allows, and after that
+only once upstream confirms, via ETag or Last-Modified, that they haven't changed. Anything else,
+such as repository metadata, is passed through uncached so that it never goes stale. https
+repositories are tunnelled with CONNECT, uncached.
+
+Only VMs may use the proxy, and only to reach the internet: it refuses upstreams on loopback,
+private and link-local addresses, so it can't be used to reach the host's or its network's own
+services.
+'''
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+)
+import BaseHTTPServer
+import hashlib
+import httplib
+import json
+import os
+import select
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+import urlparse
+
+# Headers that describe one connection rather than the resource, plus ones that
+# BaseHTTPRequestHandler.send_response() sends itself.
+_SKIPPED_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'proxy-connection',
+    'te', 'trailers', 'transfer-encoding', 'upgrade', 'date', 'server',
+])
+
+# The client's own conditional headers, which we replace with ours when revalidating.
+_CONDITIONAL_HEADERS = frozenset([
+    'if-modified-since', 'if-none-match', 'if-range', 'range',
+])
+
+
+def _is_private_address(address):
+    '''Return True for addresses that are not on the public internet: loopback, private,
+    link-local and unspecified IPv4 and IPv6 addresses. That is where VMs on this host are, and
+    where the host's and its network's own services are.'''
+    octets = None
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            octets = bytearray(socket.inet_pton(family, address))
+            break
+        except (socket.error, ValueError):
+            pass
+    if octets is None:
+        # Not an IP address at all, so we can't say where it is.
+        return True
+    if len(octets) == 16:
+        if octets[:12] == bytearray(10) + bytearray(b'\xff\xff'):
+            # An IPv4-mapped address.
+            octets = octets[12:]
+        else:
+            return (octets[:15] == bytearray(15) or  # :: and ::1
+                    octets[0] & 0xfe == 0xfc or  # fc00::/7, unique local
+                    (octets[0] == 0xfe and octets[1] & 0xc0 == 0x80))  # fe80::/10, link-local
+    return (octets[0] in [0, 10, 127] or (octets[0] == 172 and 16 <= octets[1] < 32) or
+            octets[:2] == bytearray([192, 168]) or octets[:2] == bytearray([169, 254]))
+
+
+class ForbiddenUpstream(Exception):
+    pass
+
+
+def _freshness_lifetime(response):
+    '''Return how many seconds a response may be served from the cache without revalidating it,
+    or None if it must not be cached at all.'''
+    directives = [directive.strip().lower()
+                  for directive in (response.getheader('cache-control') or '').split(',')]
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                return max(0, int(directive[len('max-age='):]))
+            except ValueError:
+                return 0
+    return 0
+
+
+class _ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Set by PackageCache.start().
+    package_cache = None
+
+    def do_GET(self):
+        self._proxy()
+
+    def do_HEAD(self):
+        self._proxy()
+
+    def do_CONNECT(self):
+        '''Tunnel to an https upstream, e.g. for a yum or dnf repository.'''
+        if not _is_private_address(self.client_address[0]):
+            self.send_error(403, 'Only VMs on this host may use this proxy')
+            return
+        cache = self.package_cache
+        host, _, port = self.path.rpartition(':')
+        if port not in [str(allowed) for allowed in cache.TUNNEL_PORTS]:
+            self.send_error(403, 'Only https may be tunnelled')
+            return
+        try:
+            family, address = cache.resolve_upstream(host.strip('[]'), int(port))
+            upstream = socket.socket(family, socket.SOCK_STREAM)
+            upstream.settimeout(PackageCache.UPSTREAM_TIMEOUT)
+            upstream.connect(address)
+        except ForbiddenUpstream as e:
+            self.send_error(403, str(e))
+            return
+        except socket.error as e:
+            cache._count(errors=1)
+            self.send_error(502, str(e))
+            return
+        self.close_connection = 1
+        try:
+            self.send_response(200, 'Connection established')
+            self.end_headers()
+            cache._count(tunnels=1)
+            # The client waits for our response before it starts TLS, so nothing it sent is
+            # still sitting in self.rfile's buffer.
+            self._relay(upstream)
+        except socket.error:
+            cache._count(errors=1)
+        finally:
+            upstream.close()
+
+    def _relay(self, upstream):
+        peers = {self.connection: upstream, upstream: self.connection}
+        while True:
+            readable = select.select(list(peers), [], [], PackageCache.UPSTREAM_TIMEOUT)[0]
+            if not readable:
+                return
+            for sock in readable:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                peers[sock].sendall(data)
+
+    def log_message(self, format, *args):
+        # Package managers make hundreds of requests; the summary at the end is enough.
+        pass
+
+    def _proxy(self):
+        if not _is_private_address(self.client_address[0]):
+            self.send_error(403, 'Only VMs on this host may use this proxy')
+            return
+        url = self.path
+        if not url.startswith('http://'):
+            self.send_error(400, 'Only absolute http:// URLs can be proxied')
+            return
+
+        cache = self.package_cache
+        cacheable = self.command == 'GET' and cache.is_cacheable(url)
+        filename = cache.cache_filename(url)
+        cached = cache.read_metadata(filename) if cacheable else None
+        if cached is not None and cache.is_fresh(url, cached):
+            self._send_cached(filename)
+            return
+
+        try:
+            connection, response = self._fetch(url, cached)
+        except ForbiddenUpstream as e:
+            self.send_error(403, str(e))
+            return
+        except (socket.error, httplib.HTTPException) as e:
+            cache._count(errors=1)
+            self.send_error(502, str(e))
+            return
+        try:
+            if cached is not None and response.status == 304:
+                cache.write_metadata(filename, url, response, previous=cached)
+                self._send_cached(filename)
+                return
+            self.send_response(response.status, response.reason)
+            for name, value in response.getheaders():
+                if name.lower() not in _SKIPPED_HEADERS:
+                    self.send_header(name, value)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            if self.command == 'HEAD':
+                return
+            if cacheable and response.status == 200 and _freshness_lifetime(response) is not None:
+                cache._count(misses=1)
+                self._copy_to_cache(response, filename, url)
+            else:
+                cache._count(uncached=1, bytes_from_network=self._copy(response))
+        except (socket.error, IOError):
+            # e.g. the client hung up, or the server did; either way, the client will retry.
+            cache._count(errors=1)
+        finally:
+            connection.close()
+
+    def _fetch(self, url, cached=None):
+        '''Send this request upstream, conditional on the cached copy's validators, if any.'''
+        parts = urlparse.urlsplit(url)
+        port = parts.port or 80
+        # Connect to the address we checked, rather than letting httplib look the name up again.
+        family, address = self.package_cache.resolve_upstream(parts.hostname, port)
+        host = address[0] if family == socket.AF_INET else '[%s]' % (address[0],)
+        connection = httplib.HTTPConnection(host, port, timeout=PackageCache.UPSTREAM_TIMEOUT)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        skipped_headers = _SKIPPED_HEADERS
+        if cached is not None:
+            skipped_headers = skipped_headers | _CONDITIONAL_HEADERS
+        headers = dict((name, value) for name, value in self.headers.items()
+                       if name.lower() not in skipped_headers)
+        if not any(name.lower() == 'host' for name in headers):
+            headers['Host'] = parts.netloc
+        if cached is not None and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached is not None and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        # One request per connection keeps the bookkeeping simple.
+        headers['Connection'] = 'close'
+        connection.request(self.command, path, headers=headers)
+        return connection, connection.getresponse()
+
+    def _copy(self, response, cache_file=None, before_last_chunk=None):
+        '''Send the response body to the client, and to cache_file, if given. Returns its length.
+
+        before_last_chunk(length) is called once the whole body is read, before the client has
+        all of it.'''
+        length = 0
+        pending = b''
+        while True:
+            chunk = response.read(65536)
+            if not chunk:
+                break
+            length += len(chunk)
+            if cache_file is not None:
+                cache_file.write(chunk)
+            self.wfile.write(pending)
+            pending = chunk
+        if before_last_chunk is not None:
+            before_last_chunk(length)
+        self.wfile.write(pending)
+        return length
+
+    def _copy_to_cache(self, response, filename, url):
+        # Write to a temporary file, so a download cut short is never served from the cache. It
+        # goes into the cache before the client gets the last chunk, so that asking again straight
+        # away is a hit.
+        cache_file = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(filename), prefix='.download-', delete=False)
+
+        def commit(length):
+            cache_file.close()
+            expected_length = response.getheader('content-length')
+            if expected_length is not None and int(expected_length) != length:
+                raise IOError('Expected %s bytes but got %d' % (expected_length, length))
+            os.rename(cache_file.name, filename)
+            self.package_cache.write_metadata(filename, url, response)
+            self.package_cache._count(bytes_from_network=length)
+
+        try:
+            self._copy(response, cache_file, before_last_chunk=commit)
+        except Exception:
+            cache_file.close()
+            if os.path.exists(cache_file.name):
+                os.unlink(cache_file.name)
+            raise
+
+    def _send_cached(self, filename):
+        with open(filename, 'rb') as f:
+            length = os.fstat(f.fileno()).st_size
+            self.package_cache._count(hits=1, bytes_from_cache=length)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+
+class PackageCache(object):
+    '''A caching HTTP proxy for package downloads, listening on host, with its cache in cache_dir.
+
+    host should be the address VMs reach this host at, e.g. the libvirt network's gateway, so that
+    nothing else can connect to it. Only private addresses may use it, and unless
+    allow_private_upstreams is set, it only fetches from public ones.'''
+    CACHEABLE_SUFFIXES = (
+        '.deb', '.udeb', '.rpm', '.drpm', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz',
+    )
+    # Served from the cache without revalidating: a package's file name includes its version.
+    IMMUTABLE_SUFFIXES = ('.deb', '.udeb', '.rpm', '.drpm')
+    TUNNEL_PORTS = (443,)
+    UPSTREAM_TIMEOUT = 60
+
+    def __init__(self, cache_dir, host, port=0, allow_private_upstreams=False):
+        self._cache_dir = cache_dir
+        self._host = host
+        self._port = port
+        self._allow_private_upstreams = allow_private_upstreams
+        self._server = None
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'uncached': 0,
+            'tunnels': 0,
+            'errors': 0,
+            'bytes_from_cache': 0,
+            'bytes_from_network': 0,
+        }
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, url):
+        return urlparse.urlsplit(url).path.endswith(self.CACHEABLE_SUFFIXES)
+
+    def cache_filename(self, url):
+        return os.path.join(self._cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def read_metadata(self, filename):
+        '''Return what we know about a cached file (its validators and when it goes stale), or
+        None if it isn't cached.'''
+        try:
+            with open(filename + '.json') as f:
+                metadata = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(filename):
+            return None
+        return metadata
+
+    def write_metadata(self, filename, url, response, previous=None):
+        previous = previous or {}
+        lifetime = _freshness_lifetime(response) or 0
+        metadata = {
+            'url': url,
+            # A 304 need not repeat the validators, in which case the old ones still hold.
+            'etag': response.getheader('etag') or previous.get('etag'),
+            'last_modified': (response.getheader('last-modified') or
+                              previous.get('last_modified')),
+            'fresh_until': time.time() + lifetime,
+        }
+        temporary_filename = '%s.json.%d.tmp' % (filename, threading.current_thread().ident)
+        with open(temporary_filename, 'w') as f:
+            json.dump(metadata, f)
+        os.rename(temporary_filename, filename + '.json')
+
+    def is_fresh(self, url, metadata):
+        '''Return True if a cached file may be served without asking upstream first.'''
+        if urlparse.urlsplit(url).path.endswith(self.IMMUTABLE_SUFFIXES):
+            return True
+        return metadata['fresh_until'] > time.time()
+
+    def resolve_upstream(self, hostname, port):
+        '''Look up hostname, and return (socket_family, address) to connect to.
+
+        Raises ForbiddenUpstream if it is on a private address, and we don't allow that.'''
+        infos = socket.getaddrinfo(hostname, port, 0, socket.SOCK_STREAM)
+        if not infos:
+            raise socket.error('Could not resolve %s' % (hostname,))
+        if not self._allow_private_upstreams:
+            for info in infos:
+                if _is_private_address(info[4][0]):
+                    raise ForbiddenUpstream('%s is not on the public internet' % (hostname,))
+        family, address = infos[0][0], infos[0][4]
+        return family, address
+
+    def _count(self, **increments):
+        with self._lock:
+            for name, increment in increments.items():
+                self._stats[name] += increment
+
+    def start(self):
+        '''Start serving on a background thread. Returns the port the proxy listens on.'''
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+        cache = self
+
+        class Handler(_ProxyRequestHandler):
+            package_cache = cache
+
+        self._server = _ProxyServer((self._host, self._port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, name='package-cache')
+        thread.daemon = True
+        thread.start()
+        return self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        '''Return a dict with counts of hits, misses, uncached requests, tunnels and errors, and
+        the bytes_from_cache and bytes_from_network.'''
+        with self._lock:
+            return dict(self._stats)
+
+    def summary(self):
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        return ('%d hits, %d misses (%d%% hit rate), %d uncached requests, %d tunnels, %d errors; '
+                '%.1f MiB served from the cache, %.1f MiB downloaded' % (
+                    stats['hits'], stats['misses'],
+                    100 * stats['hits'] // lookups if lookups else 0,
+                    stats['uncached'], stats['tunnels'], stats['errors'],
+                    stats['bytes_from_cache'] / 1048576.0,
+                    stats['bytes_from_network'] / 1048576.0))
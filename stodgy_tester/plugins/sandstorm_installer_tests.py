@@ -6,6 +6,7 @@ from __future__ import (
 import stodgy_tester.helpers
 
 
+@stodgy_tester.helpers.produces_state('sandstorm-not-installed')
 def uninstall_sandstorm(box):
     stodgy_tester.helpers.print_info('** Uninstalling Sandstorm from', box._name)
     shell_command_list = [
@@ -31,19 +32,19 @@ def uninstall_sandstorm(box):
     box.run_command_within_vm(as_text)
 
 
+@stodgy_tester.helpers.checks_state('sandstorm-not-installed')
 def sandstorm_not_installed(box):
     stodgy_tester.helpers.print_info(
-        '** Making sure Sandstorm not currently installed on', box._name)
-    shell_command_list = [
-        'if [ -e ~/sandstorm ] ; then exit 1 ; fi',
-        'if [ -e /opt/sandstorm ] ; then exit 1 ; fi',
-    ]
-    as_text = ' && '.join([('( ' + x + ' )') for x in shell_command_list])
-    box.run_command_within_vm(as_text)
-    stodgy_tester.helpers.print_info(
-        '** Making sure Postfix not currently installed on', box._name)
-    shell_command_list = [
-        'if [ -e /etc/postfix/main.cf ] ; then exit 1 ; fi',
+        '** Making sure Sandstorm and Postfix not currently installed on', box._name)
+    paths_that_should_not_exist = [
+        '~/sandstorm',
+        '/opt/sandstorm',
+        '/etc/postfix/main.cf',
     ]
-    as_text = ' && '.join([('( ' + x + ' )') for x in shell_command_list])
-    box.run_command_within_vm(as_text)
+    results = box.run_probes(
+        ['if [ -e %s ] ; then exit 1 ; fi' % (path,) for path in paths_that_should_not_exist])
+    found = [path for path, (status, output) in zip(paths_that_should_not_exist, results)
+             if status != 0]
+    if found:
+        raise Exception('Found leftovers of a previous install on %s: %s' % (
+            box._name, ', '.join(found)))
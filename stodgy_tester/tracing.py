@@ -0,0 +1,231 @@
+'''Record where the time in a stodgy-tester run goes.
+
+Slow work is wrapped in span(category, name), and every listener gets an event when a span ends.
+The categories are:
+
+- test: one whole *.t file.
+- precondition, script, postcondition, cleanup: the phases of a test.
+- plugin: one plugin function, e.g. a precondition or cleanup.
+- vm: a VM lifecycle operation, e.g. booting, suspending or restoring a snapshot.
+- vagrant, ssh, command: one subprocess. An ssh span for a test script's $[run] lasts until its
+  $[exitcode] or the end of the script.
+- expect: waiting for one line of a test script's output.
+
+Spans nest, e.g. a vm span contains the vagrant commands it ran, so categories overlap. A span
+inside another span of the same category is marked as nested, so it is not counted twice.
+
+Two listeners come built in. ChromeTrace writes Chrome's trace-event JSON, which you can open at
+chrome://tracing or https://ui.perfetto.dev. TimingReport adds up how long each test spent in each
+category.
+'''
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+)
+import contextlib
+import ctypes
+import ctypes.util
+import json
+import os
+import sys
+import threading
+import time
+
+
+def _monotonic_clock():
+    '''Return a function like Python 3's time.monotonic(), so that durations and deadlines
+    don't jump when NTP steps the wall clock.
+
+    Python 2 has none, so we call clock_gettime(CLOCK_MONOTONIC) through ctypes. Only where
+    that isn't available do we fall back to the wall clock.'''
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_monotonic = 6 if sys.platform == 'darwin' else 1
+    # Older glibc keeps clock_gettime() in librt.
+    for library_name in ['c', 'rt']:
+        library_path = ctypes.util.find_library(library_name)
+        try:
+            clock_gettime = ctypes.CDLL(library_path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+
+        def monotonic():
+            now = timespec()
+            if clock_gettime(clock_monotonic, ctypes.byref(now)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return now.tv_sec + now.tv_nsec * 1e-9
+
+        try:
+            monotonic()
+        except OSError:
+            continue
+        return monotonic
+    return time.time
+
+
+clock = _monotonic_clock()
+
+_listeners = []
+_listeners_lock = threading.Lock()
+# The test that spans on this thread belong to.
+_context = threading.local()
+
+
+def add_listener(listener):
+    '''Call listener(event) for every span that ends from now on.
+
+    Events are dicts with category, name, start and duration (in seconds, from clock()), thread,
+    thread_id, test (the filename of the test the span is part of, if any), failed, nested and
+    args. Listeners can be called from any thread.'''
+    with _listeners_lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    with _listeners_lock:
+        _listeners.remove(listener)
+
+
+class Span(object):
+    '''One timed piece of work. Most code should use span() instead.'''
+    def __init__(self, category, name, args):
+        self.category = category
+        self.name = name
+        self.args = args
+        if category == 'test':
+            self._parent_test = getattr(_context, 'test', None)
+            _context.test = name
+            self.test = name
+        else:
+            self.test = getattr(_context, 'test', None)
+        if not hasattr(_context, 'open_categories'):
+            _context.open_categories = []
+        self.nested = category in _context.open_categories
+        _context.open_categories.append(category)
+        self.start = clock()
+        self._ended = False
+
+    def end(self, failed=False):
+        if self._ended:
+            return
+        self._ended = True
+        duration = clock() - self.start
+        if self.category == 'test':
+            _context.test = self._parent_test
+        _context.open_categories.remove(self.category)
+        with _listeners_lock:
+            listeners = list(_listeners)
+        if not listeners:
+            return
+        thread = threading.current_thread()
+        event = {
+            'category': self.category,
+            'name': self.name,
+            'start': self.start,
+            'duration': duration,
+            'thread': thread.name,
+            'thread_id': thread.ident,
+            'test': self.test,
+            'failed': failed,
+            'nested': self.nested,
+            'args': self.args,
+        }
+        for listener in listeners:
+            listener(event)
+
+
+def start_span(category, name, **args):
+    '''Start a span that has to outlive a `with` block. Call its end() when the work is done.'''
+    return Span(category, name, args)
+
+
+@contextlib.contextmanager
+def span(category, name, **args):
+    '''Time the body of a `with` block.'''
+    current_span = Span(category, name, args)
+    try:
+        yield current_span
+    except BaseException:
+        current_span.end(failed=True)
+        raise
+    current_span.end()
+
+
+class ChromeTrace(object):
+    '''Collect spans, and write them in Chrome's trace-event format.'''
+    def __init__(self):
+        self._events = []
+        self._thread_names = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        args = dict(event['args'])
+        if event['test']:
+            args['test'] = event['test']
+        if event['failed']:
+            args['failed'] = True
+        with self._lock:
+            self._thread_names[event['thread_id']] = event['thread']
+            self._events.append({
+                'name': event['name'],
+                'cat': event['category'],
+                'ph': 'X',
+                'ts': event['start'] * 1e6,
+                'dur': event['duration'] * 1e6,
+                'pid': os.getpid(),
+                'tid': event['thread_id'],
+                'args': args,
+            })
+
+    def write(self, filename):
+        with self._lock:
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread_id,
+                       'args': {'name': thread_name}}
+                      for thread_id, thread_name in sorted(self._thread_names.items())]
+            events.extend(sorted(self._events, key=lambda event: event['ts']))
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class TimingReport(object):
+    '''Add up how many seconds each test spent in each category of span.'''
+    def __init__(self):
+        self._tests = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def _entry(self, test):
+        if test not in self._tests:
+            self._tests[test] = {'test': test, 'seconds': None, 'passed': None, 'categories': {}}
+            self._order.append(test)
+        return self._tests[test]
+
+    def __call__(self, event):
+        if not event['test'] or event['nested']:
+            return
+        with self._lock:
+            entry = self._entry(event['test'])
+            if event['category'] == 'test':
+                entry['seconds'] = event['duration']
+                entry['passed'] = not event['failed']
+                return
+            categories = entry['categories']
+            categories[event['category']] = (
+                categories.get(event['category'], 0.0) + event['duration'])
+
+    def tests(self):
+        '''Return a list with a dict for each test, in the order they started.'''
+        with self._lock:
+            return [dict(self._tests[test]) for test in self._order]
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'tests': self.tests()}, f, indent=2, sort_keys=True)
@@ -0,0 +1,138 @@
+'''Drive libvirt boxes with virsh instead of Vagrant, where that is safe.
+
+Every `vagrant` command starts a Ruby interpreter and evaluates the Vagrantfile before it does any
+work, which often takes longer than suspending or resuming the VM itself. vagrant-libvirt keeps the
+libvirt domain's UUID in .vagrant/machines/NAME/libvirt/id, so once a box exists we can find its
+domain without asking Vagrant, and pause, resume, check and shut it down with virsh.
+'''
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+)
+import glob
+import os
+import time
+import stodgy_tester.helpers
+
+VIRSH = ['virsh', '-c', os.environ.get('LIBVIRT_DEFAULT_URI', 'qemu:///system')]
+
+# What `virsh domstate` says, in VagrantStateTracker's terms. Any other state (e.g. "in shutdown")
+# is left to Vagrant.
+_DOMAIN_STATES = {
+    'running': stodgy_tester.helpers.VagrantStateTracker.RUNNING,
+    'idle': stodgy_tester.helpers.VagrantStateTracker.RUNNING,
+    'blocked': stodgy_tester.helpers.VagrantStateTracker.RUNNING,
+    'paused': stodgy_tester.helpers.VagrantStateTracker.SAVED,
+    'shut off': stodgy_tester.helpers.VagrantStateTracker.POWEROFF,
+    'crashed': stodgy_tester.helpers.VagrantStateTracker.POWEROFF,
+}
+
+
+def libvirt_box_names():
+    '''Return the name of every box in the current directory that vagrant-libvirt has created.'''
+    return sorted(os.path.basename(os.path.dirname(os.path.dirname(filename)))
+                  for filename in glob.glob(os.path.join('.vagrant', 'machines', '*', 'libvirt',
+                                                         'id')))
+
+
+class LibvirtVirtualMachine(stodgy_tester.helpers.VirtualMachine):
+    '''A VirtualMachine that suspends, resumes and shuts down its libvirt domain with virsh.
+
+    Creating a box, booting it from power-off (which also runs Vagrant's synced folders and
+    provisioners) and destroying it still go through Vagrant, as does everything while the box has
+    no domain, or if virsh fails.'''
+    # How long the guest gets to shut down cleanly before it is powered off.
+    SHUTDOWN_TIMEOUT = 120
+
+    def _virsh(self, *argv):
+        return self._command_runner(VIRSH + list(argv))
+
+    def domain_state(self):
+        '''Ask libvirt for the box's state. Returns None if virsh can't tell us.'''
+        domain = self._machine_id()
+        if domain is None:
+            return stodgy_tester.helpers.VagrantStateTracker.NOT_CREATED
+        try:
+            output = self._virsh('domstate', domain)
+        except Exception as e:
+            stodgy_tester.helpers.print_warn(
+                '** Warning: could not get the state of', self._name, e)
+            return None
+        return _DOMAIN_STATES.get(output.strip())
+
+    @stodgy_tester.helpers._traced_vm_operation
+    def _up_or_resume(self):
+        state = self._get_state()
+        if state is None:
+            state = self.domain_state()
+        if state == stodgy_tester.helpers.VagrantStateTracker.RUNNING:
+            self._cached_box_seems_up = True
+            self._set_state(state)
+            return
+        if state == stodgy_tester.helpers.VagrantStateTracker.SAVED:
+            try:
+                output = self._virsh('resume', self._machine_id())
+                self._cached_box_seems_up = True
+                self._set_state(stodgy_tester.helpers.VagrantStateTracker.RUNNING)
+                return output
+            except Exception as e:
+                stodgy_tester.helpers.print_warn('** Warning: virsh resume failed for', self._name)
+                stodgy_tester.helpers.print_warn('Going to do vagrant up instead.')
+                stodgy_tester.helpers.print_warn(e)
+                return self._up()
+        if state in [stodgy_tester.helpers.VagrantStateTracker.NOT_CREATED,
+                     stodgy_tester.helpers.VagrantStateTracker.POWEROFF]:
+            return self._up()
+        self._set_state(None)
+        return super(LibvirtVirtualMachine, self)._up_or_resume()
+
+    @stodgy_tester.helpers._traced_vm_operation
+    def suspend(self):
+        domain = self._machine_id()
+        if domain is None:
+            return super(LibvirtVirtualMachine, self).suspend()
+        self._close_ssh_connection()
+        try:
+            self._virsh('suspend', domain)
+        except Exception as e:
+            stodgy_tester.helpers.print_warn('** Warning: virsh suspend failed for', self._name, e)
+            return super(LibvirtVirtualMachine, self).suspend()
+        self._cached_box_seems_up = False
+        self._set_state(stodgy_tester.helpers.VagrantStateTracker.SAVED)
+
+    @stodgy_tester.helpers._traced_vm_operation
+    def stop(self):
+        domain = self._machine_id()
+        state = self.domain_state()
+        if domain is None or state is None:
+            return super(LibvirtVirtualMachine, self).stop()
+        self._close_ssh_connection(forget_config=True)
+        # Anything running in the VM is about to go away.
+        self.forget_known_states()
+        if state == stodgy_tester.helpers.VagrantStateTracker.SAVED:
+            # A paused guest can't shut itself down, so wake it up first, as `vagrant halt` does.
+            # Powering it off instead could lose writes still in its page cache, e.g. our rsync.
+            try:
+                self._virsh('resume', domain)
+            except Exception as e:
+                stodgy_tester.helpers.print_warn(
+                    '** Warning: virsh resume failed for', self._name, e)
+                return super(LibvirtVirtualMachine, self).stop()
+            self._shut_down(domain)
+        elif state == stodgy_tester.helpers.VagrantStateTracker.RUNNING:
+            self._shut_down(domain)
+        self._cached_box_seems_up = False
+        self._set_state(stodgy_tester.helpers.VagrantStateTracker.POWEROFF)
+
+    def _shut_down(self, domain):
+        self._virsh('shutdown', domain)
+        deadline = time.time() + self.SHUTDOWN_TIMEOUT
+        while self.domain_state() != stodgy_tester.helpers.VagrantStateTracker.POWEROFF:
+            if time.time() > deadline:
+                stodgy_tester.helpers.print_warn(
+                    '** Warning:', self._name, 'did not shut down; powering it off')
+                # For a persistent domain, `virsh destroy` just pulls the plug.
+                self._virsh('destroy', domain)
+                return
+            time.sleep(1)
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+import stodgy_tester.clones
+import stodgy_tester.helpers
+
+DOMAIN_XML = '''<domain type="kvm">
+  <name>suite_jessie</name>
+  <uuid>6a1f9b1e-0000-4000-8000-000000000001</uuid>
+  <devices>
+    <disk type="file" device="disk">
+      <driver name="qemu" type="qcow2"/>
+      <source file="/var/lib/libvirt/images/suite_jessie.img"/>
+      <backingStore type="file"><format type="qcow2"/></backingStore>
+      <target dev="vda" bus="virtio"/>
+    </disk>
+    <disk type="file" device="cdrom"><target dev="hdc"/></disk>
+    <interface type="network">
+      <mac address="52:54:00:12:34:56"/>
+      <source network="vagrant-libvirt"/>
+    </interface>
+  </devices>
+</domain>
+'''
+
+SSH_CONFIG = '''Host jessie
+  HostName 192.168.121.10
+  User vagrant
+  IdentityFile /home/me/.vagrant.d/insecure_private_key
+'''
+
+
+class FakeVirshRunner(object):
+    def __init__(self):
+        self.argvs = []
+
+    def __call__(self, argv):
+        self.argvs.append(argv)
+        if argv[0] == 'virsh':
+            command = argv[3]
+            if command == 'dumpxml':
+                return DOMAIN_XML
+            if command == 'vol-pool':
+                return 'default\n'
+            if command == 'vol-info':
+                return 'Name: suite_jessie.img\nCapacity:       10737418240 bytes\n'
+            if command == 'vol-path':
+                return '/var/lib/libvirt/images/%s\n' % (argv[-1],)
+            if command == 'domifaddr':
+                return ' vnet0  52:54:00:aa:bb:cc  ipv4  192.168.121.77/24\n'
+        return ''
+
+
+class FakeBaseVirtualMachine(stodgy_tester.helpers.VirtualMachine):
+    def _fetch_ssh_config(self):
+        return SSH_CONFIG
+
+    def _machine_id(self):
+        return '6a1f9b1e-0000-4000-8000-000000000001'
+
+
+class TestLinkedClones(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._old_state_dir = os.environ.get('STODGY_TESTER_STATE_DIR')
+        os.environ['STODGY_TESTER_STATE_DIR'] = self._tempdir
+
+    def tearDown(self):
+        if self._old_state_dir is None:
+            del os.environ['STODGY_TESTER_STATE_DIR']
+        else:
+            os.environ['STODGY_TESTER_STATE_DIR'] = self._old_state_dir
+        stodgy_tester.helpers.VirtualMachine._ssh_config_filenames_by_name.clear()
+        shutil.rmtree(self._tempdir)
+
+    def test_clone_xml_uses_overlay_and_fresh_identity(self):
+        xml = stodgy_tester.clones.clone_domain_xml(
+            DOMAIN_XML, 'jessie-clone-0', '/var/lib/libvirt/images/jessie-clone-0.qcow2')
+        self.assertIn('<name>jessie-clone-0</name>', xml)
+        self.assertNotIn('<uuid>', xml)
+        self.assertNotIn('52:54:00:12:34:56', xml)
+        self.assertNotIn('backingStore', xml)
+        self.assertIn('<source file="/var/lib/libvirt/images/jessie-clone-0.qcow2" />', xml)
+        self.assertEqual(stodgy_tester.clones.base_disk_path(DOMAIN_XML),
+                         '/var/lib/libvirt/images/suite_jessie.img')
+
+    def test_clone_ssh_config_points_at_clone(self):
+        config = stodgy_tester.clones.clone_ssh_config(
+            SSH_CONFIG, 'jessie', 'jessie-clone-0', '192.168.121.77')
+        self.assertEqual(config.splitlines()[:3], [
+            'Host jessie-clone-0', '  HostName 192.168.121.77', '  User vagrant'])
+
+    def test_clone_lifecycle(self):
+        runner = FakeVirshRunner()
+        base = FakeBaseVirtualMachine('jessie', command_runner=runner)
+        factory = stodgy_tester.clones.LinkedCloneFactory(base, runner)
+        factory.prepare()
+        clone = factory.create('jessie-clone-0')
+        clone.up_or_resume_if_needed()
+        clone.up_or_resume_if_needed()
+        clone.stop()
+
+        commands = [argv[3] if argv[0] == 'virsh' else ' '.join(argv[:2]) for argv in runner.argvs]
+        self.assertEqual(commands, [
+            'vagrant halt', 'dumpxml', 'vol-pool', 'vol-info',
+            'vol-create-as', 'vol-path', 'create', 'domifaddr', 'ssh -F',
+            'destroy', 'vol-delete',
+        ])
+        vol_create = runner.argvs[4]
+        self.assertIn('/var/lib/libvirt/images/suite_jessie.img', vol_create)
+        self.assertIn('10737418240', vol_create)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import stodgy_tester.distributed
+
+
+class TestWorkQueue(unittest.TestCase):
+    def _make_queue(self):
+        durations = {'a1.t': 10, 'a2.t': 10, 'a3.t': 10, 'a4.t': 10, 'b1.t': 100}
+        return stodgy_tester.distributed.WorkQueue(
+            [('box-a', ['a1.t', 'a2.t', 'a3.t', 'a4.t']), ('box-b', ['b1.t'])],
+            expected_duration=lambda filename: durations[filename])
+
+    def test_longest_box_goes_first_and_workers_keep_their_box(self):
+        queue = self._make_queue()
+        self.assertEqual(queue.next_testfile('w1'), ('box-b', 'b1.t'))
+        self.assertEqual(queue.next_testfile('w2'), ('box-a', 'a1.t'))
+        self.assertEqual(queue.next_testfile('w2'), ('box-a', 'a2.t'))
+
+    def test_idle_worker_steals_half_of_the_remaining_work(self):
+        queue = self._make_queue()
+        queue.next_testfile('w1')
+        queue.next_testfile('w2')
+        # w1 asks for more before w2 has run anything else. No box is left unclaimed, so w1 takes
+        # the later half (rounded up) of w2's a2, a3 and a4: w1 gets a3 and a4, and w2 keeps a2.
+        self.assertEqual(queue.next_testfile('w1'), ('box-a', 'a3.t'))
+        self.assertEqual(queue.next_testfile('w2'), ('box-a', 'a2.t'))
+        self.assertEqual(queue.next_testfile('w2'), ('box-a', 'a4.t'))
+        self.assertEqual(queue.next_testfile('w1'), None)
+        self.assertTrue(queue.is_empty())
+
+    def test_stop_ends_the_work(self):
+        queue = self._make_queue()
+        queue.stop()
+        self.assertEqual(queue.next_testfile('w1'), None)
+        self.assertTrue(queue.is_empty())
+
+    def test_parse_address(self):
+        self.assertEqual(stodgy_tester.distributed.parse_address('example.com:4000')[1],
+                         ('example.com', 4000))
+        self.assertEqual(stodgy_tester.distributed.parse_address('unix:/tmp/sock')[1],
+                         '/tmp/sock')
+
+
+class TestCoordinator(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_workers_report_how_long_each_test_took(self):
+        address = 'unix:' + os.path.join(self._tempdir, 'coordinator.sock')
+        queue = stodgy_tester.distributed.WorkQueue(
+            [('box-a', ['a1.t', 'a2.t'])], expected_duration=lambda filename: 60)
+        recorded = []
+        coordinator = stodgy_tester.distributed.Coordinator(
+            address, queue, worker_timeout=30,
+            record_result=lambda *result: recorded.append(result))
+        worker = threading.Thread(target=stodgy_tester.distributed.run_worker, args=(
+            address, lambda filename: (filename == 'a1.t', '', len(filename) * 1.5)))
+        worker.daemon = True
+        worker.start()
+        self.assertFalse(coordinator.serve_until_done())
+        worker.join(30)
+        self.assertEqual(recorded, [('a1.t', True, 6.0), ('a2.t', False, 6.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,373 @@
+import os
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import stodgy_tester
+import stodgy_tester.distributed
+import stodgy_tester.fake_vagrant
+import stodgy_tester.helpers
+import stodgy_tester.virsh
+
+SUITE_TEST = '''Title: %(name)s
+Vagrant-Box: %(box)s
+
+$[run]echo hello from %(name)s
+hello from %(name)s
+$[exitcode] 0
+'''
+
+# Records how many fake VMs are running while the test runs.
+COUNT_LIVE_VMS_TEST = '''Title: %(name)s
+Vagrant-Box: %(box)s
+
+$[run]cd "$STODGY_FAKE_VAGRANT_ROOT"; grep -l running machines/*/state | wc -l >> live-vms
+$[exitcode] 0
+$[run]sleep 0.5; echo counted
+counted
+$[exitcode] 0
+'''
+
+
+class ScriptedWorkQueue(object):
+    '''Stands in for WorkQueue, handing out (box, testfile) pairs in a fixed order.'''
+    def __init__(self, items):
+        self._items = list(items)
+        self._lock = threading.Lock()
+
+    def next_testfile(self, worker_id):
+        with self._lock:
+            return self._items.pop(0) if self._items else None
+
+    def is_empty(self):
+        with self._lock:
+            return not self._items
+
+    def stop(self):
+        with self._lock:
+            self._items = []
+
+
+class TestVirtualMachineWithFakeVagrant(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._old_environ = dict(os.environ)
+        bin_dir = os.path.join(self._tempdir, 'bin')
+        stodgy_tester.fake_vagrant.install(bin_dir)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['STODGY_FAKE_VAGRANT_ROOT'] = os.path.join(self._tempdir, 'vms')
+        os.environ['STODGY_FAKE_VAGRANT_BOXES'] = 'jessie,fedora'
+        os.environ['STODGY_TESTER_STATE_DIR'] = os.path.join(self._tempdir, 'state')
+        stodgy_tester.helpers.VirtualMachine._ssh_config_filenames_by_name.clear()
+        self._runner = stodgy_tester.helpers.CommandRunner(
+            default_cwd=self._tempdir, print_cmd=False)
+        self._runner._should_print_cmd_output = False
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self._old_environ)
+        stodgy_tester.helpers.VirtualMachine._ssh_config_filenames_by_name.clear()
+        shutil.rmtree(self._tempdir)
+
+    def _invocations(self):
+        with open(os.path.join(os.environ['STODGY_FAKE_VAGRANT_ROOT'], 'invocations.log')) as f:
+            return [line.split(' ', 1)[1].strip() for line in f]
+
+    def _write_suite(self, tests_by_box, template=SUITE_TEST):
+        '''Write a suite with, for each (box, count) pair, count passing tests on that box.'''
+        suite_dir = os.path.join(self._tempdir, 'suite')
+        os.makedirs(suite_dir)
+        for box_name, count in tests_by_box:
+            for i in range(count):
+                name = '%s-%d' % (box_name, i)
+                with open(os.path.join(suite_dir, name + '.t'), 'w') as f:
+                    f.write(template % {'name': name, 'box': box_name})
+        return suite_dir
+
+    def _start_stodgy_tester(self, suite_dir, *argv):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(
+            stodgy_tester.__file__)))
+        return subprocess.Popen(
+            [sys.executable, '-c', 'import stodgy_tester; stodgy_tester.main()'] + list(argv),
+            cwd=suite_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def _run_stodgy_tester(self, suite_dir, *argv):
+        '''Run stodgy-tester in suite_dir, and return its exit status and output.'''
+        p = self._start_stodgy_tester(suite_dir, *argv)
+        output = p.communicate()[0]
+        return p.returncode, output
+
+    def _box_states(self):
+        tracker = stodgy_tester.helpers.VagrantStateTracker(self._runner)
+        tracker.refresh()
+        return dict((name, tracker.get(name)) for name in tracker.names())
+
+    def test_each_box_is_suspended_once_its_tests_are_done(self):
+        suite_dir = self._write_suite([('fedora', 2), ('jessie', 2)])
+        returncode, output = self._run_stodgy_tester(suite_dir)
+        self.assertEqual(returncode, 0, output)
+        self.assertEqual(self._box_states(), {'fedora': 'saved', 'jessie': 'running'})
+
+    def _run_interleaved_worker(self, *argv):
+        '''Run a --worker that is handed tests that go back and forth between two boxes, as work
+        stealing can, and return how many times a box was suspended.'''
+        suite_dir = self._write_suite([('fedora', 2), ('jessie', 2)])
+        address = 'unix:' + os.path.join(self._tempdir, 'coordinator.sock')
+        coordinator = stodgy_tester.distributed.Coordinator(address, ScriptedWorkQueue([
+            ('jessie', 'jessie-0.t'), ('fedora', 'fedora-0.t'),
+            ('jessie', 'jessie-1.t'), ('fedora', 'fedora-1.t'),
+        ]), worker_timeout=60)
+        p = self._start_stodgy_tester(suite_dir, '--worker', address, *argv)
+        old_stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            all_passed = coordinator.serve_until_done()
+        finally:
+            sys.stdout = old_stdout
+        output = p.communicate()[0]
+        self.assertEqual(p.returncode, 0, output)
+        self.assertTrue(all_passed)
+        return len([line for line in self._invocations() if line.startswith('vagrant suspend')])
+
+    def test_each_box_switch_suspends_by_default(self):
+        self.assertEqual(self._run_interleaved_worker(), 3)
+
+    def test_resident_vms_stay_running_across_box_switches(self):
+        self.assertEqual(self._run_interleaved_worker('--max-live-vms', '2'), 0)
+        self.assertEqual(self._box_states(), {'fedora': 'running', 'jessie': 'running'})
+
+    def test_jobs_keep_live_vms_within_the_memory_budget(self):
+        box_names = ['box0', 'box1', 'box2', 'box3']
+        os.environ['STODGY_FAKE_VAGRANT_BOXES'] = ','.join(box_names)
+        self._runner = stodgy_tester.helpers.CommandRunner(
+            default_cwd=self._tempdir, print_cmd=False)
+        self._runner._should_print_cmd_output = False
+        suite_dir = self._write_suite([(name, 1) for name in box_names],
+                                      template=COUNT_LIVE_VMS_TEST)
+        returncode, output = self._run_stodgy_tester(
+            suite_dir, '--jobs', '2', '--vm-memory-mb', '1024', '--memory-budget-mb', '2048')
+        self.assertEqual(returncode, 0, output)
+        with open(os.path.join(os.environ['STODGY_FAKE_VAGRANT_ROOT'], 'live-vms')) as f:
+            live_vm_counts = [int(line) for line in f]
+        self.assertEqual(len(live_vm_counts), 4)
+        self.assertTrue(max(live_vm_counts) <= 2, live_vm_counts)
+        self.assertEqual(self._box_states(), dict((name, 'saved') for name in box_names))
+
+    def test_local_machines_skip_plugins_and_vagrant(self):
+        suite_dir = self._write_suite([('jessie', 1)], template=SUITE_TEST.replace(
+            'Vagrant-Box: %(box)s', 'Vagrant-Box: %(box)s\nMachine-Backend: local\n'
+            'Cleanup: touch_marker'))
+        marker_filename = os.path.join(self._tempdir, 'plugin-ran')
+        with open(os.path.join(suite_dir, 'host_plugin.py'), 'w') as f:
+            f.write('def touch_marker(vm):\n    open(%r, "w").close()\n' % (marker_filename,))
+        returncode, output = self._run_stodgy_tester(
+            suite_dir, '--plugin', 'host_plugin', '--on-vm-start', 'touch_marker',
+            '--changed-only')
+        self.assertEqual(returncode, 0, output)
+        self.assertIn(b'hello from jessie-0', output)
+        self.assertFalse(os.path.exists(marker_filename))
+        self.assertFalse(os.path.exists(os.path.join(
+            os.environ['STODGY_FAKE_VAGRANT_ROOT'], 'invocations.log')))
+
+    def test_coordinator_and_two_workers(self):
+        suite_dir = self._write_suite([('fedora', 2), ('jessie', 3)], template=SUITE_TEST.replace(
+            '$[run]echo', '$[run]sleep 1; echo'))
+        socket_filename = os.path.join(self._tempdir, 'coordinator.sock')
+        address = 'unix:' + socket_filename
+        coordinator = self._start_stodgy_tester(suite_dir, '--coordinator', address)
+        while not os.path.exists(socket_filename) and coordinator.poll() is None:
+            time.sleep(0.1)
+        workers = [self._start_stodgy_tester(suite_dir, '--worker', address) for i in range(2)]
+        processes = [coordinator] + workers
+        outputs = [p.communicate()[0] for p in processes]
+        self.assertEqual([p.returncode for p in processes], [0, 0, 0], outputs)
+        for name in ['fedora-0', 'fedora-1', 'jessie-0', 'jessie-1', 'jessie-2']:
+            self.assertIn(b'hello from ' + name.encode('ascii'), outputs[0])
+
+        # Each worker asks Vagrant about the boxes once, not once per test.
+        invocations = self._invocations()
+        self.assertTrue(len([line for line in invocations
+                             if line.startswith('vagrant status')]) <= 2, invocations)
+        self.assertTrue(len([line for line in invocations
+                             if line.startswith('vagrant ssh-config')]) <= 4, invocations)
+
+    def test_coordinator_finishes_at_once_without_tests(self):
+        suite_dir = self._write_suite([])
+        returncode, output = self._run_stodgy_tester(
+            suite_dir, '--coordinator', 'unix:' + os.path.join(self._tempdir, 'coordinator.sock'))
+        self.assertEqual(returncode, 0, output)
+        self.assertIn(b'No testfiles', output)
+
+    def test_coordinator_gives_up_without_workers(self):
+        suite_dir = self._write_suite([('jessie', 1)])
+        returncode, output = self._run_stodgy_tester(
+            suite_dir, '--coordinator', 'unix:' + os.path.join(self._tempdir, 'coordinator.sock'),
+            '--worker-timeout', '1')
+        self.assertEqual(returncode, 1, output)
+        self.assertIn(b'No worker connected', output)
+
+    def test_changed_only_skips_tests_that_passed_with_the_same_inputs(self):
+        suite_dir = self._write_suite([('jessie', 2)])
+        returncode, output = self._run_stodgy_tester(suite_dir)
+        self.assertEqual(returncode, 0, output)
+        # Without --changed-only, nothing needs the Vagrant box versions.
+        self.assertEqual([line for line in self._invocations() if line.startswith('vagrant box')],
+                         [])
+
+        for expected_skips in [0, 2]:
+            returncode, output = self._run_stodgy_tester(suite_dir, '--changed-only')
+            self.assertEqual(returncode, 0, output)
+            self.assertEqual(output.count(b'Skipping'), expected_skips, output)
+
+        with open(os.path.join(suite_dir, 'jessie-0.t'), 'a') as f:
+            f.write('\n')
+        returncode, output = self._run_stodgy_tester(suite_dir, '--changed-only')
+        self.assertEqual(returncode, 0, output)
+        self.assertEqual(output.count(b'Skipping'), 1, output)
+        self.assertIn(b'hello from jessie-0', output)
+
+    def test_lifecycle_and_commands(self):
+        tracker = stodgy_tester.helpers.VagrantStateTracker(self._runner)
+        tracker.refresh()
+        self.assertEqual(tracker.get('jessie'), 'not_created')
+
+        vm = stodgy_tester.helpers.VirtualMachine(
+            'jessie', command_runner=self._runner, state_tracker=tracker)
+        self.assertEqual(vm.run_command_within_vm('echo hi'), 'hi\n')
+        self.assertEqual(vm.run_probes(['test -e /nonexistent', 'true']), [(1, ''), (0, '')])
+        vm.suspend()
+        tracker.refresh()
+        self.assertEqual(tracker.get('jessie'), 'saved')
+        vm.up_or_resume_if_needed()
+
+        vagrant_commands = [line for line in self._invocations() if line.startswith('vagrant')]
+        self.assertEqual(vagrant_commands, [
+            'vagrant status --machine-readable',
+            'vagrant up jessie',
+            'vagrant ssh-config jessie',
+            'vagrant suspend jessie',
+            'vagrant status --machine-readable',
+            'vagrant resume jessie',
+        ])
+        ssh_commands = [line for line in self._invocations() if line.startswith('ssh')]
+        # Two commands, plus closing the master connection on suspend.
+        self.assertEqual(len(ssh_commands), 3)
+        self.assertTrue(ssh_commands[-1].endswith('-O exit jessie'))
+
+    def test_rsync_only_sends_what_changed(self):
+        suite_dir = os.path.join(self._tempdir, 'suite')
+        os.makedirs(suite_dir)
+        old_cwd = os.getcwd()
+        os.chdir(suite_dir)
+        try:
+            with open('installer.sh', 'w') as f:
+                f.write('echo one\n')
+            with open('obsolete.sh', 'w') as f:
+                f.write('echo old\n')
+            runner = stodgy_tester.helpers.CommandRunner(default_cwd=suite_dir, print_cmd=False)
+            runner._should_print_cmd_output = False
+            vm = stodgy_tester.helpers.VirtualMachine(
+                'jessie', command_runner=runner, synced_guest_path='vagrant')
+            vm.rsync()
+            vm.rsync()
+            with open('installer.sh', 'w') as f:
+                f.write('echo two\n')
+            os.unlink('obsolete.sh')
+            vm.rsync()
+            self.assertEqual(vm.run_command_within_vm('cat vagrant/installer.sh'), 'echo two\n')
+            self.assertEqual(vm.run_command_within_vm('ls vagrant'), 'installer.sh\n')
+        finally:
+            os.chdir(old_cwd)
+        rsyncs = [line for line in self._invocations() if line.startswith('vagrant rsync')]
+        self.assertEqual(len(rsyncs), 1)
+
+    def test_failed_test_makes_the_next_rsync_a_full_one(self):
+        suite_dir = self._write_suite([('jessie', 1)], template=SUITE_TEST.replace(
+            '$[exitcode] 0', '$[exitcode] 1'))
+        with open(os.path.join(suite_dir, 'Vagrantfile'), 'w') as f:
+            f.write('config.vm.synced_folder ".", "%s"\n' % (os.path.join(self._tempdir, 'guest'),))
+        for i in range(2):
+            returncode, output = self._run_stodgy_tester(suite_dir, '--rsync')
+            self.assertNotEqual(returncode, 0, output)
+        rsyncs = [line for line in self._invocations() if line.startswith('vagrant rsync')]
+        self.assertEqual(len(rsyncs), 2)
+
+    def test_halt_boxes_in_parallel(self):
+        for name in ['jessie', 'fedora']:
+            vm = stodgy_tester.helpers.VirtualMachine(name, command_runner=self._runner)
+            vm.up_or_resume_if_needed()
+        old_runner = stodgy_tester.RUNNER
+        stodgy_tester.RUNNER = self._runner
+        try:
+            self.assertTrue(stodgy_tester.halt_boxes_in_parallel())
+        finally:
+            stodgy_tester.RUNNER = old_runner
+        tracker = stodgy_tester.helpers.VagrantStateTracker(self._runner)
+        tracker.refresh()
+        self.assertEqual([tracker.get(name) for name in ['jessie', 'fedora']],
+                         ['poweroff', 'poweroff'])
+        halts = [line for line in self._invocations() if line.startswith('vagrant halt')]
+        self.assertEqual(sorted(halts), ['vagrant halt fedora', 'vagrant halt jessie'])
+
+    def test_libvirt_fast_path_skips_vagrant(self):
+        old_cwd = os.getcwd()
+        # Vagrant's machine IDs live in .vagrant, which is relative to the current directory.
+        os.chdir(self._tempdir)
+        old_runner = stodgy_tester.RUNNER
+        stodgy_tester.RUNNER = self._runner
+        try:
+            vm = stodgy_tester.virsh.LibvirtVirtualMachine('jessie', command_runner=self._runner)
+            vm.up_or_resume_if_needed()
+            vm.suspend()
+            vm = stodgy_tester.virsh.LibvirtVirtualMachine('jessie', command_runner=self._runner)
+            self.assertEqual(vm.run_command_within_vm('echo hi'), 'hi\n')
+            self.assertEqual(stodgy_tester.virsh.libvirt_box_names(), ['jessie'])
+            self.assertTrue(stodgy_tester.halt_boxes_in_parallel(libvirt_fast_path=True))
+            self.assertEqual(vm.domain_state(), 'poweroff')
+        finally:
+            stodgy_tester.RUNNER = old_runner
+            os.chdir(old_cwd)
+
+        commands = [line.replace('virsh -c qemu:///system', 'virsh') for line in self._invocations()
+                    if line.startswith('vagrant') or line.startswith('virsh')]
+        self.assertEqual(commands, [
+            'vagrant up jessie',
+            'virsh suspend fake-domain-jessie',
+            'virsh domstate fake-domain-jessie',
+            'virsh resume fake-domain-jessie',
+            'vagrant ssh-config jessie',
+            'virsh domstate fake-domain-jessie',
+            'virsh shutdown fake-domain-jessie',
+            'virsh domstate fake-domain-jessie',
+            'virsh domstate fake-domain-jessie',
+        ])
+
+    def test_libvirt_fast_path_shuts_a_suspended_box_down_cleanly(self):
+        old_cwd = os.getcwd()
+        os.chdir(self._tempdir)
+        try:
+            vm = stodgy_tester.virsh.LibvirtVirtualMachine('jessie', command_runner=self._runner)
+            vm.up_or_resume_if_needed()
+            vm.suspend()
+            vm.stop()
+            self.assertEqual(vm.domain_state(), 'poweroff')
+        finally:
+            os.chdir(old_cwd)
+
+        commands = [line.replace('virsh -c qemu:///system', 'virsh') for line in self._invocations()
+                    if line.startswith('virsh')]
+        self.assertEqual(commands, [
+            'virsh suspend fake-domain-jessie',
+            'virsh domstate fake-domain-jessie',
+            'virsh resume fake-domain-jessie',
+            'virsh shutdown fake-domain-jessie',
+            'virsh domstate fake-domain-jessie',
+            'virsh domstate fake-domain-jessie',
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
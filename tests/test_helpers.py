@@ -1,6 +1,11 @@
 import unittest
 import stodgy_tester.helpers
+import stodgy_tester.tracing
 import os
+import pexpect
+import shutil
+import tempfile
+import threading
 
 
 class TestRunner(unittest.TestCase):
@@ -13,6 +18,56 @@ class TestRunner(unittest.TestCase):
         wanted = '1'
         self.assertEqual(got, wanted)
 
+    def test_runner_handles_lots_of_stderr(self):
+        self._runner._should_print_cmd_output = False
+        got = self._runner(
+            ['bash', '-c', 'head -c 1000000 /dev/zero >&2; seq 1 100000']).strip()
+        self.assertTrue(got.endswith('\n100000'))
+
+    def test_runner_keeps_bounded_output_but_logs_everything(self):
+        self._runner._should_print_cmd_output = False
+        self._runner.MAX_OUTPUT_IN_MEMORY = 1000
+        try:
+            self._runner(['bash', '-c', 'seq 1 100000; exit 1'])
+        except Exception as e:
+            self.assertTrue(len(e.output) <= 1000)
+            self.assertTrue(e.output.endswith('100000\n'))
+            with open(e.log_filename) as f:
+                self.assertEqual(len(f.read().split()), 100000)
+        else:
+            self.fail('Expected the command to fail')
+
+    def test_runner_prints_output_without_newlines_in_pieces(self):
+        printed = []
+        old_print_info = stodgy_tester.helpers.print_info
+        stodgy_tester.helpers.print_info = lambda *args: printed.append(args[0])
+        try:
+            self._runner(['bash', '-c', 'head -c 4000000 /dev/zero | tr "\\0" x'])
+        finally:
+            stodgy_tester.helpers.print_info = old_print_info
+        self.assertEqual(sum(len(line) for line in printed), 4000000)
+        self.assertTrue(max(len(line) for line in printed) <=
+                        self._runner.MAX_PRINTED_LINE + 65536)
+
+    def test_runner_deletes_old_logs(self):
+        log_dir = tempfile.mkdtemp()
+        try:
+            old_log = os.path.join(log_dir, '1-0001-old.log')
+            new_log = os.path.join(log_dir, '1-0002-new.log')
+            for filename in [old_log, new_log]:
+                open(filename, 'w').close()
+            long_ago = os.path.getmtime(old_log) - 30 * 24 * 60 * 60
+            os.utime(old_log, (long_ago, long_ago))
+            runner = stodgy_tester.helpers.CommandRunner(
+                default_cwd=os.getcwd(), print_cmd=False, log_dir=log_dir)
+            runner._should_print_cmd_output = False
+            runner(['true'])
+            self.assertFalse(os.path.exists(old_log))
+            self.assertTrue(os.path.exists(new_log))
+            self.assertEqual(len(os.listdir(log_dir)), 2)
+        finally:
+            shutil.rmtree(log_dir)
+
     def test_runner_does_something_on_fail(self):
         got_exception = False
         try:
@@ -21,5 +76,449 @@ class TestRunner(unittest.TestCase):
             got_exception = True
         self.assertTrue(got_exception)
 
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_budget_blocks_until_memory_is_released(self):
+        budget = stodgy_tester.helpers.MemoryBudget(budget_mb=1500)
+        budget.acquire(1024)
+        acquired = threading.Event()
+
+        def acquire_second_vm():
+            budget.acquire(1024)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire_second_vm)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        budget.release(1024)
+        thread.join()
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(budget.in_use_mb(), 1024)
+
+    def test_oversized_vm_runs_alone(self):
+        budget = stodgy_tester.helpers.MemoryBudget(budget_mb=512)
+        budget.acquire(1024)
+        self.assertEqual(budget.in_use_mb(), 1024)
+
+
+class TestBackgroundLifecycle(unittest.TestCase):
+    def test_operations_on_one_box_run_in_order(self):
+        lifecycle = stodgy_tester.helpers.BackgroundLifecycle()
+        release_first = threading.Event()
+        calls = []
+
+        def first():
+            release_first.wait()
+            calls.append('first')
+
+        def fail():
+            calls.append('second')
+            raise ValueError('no such box')
+
+        lifecycle.start('jessie', 'resume', first)
+        lifecycle.start('jessie', 'suspend', fail)
+        lifecycle.start('fedora', 'resume', lambda: calls.append('other box'))
+        self.assertEqual(lifecycle.wait('fedora'), None)
+        self.assertEqual(calls, ['other box'])
+        release_first.set()
+        self.assertTrue(isinstance(lifecycle.wait('jessie'), ValueError))
+        self.assertEqual(calls, ['other box', 'first', 'second'])
+        self.assertEqual(lifecycle.wait('jessie'), None)
+
+
+class TestResidentVMCache(unittest.TestCase):
+    def test_least_recently_used_box_is_evicted(self):
+        evicted = []
+        cache = stodgy_tester.helpers.ResidentVMCache(
+            create_vm=lambda name: {'name': name}, max_live_vms=2,
+            evict=lambda vm: evicted.append(vm['name']))
+        jessie = cache.use('jessie')
+        cache.use('fedora')
+        self.assertTrue(cache.use('jessie') is jessie)
+        self.assertEqual(evicted, [])
+        cache.use('centos')
+        self.assertEqual(evicted, ['fedora'])
+        self.assertFalse(cache.is_live('fedora'))
+        self.assertTrue(cache.is_live('jessie'))
+        cache.use('fedora')
+        self.assertEqual(evicted, ['fedora', 'jessie'])
+        self.assertEqual([vm['name'] for vm in cache.live_vms()], ['centos', 'fedora'])
+
+
+class FakeCommandRunner(object):
+    '''Stands in for CommandRunner, recording each argv and replying from a dict.'''
+    def __init__(self, outputs=None):
+        self.argvs = []
+        self._outputs = outputs or {}
+
+    def __call__(self, argv):
+        self.argvs.append(argv)
+        return self._outputs.get(tuple(argv[:2]), '')
+
+
+class TestInputFingerprinter(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._test_filename = self._write('a.t', 'Title: a\n')
+        self._plugin_filename = self._write('plugin.py', 'def cleanup(vm): pass\n')
+        self._synced_root = os.path.join(self._tempdir, 'synced')
+        os.makedirs(self._synced_root)
+        self._write('synced/install.sh', 'echo one\n')
+        self._box_list = '1,jessie,box-version,1.0\n'
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _write(self, relative_path, text):
+        filename = os.path.join(self._tempdir, relative_path)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def _key(self):
+        runner = FakeCommandRunner({('vagrant', 'box'): self._box_list})
+        fingerprinter = stodgy_tester.helpers.InputFingerprinter(
+            runner, plugin_filename=self._plugin_filename + 'c', synced_root=self._synced_root)
+        key = fingerprinter.key_for(self._test_filename)
+        self.assertEqual(fingerprinter.key_for(self._test_filename), key)
+        self.assertEqual(runner.argvs, [['vagrant', 'box', 'list', '--machine-readable']])
+        return key
+
+    def test_key_changes_with_each_input(self):
+        keys = [self._key()]
+        self.assertEqual(self._key(), keys[0])
+        self._box_list = '2,jessie,box-version,1.0\n'
+        self.assertEqual(self._key(), keys[0])
+
+        self._write('a.t', 'Title: a, edited\n')
+        keys.append(self._key())
+        self._write('plugin.py', 'def cleanup(vm): vm.run_command_within_vm("true")\n')
+        keys.append(self._key())
+        self._write('synced/install.sh', 'echo two\n')
+        keys.append(self._key())
+        self._box_list = '2,jessie,box-version,1.1\n'
+        keys.append(self._key())
+        self.assertEqual(len(set(keys)), 5)
+
+    def test_only_vagrant_tests_depend_on_the_box_list(self):
+        runner = FakeCommandRunner({('vagrant', 'box'): self._box_list})
+        fingerprinter = stodgy_tester.helpers.InputFingerprinter(
+            runner, plugin_filename=self._plugin_filename,
+            uses_vagrant=lambda test_filename: False)
+        fingerprinter.key_for(self._test_filename)
+        self.assertEqual(runner.argvs, [])
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_pass_is_remembered_until_a_failure(self):
+        cache = stodgy_tester.helpers.ResultCache(os.path.join(self._tempdir, 'results.json'))
+        self.assertFalse(cache.passed_with('a.t', 'key1'))
+        cache.record_pass('a.t', 'key1')
+        cache.record_pass('b.t', 'key2')
+        self.assertTrue(cache.passed_with('a.t', 'key1'))
+        self.assertFalse(cache.passed_with('a.t', 'key2'))
+        cache.record_failure('a.t')
+        self.assertFalse(cache.passed_with('a.t', 'key1'))
+        self.assertTrue(cache.passed_with('b.t', 'key2'))
+
+
+class TestVirtualMachineSsh(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._old_state_dir = os.environ.get('STODGY_TESTER_STATE_DIR')
+        os.environ['STODGY_TESTER_STATE_DIR'] = self._tempdir
+        stodgy_tester.helpers.VirtualMachine._ssh_config_filenames_by_name.clear()
+
+    def tearDown(self):
+        if self._old_state_dir is None:
+            del os.environ['STODGY_TESTER_STATE_DIR']
+        else:
+            os.environ['STODGY_TESTER_STATE_DIR'] = self._old_state_dir
+        stodgy_tester.helpers.VirtualMachine._ssh_config_filenames_by_name.clear()
+        shutil.rmtree(self._tempdir)
+
+    def test_ssh_config_is_fetched_once_per_box(self):
+        runner = FakeCommandRunner({('vagrant', 'ssh-config'): 'Host jessie\n  Port 22\n'})
+        vm = stodgy_tester.helpers.VirtualMachine('jessie', command_runner=runner)
+        first = vm.ssh_argv('true')
+        other_vm = stodgy_tester.helpers.VirtualMachine('jessie', command_runner=runner)
+        second = other_vm.ssh_argv('echo hi', tty=True)
+        self.assertEqual(runner.argvs, [['vagrant', 'ssh-config', 'jessie']])
+        self.assertEqual(first[0], 'ssh')
+        self.assertEqual(first[-2:], ['jessie', 'true'])
+        self.assertIn('ControlMaster=auto', first)
+        self.assertIn('-t', second)
+
+    def test_http_proxy_is_set_once_and_removed_by_a_later_run(self):
+        runner = FakeCommandRunner({('vagrant', 'ssh-config'): 'Host jessie\n  Port 22\n'})
+        vm = stodgy_tester.helpers.VirtualMachine('jessie', command_runner=runner)
+        vm.set_http_proxy('http://192.168.121.1:3142')
+        vm.set_http_proxy('http://192.168.121.1:3142')
+        next_run_vm = stodgy_tester.helpers.VirtualMachine('jessie', command_runner=runner)
+        next_run_vm.set_http_proxy(None)
+        next_run_vm.set_http_proxy(None)
+
+        proxy_commands = [argv[-1] for argv in runner.argvs if 'stodgy-tester' in argv[-1]]
+        self.assertEqual(len(proxy_commands), 2)
+        self.assertIn('Acquire::http::Proxy', proxy_commands[0])
+        self.assertIn('proxy=http://192.168.121.1:3142', proxy_commands[0])
+        self.assertNotIn('Acquire::http::Proxy', proxy_commands[1])
+
+
+class TestVirtualMachineSnapshots(unittest.TestCase):
+    def test_reset_restores_existing_baseline(self):
+        runner = FakeCommandRunner({('vagrant', 'snapshot'): 'stodgy-tester-baseline\n'})
+        vm = stodgy_tester.helpers.VirtualMachine('jessie', command_runner=runner)
+        vm.reset_to_baseline()
+        self.assertIn(['vagrant', 'snapshot', 'restore', '--no-provision', 'jessie',
+                       'stodgy-tester-baseline'], runner.argvs)
+        self.assertNotIn(['vagrant', 'destroy', '-f', 'jessie'], runner.argvs)
+
+    def test_reset_without_baseline_rebuilds_and_saves_one(self):
+        runner = FakeCommandRunner()
+        vm = stodgy_tester.helpers.VirtualMachine('jessie', command_runner=runner)
+        vm.reset_to_baseline()
+        self.assertIn(['vagrant', 'destroy', '-f', 'jessie'], runner.argvs)
+        self.assertEqual(runner.argvs[-1],
+                         ['vagrant', 'snapshot', 'save', 'jessie', 'stodgy-tester-baseline'])
+
+
+class LocalShellVirtualMachine(stodgy_tester.helpers.VirtualMachine):
+    '''A VirtualMachine whose "VM" is just a bash process on this host.'''
+    def up_or_resume_if_needed(self):
+        pass
+
+    def ssh_argv(self, command_as_str, tty=False):
+        return ['bash', '-c', command_as_str]
+
+
+class TestVirtualMachineProbes(unittest.TestCase):
+    def test_each_probe_gets_its_own_status_and_output(self):
+        runner = stodgy_tester.helpers.CommandRunner(default_cwd=os.getcwd(), print_cmd=False)
+        runner._should_print_cmd_output = False
+        vm = LocalShellVirtualMachine('local', command_runner=runner)
+        results = vm.run_probes([
+            'echo hello',
+            'echo oops >&2; exit 3',
+            'false; echo not reached',
+            'printf no-newline',
+        ])
+        self.assertEqual(results, [
+            (0, 'hello\n'),
+            (3, 'oops\n'),
+            (1, ''),
+            (0, 'no-newline'),
+        ])
+
+
+class TestLocalProcessMachine(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._old_cwd = os.getcwd()
+        self._old_state_dir = os.environ.get('STODGY_TESTER_STATE_DIR')
+        os.environ['STODGY_TESTER_STATE_DIR'] = os.path.join(self._tempdir, 'state')
+        os.makedirs(os.path.join(self._tempdir, 'suite'))
+        os.chdir(os.path.join(self._tempdir, 'suite'))
+
+    def tearDown(self):
+        os.chdir(self._old_cwd)
+        if self._old_state_dir is None:
+            del os.environ['STODGY_TESTER_STATE_DIR']
+        else:
+            os.environ['STODGY_TESTER_STATE_DIR'] = self._old_state_dir
+        shutil.rmtree(self._tempdir)
+
+    def test_commands_run_in_the_machine_directory(self):
+        with open('install.sh', 'w') as f:
+            f.write('echo installing\n')
+        runner = stodgy_tester.helpers.CommandRunner(default_cwd=os.getcwd(), print_cmd=False)
+        runner._should_print_cmd_output = False
+        machine = stodgy_tester.helpers.LocalProcessMachine('local:jessie', command_runner=runner)
+        machine.rsync()
+        self.assertEqual(machine.run_command_within_vm('bash vagrant/install.sh'), 'installing\n')
+        machine.run_command_within_vm('touch leftover')
+        self.assertEqual(machine.run_probes(['test -e ~/leftover']), [(0, '')])
+
+        machine.reset_to_baseline()
+        self.assertEqual(machine.run_probes(['test -e ~/leftover']), [(1, '')])
+        self.assertEqual(machine.run_command_within_vm('ls vagrant'), 'install.sh\n')
+
+        child = machine.spawn('read -p "Name? " name; echo "hi $name"')
+        child.expect('Name\\? ')
+        child.sendline('world')
+        child.expect('hi world')
+
+
+class TestSyncedTree(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._vagrantfile = os.path.join(self._tempdir, 'Vagrantfile')
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _synced_folder(self, vagrantfile_text):
+        with open(self._vagrantfile, 'w') as f:
+            f.write(vagrantfile_text)
+        return stodgy_tester.helpers.vagrant_synced_folder(self._vagrantfile)
+
+    def test_synced_folder_comes_from_the_vagrantfile(self):
+        self.assertEqual(self._synced_folder('Vagrant.configure(2) do |config|\nend\n'),
+                         '/vagrant')
+        self.assertEqual(self._synced_folder(
+            '  # config.vm.synced_folder ".", "/ignored"\n'
+            '  config.vm.synced_folder ".", "/home/vagrant/tests", type: "rsync"\n'),
+            '/home/vagrant/tests')
+        self.assertEqual(self._synced_folder(
+            '  config.vm.synced_folder ".", "/vagrant", type: "rsync",\n'
+            '    rsync__exclude: [".git/"]\n'), None)
+        self.assertEqual(self._synced_folder(
+            '  config.vm.synced_folder ".", "/vagrant", disabled: true\n'), None)
+        self.assertEqual(stodgy_tester.helpers.vagrant_synced_folder(
+            os.path.join(self._tempdir, 'missing')), None)
+
+    def test_synced_tree_matches_vagrant_rsync_defaults(self):
+        root = os.path.join(self._tempdir, 'root')
+        for directory in ['.vagrant/machines', '.git', 'sub/.vagrant']:
+            os.makedirs(os.path.join(root, directory))
+        for filename in ['a.t', '.vagrant/machines/id', '.git/HEAD', 'sub/b', 'sub/.vagrant/c']:
+            with open(os.path.join(root, filename), 'w') as f:
+                f.write('x')
+        self.assertEqual(list(stodgy_tester.helpers.synced_tree_files(root)),
+                         ['a.t', '.git/HEAD', 'sub/b'])
+
+
+class TestVagrantStateTracker(unittest.TestCase):
+    STATUS_OUTPUT = (
+        '1500000000,jessie,metadata,provider,libvirt\n'
+        '1500000000,jessie,state,running\n'
+        '1500000000,fedora,state,paused\n'
+        '1500000000,trusty,state,not_created\n'
+    )
+
+    def _make_tracker(self):
+        runner = FakeCommandRunner({('vagrant', 'status'): self.STATUS_OUTPUT})
+        tracker = stodgy_tester.helpers.VagrantStateTracker(runner)
+        tracker.refresh()
+        return runner, tracker
+
+    def test_states_are_parsed_and_normalized(self):
+        runner, tracker = self._make_tracker()
+        self.assertEqual(tracker.get('jessie'), 'running')
+        self.assertEqual(tracker.get('fedora'), 'saved')
+        self.assertEqual(tracker.get('trusty'), 'not_created')
+        self.assertEqual(tracker.get('nonexistent'), None)
+
+    def test_each_state_needs_only_one_command(self):
+        runner, tracker = self._make_tracker()
+        for name in ['jessie', 'fedora', 'trusty']:
+            stodgy_tester.helpers.VirtualMachine(
+                name, command_runner=runner, state_tracker=tracker).up_or_resume_if_needed()
+        self.assertEqual(runner.argvs[1:], [
+            ['vagrant', 'resume', 'fedora'],
+            ['vagrant', 'up', 'trusty'],
+        ])
+        self.assertEqual(tracker.get('fedora'), 'running')
+
+
+class TestExpectSession(unittest.TestCase):
+    def _spawn(self, command):
+        return stodgy_tester.helpers.ExpectSession(pexpect.spawn('bash', ['-c', command]))
+
+    def test_matches_report_offsets_and_exit_status(self):
+        session = self._spawn('echo abc; echo def; exit 4')
+        offset, seconds = session.expect(stodgy_tester.helpers.LiteralPattern('def'), timeout=5)
+        # "abc\r\n" comes first, since pexpect gives us a terminal.
+        self.assertEqual(offset, 5)
+        self.assertEqual(session.expect_eof(timeout=5), 4)
+
+    def test_unmatched_output_is_not_kept(self):
+        session = self._spawn('head -c 1000000 /dev/zero | tr "\\0" x; echo; echo done')
+        session.expect(stodgy_tester.helpers.LiteralPattern('done'), timeout=10)
+        self.assertTrue(len(session._buffer) < 100)
+
+    def test_timeout_raises(self):
+        session = self._spawn('sleep 5')
+        self.assertRaises(pexpect.TIMEOUT, session.expect,
+                          stodgy_tester.helpers.LiteralPattern('never'), 0.2)
+
+
+class TestTimingHistory(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._filename = os.path.join(self._tempdir, 'timings.json')
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_falls_back_without_enough_history(self):
+        history = stodgy_tester.helpers.TimingHistory(self._filename)
+        key = history.key('a.t', 5, 'hello')
+        history.record(key, 1.0)
+        self.assertEqual(history.timeout_for(key, 60), 60)
+
+    def test_timeout_comes_from_saved_history(self):
+        history = stodgy_tester.helpers.TimingHistory(self._filename)
+        key = history.key('a.t', 5, 'hello')
+        for seconds in [1.0, 2.0, 4.0]:
+            history.record(key, seconds)
+        history.save()
+        reloaded = stodgy_tester.helpers.TimingHistory(self._filename)
+        self.assertEqual(reloaded.timeout_for(key, 60), 4.0 * 1.5 + 2.0)
+        self.assertEqual(reloaded.timeout_for(history.key('a.t', 5, 'edited'), 60), 60)
+
+    def test_quick_veryslow_line_gets_a_short_timeout(self):
+        history = stodgy_tester.helpers.TimingHistory(self._filename)
+        key = history.key('a.t', 5, '$[veryslow]Sandstorm started')
+        for seconds in [0.5, 1.0, 1.0]:
+            history.record(key, seconds)
+        # Not the 120 seconds $[veryslow] asks for, so a hang fails the run sooner.
+        self.assertEqual(history.timeout_for(key, 120), 1.0 * 1.5 + 2.0)
+
+
+class TestTestHistory(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._filename = os.path.join(self._tempdir, 'test-history.json')
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def test_recent_failures_and_changes_raise_likelihood(self):
+        history = stodgy_tester.helpers.TestHistory(self._filename)
+        self.assertEqual(history.failure_likelihood('new.t'), 0.5)
+        self.assertEqual(history.expected_duration('new.t', default=60), 60)
+        history.record('old-failure.t', False, 10.0, 'key')
+        history.record('old-failure.t', True, 20.0, 'key')
+        history.record('recent-failure.t', True, 1.0, 'key')
+        history.record('recent-failure.t', False, 1.0, 'key')
+        history.save()
+
+        reloaded = stodgy_tester.helpers.TestHistory(self._filename)
+        self.assertTrue(reloaded.failure_likelihood('recent-failure.t', 'key') >
+                        reloaded.failure_likelihood('old-failure.t', 'key') > 0)
+        self.assertEqual(reloaded.failure_likelihood('old-failure.t', 'edited'), 0.5)
+        self.assertEqual(reloaded.expected_duration('old-failure.t'), 15.0)
+
+    def test_records_test_spans(self):
+        history = stodgy_tester.helpers.TestHistory(
+            self._filename, input_key_for=lambda filename: 'key-for-' + filename)
+        stodgy_tester.tracing.add_listener(history)
+        try:
+            with stodgy_tester.tracing.span('test', 'a.t'):
+                with stodgy_tester.tracing.span('script', 'a.t'):
+                    pass
+        finally:
+            stodgy_tester.tracing.remove_listener(history)
+        reloaded = stodgy_tester.helpers.TestHistory(self._filename)
+        self.assertEqual(reloaded.failure_likelihood('a.t', 'key-for-a.t'), 0.0)
+        self.assertEqual(reloaded.failure_likelihood('a.t', 'other'), 0.5)
+
 if __name__ == '__main__':
     unittest.main()
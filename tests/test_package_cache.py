@@ -0,0 +1,146 @@
+import BaseHTTPServer
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import stodgy_tester.package_cache
+
+
+class FakeMirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    requests = []
+    # Bumped to publish new contents at the same URLs.
+    version = 1
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        etag = '"v%d"' % (self.version,)
+        if self.headers.getheader('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = ('contents of %s, version %d' % (self.path, self.version)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPackageCache(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        FakeMirrorHandler.requests = []
+        FakeMirrorHandler.version = 1
+        self._mirror = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeMirrorHandler)
+        self._mirror_thread = threading.Thread(target=self._mirror.serve_forever)
+        self._mirror_thread.daemon = True
+        self._mirror_thread.start()
+        self._cache = stodgy_tester.package_cache.PackageCache(
+            os.path.join(self._tempdir, 'cache'), '127.0.0.1', allow_private_upstreams=True)
+        self._proxy_port = self._cache.start()
+
+    def tearDown(self):
+        self._cache.stop()
+        self._mirror.shutdown()
+        self._mirror.server_close()
+        self._mirror_thread.join()
+        shutil.rmtree(self._tempdir)
+
+    def _get_through_proxy(self, path, proxy_port=None):
+        connection = httplib.HTTPConnection('127.0.0.1', proxy_port or self._proxy_port)
+        connection.request('GET', 'http://127.0.0.1:%d%s' % (self._mirror.server_port, path))
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response.status, body
+
+    def test_packages_are_cached_and_metadata_is_not(self):
+        for i in range(2):
+            self.assertEqual(self._get_through_proxy('/pool/postfix_2.11.deb'),
+                             (200, b'contents of /pool/postfix_2.11.deb, version 1'))
+            self.assertEqual(self._get_through_proxy('/dists/jessie/InRelease'),
+                             (200, b'contents of /dists/jessie/InRelease, version 1'))
+
+        self.assertEqual(FakeMirrorHandler.requests, [
+            '/pool/postfix_2.11.deb', '/dists/jessie/InRelease', '/dists/jessie/InRelease'])
+        stats = self._cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['uncached'], stats['errors']),
+                         (1, 1, 2, 0))
+        self.assertEqual(stats['bytes_from_cache'],
+                         len(b'contents of /pool/postfix_2.11.deb, version 1'))
+        self.assertTrue(self._cache.summary().startswith('1 hits, 1 misses (50% hit rate)'))
+
+    def test_tarballs_are_revalidated(self):
+        path = '/sandstorm-latest.tar.xz'
+        self.assertEqual(self._get_through_proxy(path),
+                         (200, b'contents of /sandstorm-latest.tar.xz, version 1'))
+        # Unchanged upstream: a 304, and the cached copy is served.
+        self.assertEqual(self._get_through_proxy(path),
+                         (200, b'contents of /sandstorm-latest.tar.xz, version 1'))
+        FakeMirrorHandler.version = 2
+        self.assertEqual(self._get_through_proxy(path),
+                         (200, b'contents of /sandstorm-latest.tar.xz, version 2'))
+        self.assertEqual(self._get_through_proxy(path),
+                         (200, b'contents of /sandstorm-latest.tar.xz, version 2'))
+
+        self.assertEqual(FakeMirrorHandler.requests, [path] * 4)
+        stats = self._cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['errors']), (2, 2, 0))
+
+    def test_private_upstreams_are_refused(self):
+        cache = stodgy_tester.package_cache.PackageCache(
+            os.path.join(self._tempdir, 'strict-cache'), '127.0.0.1')
+        port = cache.start()
+        try:
+            self.assertEqual(self._get_through_proxy('/pool/postfix_2.11.deb', port)[0], 403)
+        finally:
+            cache.stop()
+        self.assertEqual(FakeMirrorHandler.requests, [])
+
+    def test_connect_is_tunnelled(self):
+        self._cache.TUNNEL_PORTS = (self._mirror.server_port,)
+        client = socket.create_connection(('127.0.0.1', self._proxy_port), timeout=10)
+        try:
+            client.sendall(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n' % (self._mirror.server_port,))
+            reply = client.makefile('rb')
+            self.assertIn(b' 200 ', reply.readline())
+            while reply.readline() not in (b'\r\n', b''):
+                pass
+            # As far as the mirror knows, we're talking to it directly.
+            client.sendall(b'GET /repodata/repomd.xml HTTP/1.0\r\n\r\n')
+            self.assertTrue(reply.read().endswith(b'contents of /repodata/repomd.xml, version 1'))
+        finally:
+            client.close()
+        self.assertEqual(self._cache.stats()['tunnels'], 1)
+
+    def test_connect_is_only_tunnelled_to_https(self):
+        client = socket.create_connection(('127.0.0.1', self._proxy_port), timeout=10)
+        try:
+            client.sendall(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n' % (self._mirror.server_port,))
+            self.assertIn(b' 403 ', client.makefile('rb').readline())
+        finally:
+            client.close()
+
+    def test_only_private_addresses_may_use_it(self):
+        is_private = stodgy_tester.package_cache._is_private_address
+        self.assertTrue(is_private('192.168.121.10'))
+        self.assertTrue(is_private('127.0.0.1'))
+        self.assertTrue(is_private('169.254.169.254'))
+        self.assertTrue(is_private('::1'))
+        self.assertTrue(is_private('fe80::1'))
+        self.assertTrue(is_private('fd00::1'))
+        self.assertTrue(is_private('::ffff:10.0.0.1'))
+        self.assertFalse(is_private('8.8.8.8'))
+        self.assertFalse(is_private('172.32.0.1'))
+        self.assertFalse(is_private('2001:4860:4860::8888'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+import os
+import shutil
+import tempfile
+import unittest
+import stodgy_tester
+import stodgy_tester.helpers
+
+EXAMPLE_TEST = '''Title: Example
+Vagrant-Box: jessie
+Cleanup: uninstall_sandstorm
+
+$[run]echo hi
+$[slow]hi
+Continue? $[type]yes
+$[exitcode] 0
+'''
+
+
+class TestTestPlan(unittest.TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._old_state_dir = os.environ.get('STODGY_TESTER_STATE_DIR')
+        os.environ['STODGY_TESTER_STATE_DIR'] = os.path.join(self._tempdir, 'state')
+        self._filename = os.path.join(self._tempdir, 'example.t')
+        with open(self._filename, 'w') as f:
+            f.write(EXAMPLE_TEST)
+        stodgy_tester._test_plans_by_filename.clear()
+
+    def tearDown(self):
+        if self._old_state_dir is None:
+            del os.environ['STODGY_TESTER_STATE_DIR']
+        else:
+            os.environ['STODGY_TESTER_STATE_DIR'] = self._old_state_dir
+        stodgy_tester._test_plans_by_filename.clear()
+        shutil.rmtree(self._tempdir)
+
+    def test_steps_are_classified(self):
+        plan = stodgy_tester.load_test_plan(self._filename)
+        self.assertEqual(plan.vagrant_box_name, 'jessie')
+        self.assertEqual(plan.cleanups, [['cleanup', 'uninstall_sandstorm']])
+        kinds = [step['kind'] for step in plan.steps]
+        self.assertEqual(kinds, ['run', 'expect', 'type', 'exitcode', 'expect'])
+        self.assertEqual(plan.steps[0]['command'], 'echo hi')
+        self.assertEqual(plan.steps[1]['timeout_class'], 'slow')
+        self.assertEqual(plan.steps[1]['text'], 'hi')
+        self.assertEqual(plan.steps[2]['response'], 'yes')
+        self.assertEqual(plan.steps[3]['exitcode'], 0)
+        self.assertEqual(plan.steps[0]['lineno'], 5)
+
+    def test_machine_backend_header(self):
+        plan = stodgy_tester.load_test_plan(self._filename)
+        self.assertEqual((plan.machine_backend, plan.machine_name), ('vagrant', 'jessie'))
+        with open(self._filename, 'w') as f:
+            f.write(EXAMPLE_TEST.replace(
+                'Vagrant-Box: jessie', 'Vagrant-Box: jessie\nMachine-Backend: local'))
+        plan = stodgy_tester.TestPlan.compile(self._filename)
+        self.assertEqual((plan.machine_backend, plan.machine_name), ('local', 'local:jessie'))
+        machine = stodgy_tester.make_machine(plan.machine_name)
+        self.assertTrue(isinstance(machine, stodgy_tester.helpers.LocalProcessMachine))
+        # Plugins assume they may do anything to the machine, which here is this host.
+        self.assertRaises(Exception, stodgy_tester.run_plugin_function, 'uninstall_sandstorm',
+                          machine)
+
+    def test_plan_is_reused_from_disk(self):
+        stodgy_tester.load_test_plan(self._filename)
+        stodgy_tester._test_plans_by_filename.clear()
+        compile_calls = []
+        original_compile = stodgy_tester.TestPlan.__dict__['compile']
+
+        def counting_compile(filename):
+            compile_calls.append(filename)
+            return original_compile.__func__(stodgy_tester.TestPlan, filename)
+
+        stodgy_tester.TestPlan.compile = staticmethod(counting_compile)
+        try:
+            plan = stodgy_tester.load_test_plan(self._filename)
+        finally:
+            stodgy_tester.TestPlan.compile = original_compile
+        self.assertEqual(compile_calls, [])
+        self.assertEqual(plan.steps[2]['text'], 'Continue?')
+
+    def test_edited_file_is_recompiled(self):
+        stodgy_tester.load_test_plan(self._filename)
+        stodgy_tester._test_plans_by_filename.clear()
+        mtime = os.path.getmtime(self._filename)
+        with open(self._filename, 'w') as f:
+            f.write(EXAMPLE_TEST.replace('Continue?', 'Proceed?'))
+        os.utime(self._filename, (mtime + 1, mtime + 1))
+        plan = stodgy_tester.load_test_plan(self._filename)
+        self.assertEqual(plan.steps[2]['text'], 'Proceed?')
+
+    def test_prioritize_keeps_boxes_together(self):
+        filenames = []
+        for name, box in [('a.t', 'jessie'), ('b.t', 'jessie'), ('c.t', 'centos'),
+                          ('d.t', 'centos'), ('e.t', 'trusty')]:
+            filename = os.path.join(self._tempdir, name)
+            with open(filename, 'w') as f:
+                f.write(EXAMPLE_TEST.replace('jessie', box))
+            filenames.append(filename)
+        likelihoods = {'b.t': 0.4, 'd.t': 0.1}
+        durations = {'a.t': 10, 'b.t': 5, 'c.t': 50, 'd.t': 1, 'e.t': 100}
+
+        def short_name(filename):
+            return os.path.basename(filename)
+
+        order = stodgy_tester.prioritize_testfiles(
+            filenames,
+            lambda filename: likelihoods.get(short_name(filename), 0.0),
+            lambda filename: durations[short_name(filename)])
+        # Likeliest failures first, then the longest box, then the longest test.
+        self.assertEqual([short_name(ordered) for ordered in order],
+                         ['b.t', 'a.t', 'd.t', 'c.t', 'e.t'])
+
+
+class LocalShell(stodgy_tester.helpers.Machine):
+    '''Stands in for a VirtualMachine, running each command in bash on this host.'''
+    def __init__(self):
+        super(LocalShell, self).__init__('local', command_runner=None)
+
+    def ssh_argv(self, command_as_str, tty=False):
+        return ['bash', '-c', command_as_str]
+
+
+class TestHandleTestScript(unittest.TestCase):
+    def test_script_drives_an_interactive_command(self):
+        steps = stodgy_tester.compile_test_script([
+            '$[run]read -p "Name? " name; echo "Hello, $name"; exit 3',
+            'Name? $[type]world',
+            'Hello, world',
+            '$[exitcode] 3',
+        ])
+        stodgy_tester.handle_test_script(LocalShell(), steps)
+
+    def test_named_sessions_run_at_the_same_time(self):
+        steps = stodgy_tester.compile_test_script([
+            '$[run:server]seq 1 20000; read line; echo "server got $line"; exit 4',
+            '$[run:client]sleep 0.3; echo client done',
+            '$[expect:client]$[slow]client done',
+            '$[exitcode:client] 0',
+            '20000 $[type:server]hello',
+            'server got hello',
+            '$[exitcode] 4',
+            '',
+        ])
+        self.assertEqual([(step['kind'], step['session']) for step in steps], [
+            ('run', 'server'), ('run', 'client'), ('expect', 'client'), ('exitcode', 'client'),
+            ('type', 'server'), ('expect', None), ('exitcode', None), ('expect', None)])
+        self.assertEqual(steps[2]['timeout_class'], 'slow')
+        self.assertEqual(steps[2]['text'], 'client done')
+        stodgy_tester.handle_test_script(LocalShell(), steps)
+
+    def test_named_session_must_exit_before_it_runs_again(self):
+        steps = stodgy_tester.compile_test_script([
+            '$[run:server]sleep 30',
+            '$[run:server]echo again',
+            '$[exitcode:server] 0',
+        ])
+        with self.assertRaisesRegexp(Exception, "'server' is still running"):
+            stodgy_tester.handle_test_script(LocalShell(), steps)
+
+    def test_plain_run_replaces_a_command_that_is_still_running(self):
+        steps = stodgy_tester.compile_test_script([
+            '$[run]sleep 30',
+            '$[run]echo again',
+            'again',
+            '$[exitcode] 0',
+        ])
+        stodgy_tester.handle_test_script(LocalShell(), steps)
+
+    def test_wrong_exit_code_fails(self):
+        steps = stodgy_tester.compile_test_script(['$[run]true', '$[exitcode] 1'])
+        self.assertRaises(AssertionError, stodgy_tester.handle_test_script, LocalShell(), steps)
+
+
+class FakePlugin(object):
+    def __init__(self):
+        self.calls = []
+
+    @stodgy_tester.helpers.produces_state('clean')
+    def uninstall(self, vm):
+        self.calls.append('uninstall')
+
+    @stodgy_tester.helpers.checks_state('clean')
+    def is_clean(self, vm):
+        self.calls.append('is_clean')
+
+    def undeclared(self, vm):
+        self.calls.append('undeclared')
+
+
+class KnownStateVirtualMachine(stodgy_tester.helpers.VirtualMachine):
+    def up_or_resume_if_needed(self):
+        pass
+
+
+class TestKnownStates(unittest.TestCase):
+    def setUp(self):
+        self._old_plugin = stodgy_tester.plugin
+        stodgy_tester.plugin = FakePlugin()
+        self._vm = KnownStateVirtualMachine('jessie', command_runner=None)
+
+    def tearDown(self):
+        stodgy_tester.plugin = self._old_plugin
+
+    def test_precondition_is_skipped_once_known_to_hold(self):
+        headers = {'precondition': ['is_clean']}
+        stodgy_tester.handle_headers(headers, self._vm)
+        stodgy_tester.handle_headers(headers, self._vm)
+        self.assertEqual(stodgy_tester.plugin.calls, ['is_clean'])
+
+        stodgy_tester.run_plugin_function('undeclared', self._vm)
+        stodgy_tester.handle_headers(headers, self._vm)
+        stodgy_tester.run_plugin_function('uninstall', self._vm)
+        stodgy_tester.handle_headers(headers, self._vm)
+        self.assertEqual(stodgy_tester.plugin.calls,
+                         ['is_clean', 'undeclared', 'is_clean', 'uninstall'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import stodgy_tester.tracing
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self._events = []
+        stodgy_tester.tracing.add_listener(self._events.append)
+
+    def tearDown(self):
+        stodgy_tester.tracing.remove_listener(self._events.append)
+
+    def test_spans_know_their_test_and_nesting(self):
+        with self.assertRaises(ValueError):
+            with stodgy_tester.tracing.span('test', 'a.t'):
+                with stodgy_tester.tracing.span('vm', 'up_or_resume', box='jessie'):
+                    with stodgy_tester.tracing.span('vm', 'up'):
+                        pass
+                raise ValueError()
+        with stodgy_tester.tracing.span('vm', 'suspend'):
+            pass
+
+        self.assertEqual(
+            [(e['category'], e['name'], e['test'], e['nested'], e['failed']) for e in self._events],
+            [('vm', 'up', 'a.t', True, False),
+             ('vm', 'up_or_resume', 'a.t', False, False),
+             ('test', 'a.t', 'a.t', False, True),
+             ('vm', 'suspend', None, False, False)])
+        self.assertEqual(self._events[1]['args'], {'box': 'jessie'})
+        self.assertTrue(all(e['duration'] >= 0 for e in self._events))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'clock_gettime() is only sure on Linux')
+    def test_clock_is_monotonic_not_the_wall_clock(self):
+        clock = stodgy_tester.tracing.clock
+        self.assertFalse(clock is time.time)
+        started = clock()
+        time.sleep(0.01)
+        self.assertTrue(0.01 <= clock() - started < 1)
+
+    def test_exporters(self):
+        report = stodgy_tester.tracing.TimingReport()
+        chrome_trace = stodgy_tester.tracing.ChromeTrace()
+        stodgy_tester.tracing.add_listener(report)
+        stodgy_tester.tracing.add_listener(chrome_trace)
+        try:
+            with stodgy_tester.tracing.span('test', 'a.t'):
+                for i in range(2):
+                    with stodgy_tester.tracing.span('expect', 'hello'):
+                        pass
+                ssh_span = stodgy_tester.tracing.start_span('ssh', 'echo hello')
+                ssh_span.end()
+                ssh_span.end()
+        finally:
+            stodgy_tester.tracing.remove_listener(report)
+            stodgy_tester.tracing.remove_listener(chrome_trace)
+
+        [test] = report.tests()
+        self.assertEqual(test['test'], 'a.t')
+        self.assertTrue(test['passed'])
+        self.assertEqual(sorted(test['categories']), ['expect', 'ssh'])
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'trace.json')
+            chrome_trace.write(filename)
+            with open(filename) as f:
+                trace_events = json.load(f)['traceEvents']
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual([e['ph'] for e in trace_events], ['M', 'X', 'X', 'X', 'X'])
+        self.assertEqual(sorted(e['name'] for e in trace_events[1:]),
+                         ['a.t', 'echo hello', 'hello', 'hello'])
+
+
+if __name__ == '__main__':
+    unittest.main()